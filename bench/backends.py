@@ -0,0 +1,345 @@
+import io
+import os
+import re
+import json
+import time
+import random
+import sqlite3
+import asyncio
+import hashlib
+import datetime
+import threading
+import itertools
+from types import SimpleNamespace
+import pyarrow as pa
+
+# --- Replayed Gemini ---
+
+def _prompt_key(prompt) -> str:
+    return hashlib.sha256(str(prompt).encode()).hexdigest()
+
+
+def _response(text: str, prompt, usage: dict = None):
+    """Minimal stand-in for a GenerateContentResponse: `.text` plus token usage."""
+    usage = usage or {
+        # Roughly four characters per token, like Gemini on English text.
+        "prompt_token_count": len(str(prompt)) // 4,
+        "candidates_token_count": len(text) // 4,
+    }
+    return SimpleNamespace(text=text, usage_metadata=SimpleNamespace(**usage))
+
+
+class ReplayLLMClient:
+    """
+    Drop-in for `genai.Client()` that answers from a recording instead of calling Gemini.
+
+    A recording is {"exact": {prompt_sha256: {"text", "usage"}}, "rules": [{"contains", "text"}]}.
+    Exact entries (written by RecordingLLMClient) win; otherwise the first rule whose
+    substrings all appear in the prompt is used. Every call waits `latency` +/- `jitter`
+    seconds to model the API round trip.
+    """
+
+    def __init__(self, recording: dict, latency: float = 0.0, jitter: float = 0.0, seed: int = 0):
+        self.recording = recording
+        self.latency = latency
+        self.jitter = jitter
+        self._random = random.Random(seed)
+        self.calls = 0
+        self.models = SimpleNamespace(generate_content=self._generate_content)
+        self.aio = SimpleNamespace(models=SimpleNamespace(generate_content=self._generate_content_async))
+
+    @classmethod
+    def from_file(cls, path: str, **options) -> "ReplayLLMClient":
+        with open(path) as f:
+            return cls(json.load(f), **options)
+
+    def _delay(self) -> float:
+        return max(self._random.uniform(self.latency - self.jitter, self.latency + self.jitter), 0.0)
+
+    def respond(self, prompt):
+        self.calls += 1
+        entry = self.recording.get("exact", {}).get(_prompt_key(prompt))
+        if entry is not None:
+            return _response(entry["text"], prompt, entry.get("usage"))
+        for rule in self.recording.get("rules", []):
+            if all(fragment in str(prompt) for fragment in rule["contains"]):
+                return _response(rule["text"], prompt, rule.get("usage"))
+        raise LookupError(f"No recorded response for prompt: {str(prompt)[:120]!r}")
+
+    def _generate_content(self, model: str, contents, config=None):
+        time.sleep(self._delay())
+        return self.respond(contents)
+
+    async def _generate_content_async(self, model: str, contents, config=None):
+        await asyncio.sleep(self._delay())
+        return self.respond(contents)
+
+
+class RecordingLLMClient:
+    """
+    Wraps a live `genai.Client()` and records every prompt and response, so a run against
+    real Gemini can later be replayed offline with ReplayLLMClient. Call `save()` at the end.
+    """
+
+    def __init__(self, client, path: str):
+        self._client = client
+        self.path = path
+        self._exact = {}
+        self._lock = threading.Lock()
+        self.models = SimpleNamespace(generate_content=self._generate_content)
+        self.aio = SimpleNamespace(models=SimpleNamespace(generate_content=self._generate_content_async))
+
+    def _record(self, prompt, response):
+        usage = getattr(response, "usage_metadata", None)
+        with self._lock:
+            self._exact[_prompt_key(prompt)] = {
+                "text": response.text,
+                "usage": {
+                    "prompt_token_count": getattr(usage, "prompt_token_count", None) or 0,
+                    "candidates_token_count": getattr(usage, "candidates_token_count", None) or 0,
+                },
+            }
+        return response
+
+    def _generate_content(self, model: str, contents, config=None):
+        return self._record(contents, self._client.models.generate_content(model=model, contents=contents, config=config))
+
+    async def _generate_content_async(self, model: str, contents, config=None):
+        response = await self._client.aio.models.generate_content(model=model, contents=contents, config=config)
+        return self._record(contents, response)
+
+    def save(self):
+        with self._lock:
+            with open(self.path, "w") as f:
+                json.dump({"exact": self._exact, "rules": []}, f, indent=2)
+
+
+# --- SQLite Warehouse ---
+
+_SQLITE_TYPES = {"INTEGER": "bigint", "REAL": "double", "TEXT": "string", "DATE": "date"}
+
+SAMPLE_TABLES = {
+    "sales": (
+        "Orders with date, region, product, quantity and revenue amount.",
+        "order_id INTEGER, order_date DATE, region TEXT, product TEXT, quantity INTEGER, amount REAL",
+    ),
+    "web_traffic": (
+        "Daily page views and sessions per country and page.",
+        "visit_date DATE, country TEXT, page TEXT, page_views INTEGER, sessions INTEGER",
+    ),
+    "customers": (
+        "Customers with signup date, segment, country and lifetime value.",
+        "customer_id INTEGER, signup_date DATE, segment TEXT, country TEXT, lifetime_value REAL",
+    ),
+}
+
+
+def _sample_rows(table_name: str, rows: int, rng: random.Random):
+    start = datetime.date(2024, 1, 1)
+    day = lambda: (start + datetime.timedelta(days=rng.randrange(730))).isoformat()
+    regions = ["north", "south", "east", "west", "central"]
+    countries = ["US", "DE", "FR", "IN", "BR", "JP", "GB", "CA"]
+    for i in range(rows):
+        if table_name == "sales":
+            quantity = rng.randint(1, 20)
+            yield (i, day(), rng.choice(regions), f"product_{rng.randrange(40)}", quantity,
+                   round(quantity * rng.uniform(5, 120), 2))
+        elif table_name == "web_traffic":
+            views = rng.randint(10, 5000)
+            yield (day(), rng.choice(countries), f"/page/{rng.randrange(25)}", views, views // rng.randint(2, 6))
+        else:
+            yield (i, day(), rng.choice(["consumer", "smb", "enterprise"]), rng.choice(countries),
+                   round(rng.lognormvariate(6, 1), 2))
+
+
+def build_sample_database(path: str, rows: int = 50000, schema: str = "bench", seed: int = 0):
+    """
+    Writes the sample tables plus `information_schema_tables` / `information_schema_columns`
+    emulation tables, which is what the SQLite warehouse rewrites catalog queries to.
+    """
+    rng = random.Random(seed)
+    with sqlite3.connect(path) as db:
+        db.execute("CREATE TABLE information_schema_tables (table_schema TEXT, table_name TEXT, comment TEXT)")
+        db.execute(
+            "CREATE TABLE information_schema_columns "
+            "(table_schema TEXT, table_name TEXT, column_name TEXT, data_type TEXT, ordinal_position INTEGER)"
+        )
+        for table_name, (comment, columns) in SAMPLE_TABLES.items():
+            db.execute(f"CREATE TABLE {table_name} ({columns})")
+            placeholders = ", ".join("?" for _ in columns.split(","))
+            db.executemany(f"INSERT INTO {table_name} VALUES ({placeholders})", _sample_rows(table_name, rows, rng))
+            db.execute("INSERT INTO information_schema_tables VALUES (?, ?, ?)", (schema, table_name, comment))
+            for position, column in enumerate(columns.split(","), start=1):
+                column_name, column_type = column.split()
+                db.execute(
+                    "INSERT INTO information_schema_columns VALUES (?, ?, ?, ?, ?)",
+                    (schema, table_name, column_name, _SQLITE_TYPES[column_type], position),
+                )
+
+
+class _Cursor:
+    def __init__(self, warehouse: "SQLiteWarehouse", connection: sqlite3.Connection):
+        self._warehouse = warehouse
+        self._connection = connection
+        self._cursor = connection.cursor()
+        self._cancelled = threading.Event()
+        self.description = None
+        self._rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def execute(self, sql: str, parameters=None):
+        if sql.lstrip().upper().startswith("EXPLAIN COST"):
+            # The scan-budget check only reads sizeInBytes; report the whole database file.
+            size = os.path.getsize(self._warehouse.path)
+            self.description, self._rows = [("plan",)], [(f"Statistics(sizeInBytes={size} B)",)]
+            return
+        sql = self._warehouse.translate(sql)
+        if sql is None:
+            # Databricks-only statements (table and column comments) are accepted and ignored.
+            self.description, self._rows = [], []
+            return
+        if sql != "SELECT 1" and self._warehouse.latency:
+            # Interruptible, so cursor.cancel() from another thread ends the "query" early.
+            if self._cancelled.wait(self._warehouse.latency):
+                raise sqlite3.OperationalError("Query was cancelled.")
+        if replace := self._warehouse._REPLACE_RE.match(sql):
+            # SQLite has no CREATE OR REPLACE TABLE (used for rollups).
+            self._cursor.execute(f"DROP TABLE IF EXISTS {replace.group(1)}")
+            sql = f"CREATE TABLE {replace.group(1)}{sql[replace.end():]}"
+        self._cursor.execute(sql, parameters or ())
+        self.description = self._cursor.description
+        self._rows = self._cursor.fetchall()
+
+    def fetchall(self):
+        return self._rows
+
+    def fetchall_arrow(self) -> pa.Table:
+        names = [d[0] for d in self.description or []]
+        columns = list(zip(*self._rows)) if self._rows else [[] for _ in names]
+        return pa.table({name: pa.array(values) for name, values in zip(names, columns)})
+
+    def cancel(self):
+        self._cancelled.set()
+        self._connection.interrupt()
+
+    def close(self):
+        self._cursor.close()
+
+
+class _Connection:
+    def __init__(self, warehouse: "SQLiteWarehouse"):
+        self._warehouse = warehouse
+        self._connection = sqlite3.connect(warehouse.path, check_same_thread=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def cursor(self):
+        return _Cursor(self._warehouse, self._connection)
+
+    def close(self):
+        self._connection.close()
+
+
+class SQLiteWarehouse:
+    """
+    Stands in for a Databricks SQL warehouse: `connect()` returns DB-API style connections
+    over a SQLite file built by `build_sample_database`. Catalog-qualified names are
+    unwrapped and information_schema queries are redirected to the emulation tables.
+    Each query waits `latency` seconds first, to model warehouse round trips.
+    Pass `connect` to `db_pool.init_pool(connect=...)`.
+    """
+
+    _COMMENT_RE = re.compile(r"^\s*(COMMENT\s+ON|ALTER\s+TABLE\s+.*\s+COMMENT\s)", re.IGNORECASE | re.DOTALL)
+    _REPLACE_RE = re.compile(r"^\s*CREATE\s+OR\s+REPLACE\s+TABLE\s+(\S+)", re.IGNORECASE)
+
+    def __init__(self, path: str, catalog: str, schema: str, latency: float = 0.0):
+        self.path = path
+        self.latency = latency
+        self.connections_opened = 0
+        quoted = lambda name: rf"`?{re.escape(name)}`?"
+        self._information_schema_re = re.compile(rf"{quoted(catalog)}\.information_schema\.(tables|columns)")
+        self._qualified_re = re.compile(rf"{quoted(catalog)}\.{quoted(schema)}\.")
+
+    def translate(self, sql: str) -> str:
+        """Rewrites Databricks SQL into what SQLite understands; None for ignored statements."""
+        if self._COMMENT_RE.match(sql):
+            return None
+        sql = self._information_schema_re.sub(r"information_schema_\1", sql)
+        return self._qualified_re.sub("", sql)
+
+    def connect(self) -> _Connection:
+        self.connections_opened += 1
+        return _Connection(self)
+
+
+# --- Databricks Workspace ---
+
+class FakeWorkspaceClient:
+    """
+    Stands in for `databricks.sdk.WorkspaceClient`: `files.upload` drains the stream at
+    `upload_bandwidth` bytes/s (0 for unlimited) and `jobs` report every run as running
+    until `job_latency` seconds after it was started, then as succeeded. Small files (such
+    as append manifests) are kept, so `files.download` can return them.
+    Pass it to `databricks_integration.set_workspace_client`.
+    """
+
+    def __init__(self, upload_bandwidth: float = 0.0, job_latency: float = 0.0):
+        self.upload_bandwidth = upload_bandwidth
+        self.job_latency = job_latency
+        self.uploaded = {}  # path -> bytes received
+        self.kept = {}  # path -> contents, for files up to 1 MB
+        self._run_ids = itertools.count(1)
+        self._started = {}  # run_id -> monotonic start time
+        self.files = SimpleNamespace(upload=self._upload, download=self._download, delete=self._delete)
+        self.jobs = SimpleNamespace(run_now=self._run_now, get_run=self._get_run)
+
+    def _upload(self, file_path: str, contents, overwrite: bool = False, **options):
+        if isinstance(contents, (bytes, bytearray)):
+            contents = io.BytesIO(contents)
+        size, head = 0, b""
+        while chunk := contents.read(1024 * 1024):
+            if not size:
+                head = chunk
+            size += len(chunk)
+            if self.upload_bandwidth:
+                time.sleep(len(chunk) / self.upload_bandwidth)
+        self.uploaded[file_path] = size
+        if size == len(head) and size < 1024 * 1024:
+            self.kept[file_path] = head
+        else:
+            self.kept.pop(file_path, None)
+
+    def _download(self, file_path: str):
+        if file_path not in self.kept:
+            raise FileNotFoundError(file_path)
+        return SimpleNamespace(contents=io.BytesIO(self.kept[file_path]))
+
+    def _delete(self, file_path: str):
+        if self.uploaded.pop(file_path, None) is None:
+            raise FileNotFoundError(file_path)
+        self.kept.pop(file_path, None)
+
+    def _run_now(self, job_id: int, job_parameters: dict = None):
+        run_id = next(self._run_ids)
+        self._started[run_id] = time.monotonic()
+        return SimpleNamespace(run_id=run_id)
+
+    def _get_run(self, run_id: int, **options):
+        done = time.monotonic() - self._started.get(run_id, 0.0) >= self.job_latency
+        return SimpleNamespace(
+            run_id=run_id,
+            state=SimpleNamespace(
+                life_cycle_state=SimpleNamespace(value="TERMINATED" if done else "RUNNING"),
+                result_state=SimpleNamespace(value="SUCCESS") if done else None,
+                state_message="",
+            ),
+        )
@@ -0,0 +1,221 @@
+"""
+Offline load test for the API: Gemini, the SQL warehouse and the Databricks workspace are
+replaced by the stand-ins in bench/backends.py, so no credentials or network are needed.
+
+    python -m bench.run --scenario visualize --requests 200 --concurrency 16 --llm-latency 0.4
+    python -m bench.run --scenario upload --requests 20 --concurrency 4 --upload-mb 50
+    python -m bench.run --scenario mixed --planner single_shot --json
+
+Reports p50/p95/p99 latency and throughput per endpoint, plus the process's peak RSS.
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import resource
+import tempfile
+import contextlib
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BENCH_CATALOG = "bench_catalog"
+BENCH_SCHEMA = "bench"
+
+QUERIES = [
+    "Total revenue by region",
+    "Daily revenue trend over time",
+    "Show quantity versus amount for each order",
+    "Share of page views by country",
+]
+
+
+def _parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmark for /generate_visualization and /upload/.")
+    parser.add_argument("--scenario", choices=("visualize", "upload", "mixed"), default="visualize")
+    parser.add_argument("--requests", type=int, default=100, help="Total requests to send.")
+    parser.add_argument("--concurrency", type=int, default=8, help="Requests in flight at once.")
+    parser.add_argument("--planner", choices=("multi_step", "single_shot"), default=None)
+    parser.add_argument("--format", choices=("rows", "columnar", "arrow"), default="rows")
+    parser.add_argument("--recording", default=os.path.join(BENCH_DIR, "recordings", "sample.json"))
+    parser.add_argument("--llm-latency", type=float, default=0.3, help="Seconds per Gemini call.")
+    parser.add_argument("--llm-jitter", type=float, default=0.1)
+    parser.add_argument("--sql-latency", type=float, default=0.05, help="Seconds per warehouse query.")
+    parser.add_argument("--rows", type=int, default=50000, help="Rows per sample table.")
+    parser.add_argument("--upload-mb", type=float, default=10.0, help="Size of the CSV sent to /upload/.")
+    parser.add_argument("--upload-bandwidth-mb", type=float, default=0.0, help="Simulated Volume bandwidth, 0 = unlimited.")
+    parser.add_argument("--response-cache", choices=("off", "memory"), default="off")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON.")
+    parser.add_argument("--verbose", action="store_true", help="Keep the application's own output.")
+    return parser.parse_args(argv)
+
+
+def _configure_environment(args, workdir: str):
+    """Settings the app reads at import time, so this must run before `import main`."""
+    os.environ.setdefault("GOOGLE_API_KEY", "bench")
+    os.environ["DB_CATALOG"] = BENCH_CATALOG
+    os.environ["DB_SCHEMA"] = BENCH_SCHEMA
+    os.environ["RESPONSE_CACHE_BACKEND"] = args.response_cache
+    os.environ.setdefault("DB_POOL_MAX_SIZE", str(max(args.concurrency, 2)))
+    if args.planner:
+        os.environ["PLANNER_MODE"] = args.planner
+    os.environ.setdefault("CATALOG_CACHE_TTL", "3600")
+
+
+def _write_upload_csv(path: str, size_mb: float, seed: int):
+    rng = random.Random(seed)
+    target = int(size_mb * 1024 * 1024)
+    with open(path, "w") as f:
+        f.write("order_id,order_date,region,product,quantity,amount\n")
+        i = 0
+        while f.tell() < target:
+            lines = [
+                f"{i + j},2025-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d},region_{rng.randrange(5)},"
+                f"product_{rng.randrange(40)},{rng.randint(1, 20)},{rng.uniform(5, 2000):.2f}\n"
+                for j in range(1000)
+            ]
+            f.writelines(lines)
+            i += len(lines)
+
+
+def _install_backends(args, workdir: str):
+    """Builds the sample warehouse and swaps every external service for its stand-in."""
+    from bench.backends import ReplayLLMClient, SQLiteWarehouse, FakeWorkspaceClient, build_sample_database
+    import db_pool
+    import databricks_flow
+    import databricks_integration
+
+    database = os.path.join(workdir, "warehouse.sqlite")
+    build_sample_database(database, rows=args.rows, schema=BENCH_SCHEMA, seed=args.seed)
+    warehouse = SQLiteWarehouse(database, BENCH_CATALOG, BENCH_SCHEMA, latency=args.sql_latency)
+    # The lifespan hook's init_pool() returns this pool instead of dialing Databricks.
+    db_pool.init_pool(connect=warehouse.connect)
+
+    llm = ReplayLLMClient.from_file(
+        args.recording, latency=args.llm_latency, jitter=args.llm_jitter, seed=args.seed
+    )
+    databricks_flow.set_client(llm)
+    workspace = FakeWorkspaceClient(upload_bandwidth=args.upload_bandwidth_mb * 1024 * 1024)
+    databricks_integration.set_workspace_client(workspace)
+    return llm, warehouse, workspace
+
+
+def _request_plan(args) -> list:
+    if args.scenario == "visualize":
+        return ["visualize"] * args.requests
+    if args.scenario == "upload":
+        return ["upload"] * args.requests
+    # Mixed: roughly one upload per ten visualizations.
+    rng = random.Random(args.seed)
+    return ["upload" if rng.random() < 0.1 else "visualize" for _ in range(args.requests)]
+
+
+async def _drive(app, args, upload_csv: str) -> tuple[list, float]:
+    import httpx
+
+    plan = _request_plan(args)
+    queue = asyncio.Queue()
+    for i, kind in enumerate(plan):
+        queue.put_nowait((i, kind))
+    samples = []  # (endpoint, status, seconds)
+
+    async def send(client, i: int, kind: str):
+        if kind == "visualize":
+            body = {"query": QUERIES[i % len(QUERIES)], "format": args.format}
+            if args.planner:
+                body["planner"] = args.planner
+            return await client.post("/generate_visualization", json=body)
+        with open(upload_csv, "rb") as f:
+            return await client.post("/upload/", files={"file": (f"bench_upload_{i}.csv", f, "text/csv")})
+
+    async def worker(client):
+        while not queue.empty():
+            i, kind = queue.get_nowait()
+            start = time.perf_counter()
+            try:
+                status = (await send(client, i, kind)).status_code
+            except Exception as e:
+                print(f"Request {i} failed: {e}", file=sys.stderr)
+                status = 0
+            samples.append((kind, status, time.perf_counter() - start))
+
+    transport = httpx.ASGITransport(app=app)
+    async with app.router.lifespan_context(app), httpx.AsyncClient(
+        transport=transport, base_url="http://bench", timeout=None
+    ) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - start
+    return samples, elapsed
+
+
+def _summarize(samples: list, elapsed: float, llm, warehouse) -> dict:
+    endpoints = {}
+    for kind in sorted({s[0] for s in samples}):
+        latencies = np.array([s[2] for s in samples if s[0] == kind]) * 1000
+        statuses = [s[1] for s in samples if s[0] == kind]
+        errors = sum(1 for status in statuses if status != 200)
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        endpoints[kind] = {
+            "requests": len(statuses),
+            "errors": errors,
+            "p50_ms": round(float(p50), 1),
+            "p95_ms": round(float(p95), 1),
+            "p99_ms": round(float(p99), 1),
+            "throughput_rps": round(len(statuses) / elapsed, 2),
+        }
+    # ru_maxrss is reported in KiB on Linux and in bytes on macOS.
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_rss_mb = peak_rss / (1024 * 1024) if sys.platform == "darwin" else peak_rss / 1024
+    return {
+        "elapsed_s": round(elapsed, 2),
+        "throughput_rps": round(len(samples) / elapsed, 2),
+        "peak_rss_mb": round(peak_rss_mb, 1),
+        "llm_calls": llm.calls,
+        "warehouse_connections": warehouse.connections_opened,
+        "endpoints": endpoints,
+    }
+
+
+def _print_report(report: dict, args):
+    print(f"scenario={args.scenario} requests={args.requests} concurrency={args.concurrency} "
+          f"llm_latency={args.llm_latency}s sql_latency={args.sql_latency}s")
+    print(f"{'endpoint':<12}{'requests':>9}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'req/s':>9}")
+    for kind, stats in report["endpoints"].items():
+        print(f"{kind:<12}{stats['requests']:>9}{stats['errors']:>8}{stats['p50_ms']:>10}"
+              f"{stats['p95_ms']:>10}{stats['p99_ms']:>10}{stats['throughput_rps']:>9}")
+    print(f"total: {report['throughput_rps']} req/s over {report['elapsed_s']}s, "
+          f"peak RSS {report['peak_rss_mb']} MB, {report['llm_calls']} LLM calls, "
+          f"{report['warehouse_connections']} warehouse connections")
+
+
+def main(argv=None):
+    args = _parse_args(argv)
+    with tempfile.TemporaryDirectory(prefix="viz-bench-") as workdir:
+        _configure_environment(args, workdir)
+        sys.path.insert(0, os.path.dirname(BENCH_DIR))
+        llm, warehouse, _ = _install_backends(args, workdir)
+        import main as app_module
+
+        upload_csv = os.path.join(workdir, "upload.csv")
+        if args.scenario != "visualize":
+            _write_upload_csv(upload_csv, args.upload_mb, args.seed)
+
+        quiet = open(os.devnull, "w") if not args.verbose else None
+        with contextlib.redirect_stdout(quiet) if quiet else contextlib.nullcontext():
+            samples, elapsed = asyncio.run(_drive(app_module.app, args, upload_csv))
+        if quiet:
+            quiet.close()
+
+    report = _summarize(samples, elapsed, llm, warehouse)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        _print_report(report, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+import os
+from typing import NamedTuple
+
+
+class ChartType(NamedTuple):
+    name: str
+    # What the query result must look like; shown to the model when it picks a chart.
+    data_shape: str
+    # Upper bound on rows sent to the browser.
+    row_budget: int
+    # "lttb" or "minmax" for charts whose data can be downsampled without losing its shape.
+    downsample: str = None
+
+
+# --- Chart Registry ---
+# Every chart type the frontend may render. Only the ones listed in CHART_TYPES (env,
+# comma-separated) are offered to the model; the rest stay registered for governance.
+_REGISTRY = {}
+
+CHART_TYPES = [n.strip() for n in os.environ.get("CHART_TYPES", "line,bar,pie,radar,scatter").split(",") if n.strip()]
+DEFAULT_ROW_BUDGET = int(os.environ.get("ROW_BUDGET_DEFAULT", "5000"))
+
+
+def register_chart_type(name: str, data_shape: str, row_budget: int, downsample: str = None) -> ChartType:
+    """Adds or replaces a chart type; enable it for the model through CHART_TYPES."""
+    chart = ChartType(name, data_shape, row_budget, downsample)
+    _REGISTRY[name] = chart
+    return chart
+
+
+def get_chart_type(name: str) -> ChartType:
+    """Registered chart type, or None."""
+    return _REGISTRY.get(name)
+
+
+def enabled_chart_types() -> list:
+    """Chart types offered to the model, in CHART_TYPES order."""
+    return [_REGISTRY[n] for n in CHART_TYPES if n in _REGISTRY]
+
+
+def chart_type_names() -> list:
+    return [chart.name for chart in enabled_chart_types()]
+
+
+def row_budget(chart_type: str) -> int:
+    """Row budget for a chart type; override with ROW_BUDGET_<TYPE>, e.g. ROW_BUDGET_SCATTER=10000."""
+    override = os.environ.get(f"ROW_BUDGET_{chart_type.upper().replace('-', '_')}")
+    if override:
+        return int(override)
+    chart = _REGISTRY.get(chart_type)
+    return chart.row_budget if chart else DEFAULT_ROW_BUDGET
+
+
+def downsample_method(chart_type: str) -> str:
+    chart = _REGISTRY.get(chart_type)
+    return chart.downsample if chart else None
+
+
+# --- Built-in Chart Types ---
+
+register_chart_type(
+    "line", "an ordered x column (date, time or number) and one or more numeric y columns; "
+    "optionally a category column to split series", 2000, "lttb",
+)
+register_chart_type("bar", "one category column and one or more numeric measures", 500)
+register_chart_type("pie", "one category column with few distinct values and one numeric measure (parts of a whole)", 50)
+register_chart_type("radar", "one category column (the axes) and one or more numeric measures", 200)
+register_chart_type("scatter", "two numeric columns, optionally a category column", 5000, "minmax")
+
+# Chart.js plugin types used by the extended frontend.
+register_chart_type("bar-funnel", "an ordered stage column and a numeric count per stage", 50)
+register_chart_type("boxplot", "a category column and unaggregated numeric values per category", 5000)
+register_chart_type("error-bars", "a category column, a numeric value and lower and upper bound columns", 500)
+register_chart_type("financial", "a date column with open, high, low and close columns", 2000)
+register_chart_type("funnel", "an ordered stage column and a numeric count per stage", 50)
+register_chart_type("geo", "a country or region name or code column and a numeric value", 500)
+register_chart_type("graph", "source and target node columns, optionally a numeric edge weight", 2000)
+register_chart_type("matrix", "two category columns and a numeric value per pair (a heatmap)", 2500)
+register_chart_type("pcp", "several numeric columns per row, optionally a category column (parallel coordinates)", 1000)
+register_chart_type("sankey", "source and target category columns and a numeric flow between them", 500)
+register_chart_type("smith", "real and imaginary numeric columns of complex impedance values", 1000)
+register_chart_type("stacked100", "a category column, a series column and a numeric value", 500)
+register_chart_type("treemap", "one or more nested category columns and a numeric size", 500)
+register_chart_type("venn", "set names (or intersections) and a numeric count per set", 50)
+register_chart_type("word-cloud", "a word or term column and a numeric frequency", 200)
+
+if unknown := [n for n in CHART_TYPES if n not in _REGISTRY]:
+    print(f"CHART_TYPES lists unregistered chart types, ignoring: {', '.join(unknown)}")
@@ -0,0 +1,103 @@
+from typing import BinaryIO
+import pyarrow as pa
+import pyarrow.compute as pc
+
+# Larger blocks give the CSV reader more rows to infer column types from, at the cost of
+# holding one block in memory at a time.
+CSV_BLOCK_SIZE = 8 * 1024 * 1024
+# Distinct values are counted exactly up to this many per column, then reported as a floor.
+DISTINCT_LIMIT = 10000
+
+
+class CsvConversionError(ValueError):
+    """Raised when a CSV cannot be parsed into a consistently typed table."""
+
+
+class _ColumnStats:
+    def __init__(self, name: str, data_type: pa.DataType):
+        self.name = name
+        self.type = data_type
+        self.null_count = 0
+        self.distinct = set()
+        self.distinct_capped = False
+        self.min = None
+        self.max = None
+
+    def update(self, column: pa.Array):
+        self.null_count += column.null_count
+
+        if not self.distinct_capped:
+            self.distinct.update(pc.unique(column.drop_null()).to_pylist())
+            if len(self.distinct) > DISTINCT_LIMIT:
+                self.distinct_capped = True
+                self.distinct = set()
+
+        if pa.types.is_integer(self.type) or pa.types.is_floating(self.type) or pa.types.is_temporal(self.type):
+            bounds = pc.min_max(column)
+            lo, hi = bounds["min"].as_py(), bounds["max"].as_py()
+            if lo is not None:
+                self.min = lo if self.min is None else min(self.min, lo)
+                self.max = hi if self.max is None else max(self.max, hi)
+
+    @staticmethod
+    def _plain(value):
+        # Keep numbers as numbers; dates and timestamps become ISO-like strings for JSON.
+        return value if value is None or isinstance(value, (int, float)) else str(value)
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "type": str(self.type),
+            "null_count": self.null_count,
+            "distinct_count": DISTINCT_LIMIT if self.distinct_capped else len(self.distinct),
+            "distinct_capped": self.distinct_capped,
+            "min": self._plain(self.min),
+            "max": self._plain(self.max),
+        }
+
+
+def csv_to_parquet(source: BinaryIO, destination: BinaryIO, compression: str = "zstd") -> dict:
+    """
+    Stream-parses a CSV with pyarrow, infers a typed schema, writes compressed Parquet to
+    `destination` and returns a profile:
+    {"row_count", "columns": [{"name", "type", "null_count", "distinct_count", "min", "max", ...}]}.
+
+    Only one CSV block is held in memory at a time. Raises CsvConversionError if a later
+    block does not fit the types inferred from the first one.
+    """
+    # Only uploads need the CSV reader and Parquet writer, so they are not imported at start-up.
+    import pyarrow.csv as pa_csv
+    import pyarrow.parquet as pq
+
+    try:
+        reader = pa_csv.open_csv(source, read_options=pa_csv.ReadOptions(block_size=CSV_BLOCK_SIZE))
+        stats = [_ColumnStats(field.name, field.type) for field in reader.schema]
+        row_count = 0
+        with pq.ParquetWriter(destination, reader.schema, compression=compression) as writer:
+            for batch in reader:
+                writer.write_batch(batch)
+                row_count += batch.num_rows
+                for column_stats, column in zip(stats, batch.columns):
+                    column_stats.update(column)
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError) as e:
+        raise CsvConversionError(f"Could not convert CSV to Parquet: {e}")
+
+    return {"row_count": row_count, "columns": [s.to_dict() for s in stats]}
+
+
+# --- Comments ---
+# Profiles are attached to the created table as comments, which is where the table
+# selection prompt reads its descriptions from.
+
+def describe_column(column: dict) -> str:
+    parts = [column["type"], f"{column['null_count']} nulls"]
+    prefix = ">" if column["distinct_capped"] else ""
+    parts.append(f"{prefix}{column['distinct_count']} distinct")
+    if column["min"] is not None:
+        parts.append(f"range {column['min']} to {column['max']}")
+    return "; ".join(parts)
+
+
+def describe_table(source_name: str, profile: dict) -> str:
+    columns = ", ".join(f"{c['name']} ({c['type']})" for c in profile["columns"])
+    return f"Uploaded from {source_name}: {profile['row_count']} rows. Columns: {columns}."
@@ -1,96 +1,258 @@
 import os
+import asyncio
+import threading
+from functools import lru_cache
+from contextlib import contextmanager
 from dotenv import load_dotenv
-import databricks.sql
-from google import genai
+from pydantic import BaseModel, ValidationError
 import json
+import hashlib
+from db_pool import get_pool
+from metadata_cache import catalog_cache
+from response_cache import create_response_cache_from_env, normalize_query
+from serialization import to_rows
+from result_governor import govern_sql, reduce_result
+from table_index import TableIndex
+from pipeline import Pipeline, Deadline, stage_timeout
+from metrics import timed, record_llm_usage, record_result, record_cache, record_coalesced
+from singleflight import SingleFlight, ThreadSingleFlight
+from sql_guard import create_sql_guard_from_env, ensure_read_only, qualified_name, quote_identifier, quote_string
+from rollups import rollup_manager, is_rollup_table
+from charts import chart_type_names, get_chart_type
+from prompts import (
+    Prompt, TABLE_SELECTION, SQL_GENERATION, INSIGHTS, visualization_template, planner_template,
+    schema_blocks, create_context_cache_from_env,
+)
 
 # Load all environment variables
 load_dotenv()
 
 # --- Connection and API Setup ---
-DB_HOST = os.environ.get('DB_SERVER_HOSTNAME')
-DB_PATH = os.environ.get('DB_HTTP_PATH')
-DB_TOKEN = os.environ.get('DB_ACCESS_TOKEN')
 DB_CATALOG = os.environ.get('DB_CATALOG')
 DB_SCHEMA = os.environ.get('DB_SCHEMA')
 
-client = genai.Client()
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """Returns the shared Gemini client, importing the SDK and creating it on first use."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            from google import genai
+            _client = genai.Client()
+        return _client
+
+
+def set_client(client):
+    """Replaces the Gemini client, e.g. with the replayed one used by bench/."""
+    global _client
+    with _client_lock:
+        _client = client
+
+
+# Explicit Gemini caches for long static prompt prefixes; off unless PROMPT_CONTEXT_CACHE=true.
+context_cache = create_context_cache_from_env()
+
+# Plans and results for repeated or paraphrased questions; None when disabled.
+response_cache = create_response_cache_from_env()
+
+# BM25 index over table names, descriptions and columns; kept in sync with the catalog cache.
+table_index = TableIndex()
+
+# Identical requests arriving together (e.g. a shared dashboard loading) share one in-flight
+# plan, warehouse query and insights call instead of each running their own.
+_plan_flights = SingleFlight()
+_sql_flights = SingleFlight()
+_insights_flights = SingleFlight()
+_visualization_thread_flights = ThreadSingleFlight()
+_sql_thread_flights = ThreadSingleFlight()
+
+# Read-only parse and EXPLAIN-based scan budget for generated SQL, with a cache of SQL
+# that already passed per (table, schema, question).
+sql_guard = create_sql_guard_from_env()
 
 # --- Constants ---
-CHART_TYPES = [
-    "line", "bar", "pie",
-    "radar", "scatter"
-]
+MODEL = "gemini-2.5-flash"
+INSIGHT_SAMPLE_ROWS = 10
+NO_DATA_INSIGHT = "No data was returned from the query, so no insights could be generated."
+
+# "multi_step" runs table selection, chart choice and SQL generation as three LLM calls;
+# "single_shot" asks for all three in one structured call and falls back on failure.
+PLANNER_MODES = ("multi_step", "single_shot")
+PLANNER_MODE = os.environ.get("PLANNER_MODE", "multi_step")
+
+# Table retrieval: only the top-k lexical matches (with their columns) are sent to the LLM,
+# and the LLM call is skipped when the best match matches at least MIN_TERMS query terms
+# and outscores the runner-up by SKIP_RATIO.
+TABLE_INDEX_TOP_K = int(os.environ.get("TABLE_INDEX_TOP_K", "8"))
+TABLE_INDEX_SKIP_RATIO = float(os.environ.get("TABLE_INDEX_SKIP_RATIO", "3.0"))
+TABLE_INDEX_MIN_TERMS = int(os.environ.get("TABLE_INDEX_MIN_TERMS", "2"))
+
+# Wall-clock budget for one request across all stages, in seconds (0 disables it).
+# Each stage is also bounded on its own; override with STAGE_TIMEOUT_<STAGE>.
+REQUEST_LATENCY_BUDGET = float(os.environ.get("REQUEST_LATENCY_BUDGET", "90")) or None
+STAGE_TIMEOUTS = {
+    "catalog": stage_timeout("catalog", 30),
+    "plan": stage_timeout("plan", 45),
+    "data": stage_timeout("data", 60),
+    "insights": stage_timeout("insights", 20),
+}
 
 # --- Helper Functions (Mostly Unchanged) ---
-def get_table_schema(table_name: str, connection):
-    """Retrieves schema for a specific table using an existing connection."""
-    with connection.cursor() as cursor:
+@contextmanager
+def _borrow_connection(connection=None):
+    """Yields the given connection, or checks one out of the shared pool for the block."""
+    if connection is not None:
+        yield connection
+    else:
+        with get_pool().connection() as pooled:
+            yield pooled
+
+
+def get_table_schema(table_name: str, connection=None):
+    """Retrieves schema for a specific table, borrowing a pooled connection if none is given."""
+    with timed("catalog_query"), _borrow_connection(connection) as connection, connection.cursor() as cursor:
         cursor.execute(
             f"""
             SELECT column_name, data_type
-            FROM {DB_CATALOG}.information_schema.columns
-            WHERE table_schema = '{DB_SCHEMA}' AND table_name = '{table_name}'
+            FROM {quote_identifier(DB_CATALOG)}.information_schema.columns
+            WHERE table_schema = {quote_string(DB_SCHEMA)} AND table_name = {quote_string(table_name)}
             ORDER BY ordinal_position
             """
         )
         return [{"column_name": r[0], "data_type": r[1]} for r in cursor.fetchall()]
 
-def get_all_tables_metadata(connection):
-    """Retrieves metadata for all tables using an existing connection."""
-    with connection.cursor() as cursor:
+def get_all_tables_metadata(connection=None):
+    """Retrieves metadata for all tables, borrowing a pooled connection if none is given."""
+    with timed("catalog_query"), _borrow_connection(connection) as connection, connection.cursor() as cursor:
         cursor.execute(
             f"""
             SELECT table_name, comment
-            FROM {DB_CATALOG}.information_schema.tables
-            WHERE table_schema = '{DB_SCHEMA}'
+            FROM {quote_identifier(DB_CATALOG)}.information_schema.tables
+            WHERE table_schema = {quote_string(DB_SCHEMA)}
             ORDER BY table_name
             """
         )
         return [
             {"table_name": r[0], "description": r[1] if r[1] else "No description available."}
-            for r in cursor.fetchall()
+            for r in cursor.fetchall() if not is_rollup_table(r[0])
         ]
 
-# --- LLM-Powered Functions ---
+def get_all_table_schemas(connection=None) -> dict:
+    """Retrieves {table_name: schema} for every table in a single information_schema query."""
+    with timed("catalog_query"), _borrow_connection(connection) as connection, connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            SELECT table_name, column_name, data_type
+            FROM {quote_identifier(DB_CATALOG)}.information_schema.columns
+            WHERE table_schema = {quote_string(DB_SCHEMA)}
+            ORDER BY table_name, ordinal_position
+            """
+        )
+        schemas = {}
+        for r in cursor.fetchall():
+            if not is_rollup_table(r[0]):
+                schemas.setdefault(r[0], []).append({"column_name": r[1], "data_type": r[2]})
+        return schemas
+
+def get_cached_tables_metadata() -> list:
+    """Table list served from the in-process catalog cache."""
+    return catalog_cache.get_tables(get_all_tables_metadata)
+
+def get_cached_table_schema(table_name: str) -> list:
+    """Table schema served from the in-process catalog cache."""
+    return catalog_cache.get_schema(table_name, get_table_schema)
 
-def choose_visualization(user_query: str, schema: list) -> dict:
+def get_cached_all_table_schemas() -> dict:
+    """Schemas for the whole catalog served from the in-process catalog cache."""
+    return catalog_cache.get_all_schemas(get_all_table_schemas)
+
+# (tables, schemas, rollup revision, fingerprint). The lists themselves are kept, not their
+# ids: a freed list's id can be reused by the next catalog load.
+_fingerprint_memo = (None, None, None, None)
+
+def catalog_fingerprint() -> str:
     """
-    Uses an LLM to choose the best visualization type based on the user query and table schema.
-    
-    Returns:
-        A dictionary like {"type": "scatter", "justification": "..."}
+    Short content hash of the cached table list, schemas and rollups.
+    Cached plans are keyed on it, so they miss as soon as the catalog changes.
     """
-    schema_str = "\n".join([f"- {col['column_name']} ({col['data_type']})" for col in schema])
-    
-    llm_instruction = (
-        "You are an expert data analyst. Your task is to recommend the best chart type to answer a user's question "
-        "based on the available data columns. You must choose exactly one type from the provided list.\n"
-        f"Available chart types: {', '.join(CHART_TYPES)}\n"
-        "Your response MUST be a single, valid JSON object with two keys: 'type' and 'justification'. "
-        "Do not add any other text, explanation, or markdown formatting outside of the JSON object."
-        "Do not refer to the user or their specific query. Frame it as a general best practice."
+    global _fingerprint_memo
+    tables, schemas = get_cached_tables_metadata(), get_cached_all_table_schemas()
+    revision = rollup_manager.revision()
+    memo = _fingerprint_memo
+    if not (memo[0] is tables and memo[1] is schemas and memo[2] == revision):
+        payload = json.dumps([tables, schemas, revision], sort_keys=True).encode()
+        memo = _fingerprint_memo = (tables, schemas, revision, hashlib.sha256(payload).hexdigest()[:16])
+    return memo[3]
 
+def warm_up_catalog():
+    """Loads the table list and schemas into the catalog cache ahead of the first request."""
+    get_cached_tables_metadata()
+    get_cached_all_table_schemas()
+
+def start_catalog_refresh():
+    """Keeps the catalog cache warm in the background so requests skip information_schema."""
+    catalog_cache.start_background_refresh(get_all_tables_metadata, get_table_schema, get_all_table_schemas)
+
+def stop_catalog_refresh():
+    catalog_cache.stop_background_refresh()
+
+# --- LLM-Powered Functions ---
+
+def _generate_content(prompt: Prompt, step: str, config=None):
+    """Sends a prompt to Gemini, recording latency and token usage under `step`."""
+    client = get_client()
+    contents, config = context_cache.prepare(client, MODEL, prompt, config)
+    with timed(step):
+        response = client.models.generate_content(model=MODEL, contents=contents, config=config)
+    record_llm_usage(step, response)
+    return response
+
+
+def _build_visualization_prompt(user_query: str, schema: list, table_name: str = None) -> Prompt:
+    """Builds the chart-selection prompt for a user query and table schema."""
+    return visualization_template().render(
+        user_query=user_query, columns=schema_blocks.columns(table_name, schema)
     )
-    
-    final_prompt = (
-        f"{llm_instruction}\n\n"
-        f"User Query: \"{user_query}\"\n\n"
-        f"Available Columns:\n{schema_str}"
-    )
-    
-    response = client.models.generate_content(
-        model="gemini-2.5-flash",
-        contents=final_prompt
-    )
-    
+
+
+def _parse_visualization_response(response) -> dict:
+    """Parses the LLM's chart-selection response into a dictionary."""
     try:
         # Clean up potential markdown formatting from the LLM response
         cleaned_response = response.text.strip().replace("```json", "").replace("```", "").strip()
-        return json.loads(cleaned_response)
+        viz_info = json.loads(cleaned_response)
     except (json.JSONDecodeError, AttributeError) as e:
         print(f"Error decoding JSON from LLM for visualization choice: {e}")
         raise ValueError("LLM failed to return a valid JSON for visualization type.")
+    if not isinstance(viz_info, dict) or viz_info.get("type") not in chart_type_names():
+        raise ValueError(f"LLM chose an unsupported chart type: {cleaned_response}")
+    return viz_info
+
+
+def choose_visualization(user_query: str, schema: list, table_name: str = None) -> dict:
+    """
+    Uses an LLM to choose the best visualization type based on the user query and table schema.
+    
+    Returns:
+        A dictionary like {"type": "scatter", "justification": "..."}
+    """
+    response = _generate_content(_build_visualization_prompt(user_query, schema, table_name), "chart_choice")
+    return _parse_visualization_response(response)
+
+
+def _build_insights_prompt(user_query: str, viz_info: dict, data_sample: list) -> Prompt:
+    """Builds the insights prompt from the query, chosen chart and a data sample."""
+    return INSIGHTS.render(
+        user_query=user_query,
+        chart_type=viz_info['type'],
+        justification=viz_info['justification'],
+        sample_rows=len(data_sample),
+        # Convert the data sample to a more readable string format for the prompt
+        data=json.dumps(data_sample, indent=2, default=str),
+    )
 
 
 def generate_data_insights(user_query: str, viz_info: dict, data_sample: list) -> str:
@@ -98,146 +260,638 @@ def generate_data_insights(user_query: str, viz_info: dict, data_sample: list) -
     Uses an LLM to generate a brief insight about the data based on the results.
     """
     if not data_sample:
-        return "No data was returned from the query, so no insights could be generated."
+        return NO_DATA_INSIGHT
 
-    # Convert the data sample to a more readable string format for the prompt
-    data_str = json.dumps(data_sample, indent=2)
+    response = _generate_content(_build_insights_prompt(user_query, viz_info, data_sample), "insights")
+
+    return response.text.strip()
 
-    llm_instruction = (
-        "You are a helpful data analyst. Your task is to provide a brief, human-readable insight based on a user's query, the chosen visualization, and a sample of the resulting data. "
-        "The insight should be a short observation about patterns, trends, or notable points in the data. "
-        "Focus on what the data reveals in the context of the user's question. "
-        "Your response should be a single, concise string of one or two sentences. Do not add any other text or explanation."
-    )
 
-    final_prompt = (
-        f"{llm_instruction}\n\n"
-        f"--- CONTEXT ---\n"
-        f"Original User Query: \"{user_query}\"\n"
-        f"Chosen Visualization: {viz_info['type']}\n"
-        f"Justification for Chart: {viz_info['justification']}\n"
-        f"--- DATA SAMPLE (first {len(data_sample)} rows) ---\n"
-        f"{data_str}\n"
-        f"--- END CONTEXT ---\n\n"
-        f"Insight:"
+def _build_sql_prompt(user_query: str, schema: list, viz_info: dict, table_name: str) -> Prompt:
+    """Builds the SQL-generation prompt for the selected table and chart, listing its rollups if any."""
+    rollups = rollup_manager.describe(table_name)
+    chart = get_chart_type(viz_info['type'])
+    return SQL_GENERATION.render(
+        user_query=user_query,
+        table=qualified_name(DB_CATALOG, DB_SCHEMA, table_name),
+        chart_type=viz_info['type'],
+        justification=viz_info['justification'],
+        data_shape=chart.data_shape if chart else "any",
+        columns=schema_blocks.columns(table_name, schema),
+        rollups=f"{rollups}\n" if rollups else "",
     )
 
-    response = client.models.generate_content(
-        model="gemini-2.5-flash",
-        contents=final_prompt
+
+def _clean_sql(text: str) -> str:
+    """Strips markdown fences the LLM may wrap around a SQL query."""
+    return text.strip().replace("```sql", "").replace("```", "").strip()
+
+
+def _execute_sql(generated_sql: str, connection=None, on_cursor=None):
+    """
+    Executes a generated SQL query and returns the result as a pyarrow Table.
+    Results stay columnar end-to-end and are never expanded into per-row dicts here.
+    `on_cursor` receives the open cursor so another thread can cancel the query.
+    """
+    print(f"Executing Generated SQL:\n{generated_sql}") # For debugging
+    
+    with _borrow_connection(connection) as connection, connection.cursor() as cursor:
+        if on_cursor is not None:
+            on_cursor(cursor)
+        with timed("warehouse"):
+            cursor.execute(generated_sql)
+            table = cursor.fetchall_arrow()
+    record_result(table)
+    return table
+
+
+def _explain_sql(generated_sql: str, connection=None) -> str:
+    """Returns the warehouse's `EXPLAIN COST` plan for a query without running it."""
+    with timed("explain"), _borrow_connection(connection) as connection, connection.cursor() as cursor:
+        cursor.execute(f"EXPLAIN COST {generated_sql}")
+        return "\n".join(str(row[0]) for row in cursor.fetchall())
+
+
+def _sql_guard_key(user_query: str, table_name: str, schema: list, viz_info: dict) -> str:
+    # The chart type shapes the SQL, so it is part of the question; the SQL may also target a rollup.
+    return sql_guard.cache_key(
+        table_name, schema,
+        f"{normalize_query(user_query)}|{viz_info['type']}|{rollup_manager.revision(table_name)}",
     )
 
-    return response.text.strip()
+
+def _check_sql(user_query: str, table_name: str, schema: list, viz_info: dict, generated_sql: str, connection=None):
+    """
+    Rejects non-read-only or over-budget SQL before it reaches the warehouse (see sql_guard.py).
+    """
+    with timed("sql_validation"):
+        sql_guard.check(
+            generated_sql, _sql_guard_key(user_query, table_name, schema, viz_info),
+            lambda sql: _explain_sql(sql, connection),
+        )
 
 
-def generate_and_execute_sql(user_query: str, schema: list, viz_info: dict, table_name: str, connection) -> list:
+def _execute_governed_sql(generated_sql: str, chart_type: str):
     """
-    Uses an LLM to generate a Databricks SQL query and then executes it.
+    Executes SQL under the chart type's row budget: an outer LIMIT is applied in the
+    warehouse and line/scatter results are downsampled locally.
+    Returns (table, data_reduction) where data_reduction describes any truncation.
+    """
+    governed_sql, fetch_limit = govern_sql(generated_sql, chart_type)
+    return reduce_result(_execute_sql(governed_sql), chart_type, fetch_limit)
+
+
+def _data_sample(table) -> list:
+    """First few rows of a result, as dicts, for the insights prompt."""
+    return to_rows(table.slice(0, INSIGHT_SAMPLE_ROWS))
+
+
+def generate_sql(user_query: str, schema: list, viz_info: dict, table_name: str) -> str:
+    """
+    Uses an LLM to generate a Databricks SQL query for the chosen table and chart.
     The LLM is instructed to create new columns on-the-fly using CTEs if needed.
+    """
+    response = _generate_content(_build_sql_prompt(user_query, schema, viz_info, table_name), "sql_generation")
+    return _clean_sql(response.text)
+
+
+def generate_and_execute_sql(user_query: str, schema: list, viz_info: dict, table_name: str, connection=None) -> list:
+    """
+    Uses an LLM to generate a Databricks SQL query and then executes it.
     
     Returns:
         A list of dictionaries representing the query results.
     """
-    schema_str = "\n".join([f"- {col['column_name']} ({col['data_type']})" for col in schema])
-    
-    llm_instruction = (
-        "You are a Databricks SQL expert. Your goal is to write a SINGLE SQL query to fetch data that can be used to create a specified visualization. "
-        "The query should be tailored to the user's request.\n"
-        "IMPORTANT RULES:\n"
-        "1. If a necessary column doesn't exist but can be derived from existing columns (e.g., extracting a year from a date, creating a price category), "
-        "you MUST generate it on-the-fly using a Common Table Expression (CTE) with a `WITH` clause.\n"
-        "2. DO NOT use `CREATE TABLE` or any other DDL statements. The query must only read data.\n"
-        "3. Your response must be ONLY the raw SQL query. Do not include any explanations, comments, or markdown formatting like ```sql."
-    )
-    
-    final_prompt = (
-        f"{llm_instruction}\n\n"
-        f"--- CONTEXT ---\n"
-        f"User Query: \"{user_query}\"\n"
-        f"Table to Query: `{DB_CATALOG}`.`{DB_SCHEMA}`.`{table_name}`\n"
-        f"Chosen Visualization: {viz_info['type']} (Justification: {viz_info['justification']})\n"
-        f"Available Columns:\n{schema_str}\n"
-        f"--- END CONTEXT ---\n\n"
-        f"SQL Query:"
-    )
-
-    response = client.models.generate_content(
-        model="gemini-2.5-flash",
-        contents=final_prompt
-    )
-    
-    generated_sql = response.text.strip().replace("```sql", "").replace("```", "")
-    
-    print(f"Executing Generated SQL:\n{generated_sql}") # For debugging
-    
-    with connection.cursor() as cursor:
-        cursor.execute(generated_sql)
-        rows = cursor.fetchall()
-        columns = [desc[0] for desc in cursor.description]
-        results = [dict(zip(columns, row)) for row in rows]
-    
-    return results
+    generated_sql = generate_sql(user_query, schema, viz_info, table_name)
+    _check_sql(user_query, table_name, schema, viz_info, generated_sql, connection)
+    rollup_manager.record(table_name, schema, generated_sql)
+    return to_rows(_execute_sql(generated_sql, connection))
 
 # --- Core Orchestration Logic ---
 
-def _select_table_and_get_schema(user_query: str, connection) -> tuple[list, str]:
+def _shortlist_tables(user_query: str, table_metadata: list) -> tuple[list, dict, str]:
+    """
+    Ranks tables against the query with the local BM25 index.
+    Returns (candidate metadata, all schemas, confidently matched table name or None).
+    With no lexical match at all, every table stays a candidate.
+    """
+    schemas = get_cached_all_table_schemas()
+    table_index.sync(table_metadata, schemas)
+    ranked = table_index.search(user_query, TABLE_INDEX_TOP_K)
+    if not ranked:
+        return table_metadata, schemas, None
+
+    confident = None
+    # A lone hit is not confident by itself: one weak term match must still go to the LLM.
+    if (TABLE_INDEX_SKIP_RATIO
+            and (len(ranked) == 1 or ranked[0][1] >= TABLE_INDEX_SKIP_RATIO * ranked[1][1])
+            and table_index.matched_terms(user_query, ranked[0][0]) >= TABLE_INDEX_MIN_TERMS):
+        confident = ranked[0][0]
+
+    if len(table_metadata) <= TABLE_INDEX_TOP_K:
+        return table_metadata, schemas, confident
+    by_name = {meta['table_name']: meta for meta in table_metadata}
+    return [by_name[name] for name, _ in ranked], schemas, confident
+
+
+def _build_table_selection_prompt(user_query: str, table_metadata: list, schemas: dict = None) -> Prompt:
+    """Builds the table-selection prompt from table metadata, plus columns when schemas are given."""
+    table_context_list = []
+    for meta in table_metadata:
+        context = f"Table Name: {meta['table_name']}\nDescription: {meta['description']}"
+        if schemas:
+            context += f"\nColumns: {schema_blocks.names(meta['table_name'], schemas.get(meta['table_name'], []))}"
+        table_context_list.append(context)
+    return TABLE_SELECTION.render(user_query=user_query, table_info="\n---\n".join(table_context_list))
+
+
+def _select_table_and_get_schema(user_query: str, connection=None) -> tuple[list, str]:
     """
     First step: Gathers metadata, calls LLM to select a table, and gets its schema.
     Returns a tuple of (schema, selected_table_name).
     """
-    table_metadata = get_all_tables_metadata(connection)
+    table_metadata = get_all_tables_metadata(connection) if connection else get_cached_tables_metadata()
     if not table_metadata:
         raise ValueError(f"No tables found in {DB_CATALOG}.{DB_SCHEMA}.")
 
-    table_context_list = [
-        f"Table Name: {meta['table_name']}\nDescription: {meta['description']}"
-        for meta in table_metadata
-    ]
-    table_info = "\n---\n".join(table_context_list)
-    
-    llm_instruction = (
-        "The user will inquire and ask to visualize some type of data. "
-        "You will be given a list of table names along with their description. "
-        "You are supposed to pick the most relevant table, and strictly return only the name. "
-        "DO NOT return anything but the name of the most relevant table."
+    candidates, schemas, selected_table = (
+        (table_metadata, None, None) if connection else _shortlist_tables(user_query, table_metadata)
     )
-    final_prompt = f"{llm_instruction}\n\nuser query: {user_query}\n\ntable(s):\n{table_info}"
-    
-    response = client.models.generate_content(model="gemini-2.5-flash", contents=final_prompt)
-    selected_table = response.text.strip()
+    if selected_table is not None:
+        print(f"Table index matched '{selected_table}'; skipping the table-selection LLM call.")
+    else:
+        final_prompt = _build_table_selection_prompt(user_query, candidates, schemas)
+        
+        response = _generate_content(final_prompt, "table_selection")
+        selected_table = response.text.strip()
     
-    schema_data = get_table_schema(selected_table, connection)
+    schema_data = get_table_schema(selected_table, connection) if connection else get_cached_table_schema(selected_table)
     if not schema_data:
         raise LookupError(f"Table '{selected_table}' was selected by LLM but not found.")
 
     return schema_data, selected_table
 
 
-def generate_visualization_from_query(user_query: str) -> dict:
+# --- Single-Shot Planner ---
+
+class VisualizationPlan(BaseModel):
+    """Structured output of the single-shot planner."""
+    table_name: str
+    type: str
+    justification: str
+    sql: str
+
+
+def warm_up_llm():
+    """Imports the Gemini SDK and the SQL parser, and creates the client ahead of the first request."""
+    get_client()
+    _planner_config()
+    ensure_read_only("SELECT 1")
+
+
+@lru_cache(maxsize=1)
+def _planner_config():
+    from google.genai import types
+    return types.GenerateContentConfig(
+        response_mime_type="application/json",
+        response_schema=VisualizationPlan,
+    )
+
+
+def _build_planner_prompt(user_query: str, table_metadata: list, schemas: dict) -> Prompt:
+    """Builds one prompt that asks for the table, chart type, justification and SQL together."""
+    table_context_list = []
+    for meta in table_metadata:
+        columns = schema_blocks.columns(meta['table_name'], schemas.get(meta['table_name'], []))
+        context = f"Table Name: {meta['table_name']}\nDescription: {meta['description']}\nColumns:\n{columns}"
+        if rollups := rollup_manager.describe(meta['table_name']):
+            context += f"\n{rollups}"
+        table_context_list.append(context)
+    return planner_template(DB_CATALOG, DB_SCHEMA).render(
+        user_query=user_query, table_info="\n---\n".join(table_context_list)
+    )
+
+
+def _parse_plan_response(response, schemas: dict) -> dict:
+    """Validates the planner's JSON against the schema, the catalog and the chart types."""
+    try:
+        plan = VisualizationPlan.model_validate_json(response.text)
+    except (ValidationError, AttributeError, TypeError) as e:
+        raise ValueError(f"Planner returned an invalid plan: {e}")
+
+    if plan.table_name not in schemas:
+        raise LookupError(f"Planner selected unknown table '{plan.table_name}'.")
+    if plan.type not in chart_type_names():
+        raise ValueError(f"Planner selected unsupported chart type '{plan.type}'.")
+    sql = _clean_sql(plan.sql)
+    if not sql:
+        raise ValueError("Planner returned an empty SQL query.")
+
+    return {
+        "table_name": plan.table_name,
+        "schema": schemas[plan.table_name],
+        "viz_info": {"type": plan.type, "justification": plan.justification},
+        "sql": sql,
+    }
+
+
+def _load_planner_catalog(user_query: str) -> tuple[list, dict]:
+    """Returns the shortlisted tables and all schemas for the planner prompt."""
+    table_metadata = get_cached_tables_metadata()
+    if not table_metadata:
+        raise ValueError(f"No tables found in {DB_CATALOG}.{DB_SCHEMA}.")
+    candidates, schemas, _ = _shortlist_tables(user_query, table_metadata)
+    return candidates, schemas
+
+
+def _resolve_planner(planner: str = None) -> str:
+    planner = planner or PLANNER_MODE
+    if planner not in PLANNER_MODES:
+        raise ValueError(f"Unknown planner '{planner}'. Expected one of: {', '.join(PLANNER_MODES)}.")
+    return planner
+
+
+def plan_single_shot(user_query: str) -> dict:
+    """Selects the table, chart type and SQL with a single structured LLM call."""
+    table_metadata, schemas = _load_planner_catalog(user_query)
+    response = _generate_content(
+        _build_planner_prompt(user_query, table_metadata, schemas), "single_shot_plan", config=_planner_config()
+    )
+    plan = _parse_plan_response(response, schemas)
+    _check_sql(user_query, plan["table_name"], plan["schema"], plan["viz_info"], plan["sql"])
+    return plan
+
+
+def plan_multi_step(user_query: str) -> dict:
+    """Selects the table, chart type and SQL with three sequential LLM calls."""
+    schema, table_name = _select_table_and_get_schema(user_query)
+    viz_info = choose_visualization(user_query, schema, table_name)
+    generated_sql = sql_guard.validated_sql(_sql_guard_key(user_query, table_name, schema, viz_info))
+    if generated_sql is None:
+        generated_sql = generate_sql(user_query, schema, viz_info, table_name)
+        _check_sql(user_query, table_name, schema, viz_info, generated_sql)
+    return {"table_name": table_name, "schema": schema, "viz_info": viz_info, "sql": generated_sql}
+
+
+def _get_cached_plan(user_query: str, fingerprint: str):
+    if response_cache is None:
+        return None
+    plan, hit = response_cache.get_plan(user_query, fingerprint)
+    record_cache("plan", hit)
+    if plan is not None:
+        print(f"Response cache: {hit} plan hit for query '{user_query}'")
+    return plan
+
+
+def _put_cached_plan(user_query: str, fingerprint: str, plan: dict):
+    if response_cache is not None:
+        response_cache.put_plan(user_query, fingerprint, plan)
+
+
+def _result_key(fingerprint: str, plan: dict):
+    """The catalog fingerprint plus the data version of the planned table, for cached results."""
+    if response_cache is None:
+        return None
+    return f"{fingerprint}:{plan['table_name'].lower()}@{catalog_cache.data_version(plan['table_name'])}"
+
+
+def _get_cached_result(result_key: str, sql: str):
+    if response_cache is None:
+        return None
+    cached = response_cache.get_result(result_key, sql)
+    record_cache("result", "miss" if cached is None else "hit")
+    return cached
+
+
+def _put_cached_result(result_key: str, sql: str, data, insights: str, data_reduction: dict):
+    if response_cache is not None:
+        response_cache.put_result(
+            result_key, sql, data, {"insights": insights, "data_reduction": data_reduction}
+        )
+
+
+def plan_visualization(user_query: str, planner: str = None, fingerprint: str = None) -> dict:
+    """
+    Produces a plan {"table_name", "schema", "viz_info", "sql"} for a user query.
+    The single-shot planner falls back to the multi-step chain if its output is rejected.
+    Both planners pass their SQL through sql_guard, so only validated plans are cached.
+    Plans are served from the response cache when `fingerprint` is given.
+    """
+    planner = _resolve_planner(planner)
+    if fingerprint and (plan := _get_cached_plan(user_query, fingerprint)):
+        return plan
+
+    plan = None
+    if planner == "single_shot":
+        try:
+            plan = plan_single_shot(user_query)
+        except (ValueError, LookupError) as e:
+            print(f"Single-shot planner failed, falling back to multi-step chain: {e}")
+    plan = plan or plan_multi_step(user_query)
+
+    if fingerprint:
+        _put_cached_plan(user_query, fingerprint, plan)
+    return plan
+
+
+def generate_visualization_from_query(user_query: str, planner: str = None) -> dict:
     """
     Executes the full Text-to-Visualization chain, now including data insights.
+    The "data" entry is a pyarrow Table; callers pick the wire format (see serialization.py).
+    Concurrent calls for the same query and planner share one run.
     """
-    # Use a single connection for the entire process for efficiency
-    with databricks.sql.connect(server_hostname=DB_HOST, http_path=DB_PATH, access_token=DB_TOKEN) as connection:
-        
-        # 1. Select the relevant table and get its schema
-        schema, table_name = _select_table_and_get_schema(user_query, connection)
-        
-        # 2. Choose the best visualization type
-        viz_info = choose_visualization(user_query, schema)
-        
-        # 3. Generate and execute the SQL to get the data
-        data = generate_and_execute_sql(user_query, schema, viz_info, table_name, connection)
+    key = (normalize_query(user_query), _resolve_planner(planner))
+    result, shared = _visualization_thread_flights.run(
+        key, lambda: _generate_visualization_from_query(user_query, planner)
+    )
+    if shared:
+        record_coalesced("visualization")
+    return {**result, "visualization": dict(result["visualization"])}
+
+
+def _generate_visualization_from_query(user_query: str, planner: str = None) -> dict:
+    # Each database step borrows a pooled connection only for as long as it runs,
+    # so no session is held idle while waiting on the LLM.
+    fingerprint = catalog_fingerprint() if response_cache is not None else None
 
-        # 4. NEW: Generate insights based on the returned data
-        # Use a sample of the data (e.g., first 10 rows) to keep the prompt concise
-        insights_text = generate_data_insights(user_query, viz_info, data[:10])
-        viz_info['insights'] = insights_text
+    # 1-2. Select the table, choose the chart type and write the SQL
+    plan = plan_visualization(user_query, planner, fingerprint)
+    viz_info = dict(plan["viz_info"])
+
+    # Read before executing, so rows loaded during the query are not cached as newer data.
+    result_key = _result_key(fingerprint, plan)
+    cached = _get_cached_result(result_key, plan["sql"])
+    if cached is not None:
+        data, metadata = cached
+        viz_info['insights'] = metadata["insights"]
+        return {"visualization": viz_info, "data": data, "data_reduction": metadata["data_reduction"]}
+    
+    # 3. Execute the SQL to get the data, within the chart type's row budget.
+    # Every execution counts towards rollups, including SQL reused from the plan or guard caches.
+    rollup_manager.record(plan["table_name"], plan["schema"], plan["sql"])
+    (data, data_reduction), shared = _sql_thread_flights.run(
+        (plan["sql"], viz_info["type"]), lambda: _execute_governed_sql(plan["sql"], viz_info["type"])
+    )
+    if shared:
+        record_coalesced("sql")
+
+    # 4. NEW: Generate insights based on the returned data
+    # Use a sample of the data (e.g., first 10 rows) to keep the prompt concise
+    insights_text = generate_data_insights(user_query, viz_info, _data_sample(data))
+    viz_info['insights'] = insights_text
+    _put_cached_result(result_key, plan["sql"], data, insights_text, data_reduction)
 
     # 5. Assemble the final response object
     final_output = {
         "visualization": viz_info,
-        "data": data
+        "data": data,
+        "data_reduction": data_reduction
     }
     
-    return final_output
\ No newline at end of file
+    return final_output
+
+# --- Async Pipeline ---
+# The async variants share prompt building and parsing with the sync chain above.
+# Gemini calls go through the SDK's native async client, and the blocking
+# databricks-sql calls (including pool checkout) run on worker threads so the event loop stays free.
+
+async def _generate_content_async(prompt: Prompt, step: str, config=None):
+    """Sends a prompt to Gemini without blocking the event loop; see `_generate_content`."""
+    client = get_client()
+    contents, config = await context_cache.prepare_async(client, MODEL, prompt, config)
+    with timed(step):
+        response = await client.aio.models.generate_content(model=MODEL, contents=contents, config=config)
+    record_llm_usage(step, response)
+    return response
+
+
+async def choose_visualization_async(user_query: str, schema: list, table_name: str = None) -> dict:
+    """Async version of `choose_visualization`."""
+    response = await _generate_content_async(_build_visualization_prompt(user_query, schema, table_name), "chart_choice")
+    return _parse_visualization_response(response)
+
+
+async def generate_data_insights_async(user_query: str, viz_info: dict, data_sample: list) -> str:
+    """Async version of `generate_data_insights`."""
+    if not data_sample:
+        return NO_DATA_INSIGHT
+
+    response = await _generate_content_async(_build_insights_prompt(user_query, viz_info, data_sample), "insights")
+    return response.text.strip()
+
+
+async def generate_sql_async(user_query: str, schema: list, viz_info: dict, table_name: str) -> str:
+    """Async version of `generate_sql`."""
+    # The prompt lists rollups, which may be read from the local store (SQLite), so it is built off the loop.
+    prompt = await asyncio.to_thread(_build_sql_prompt, user_query, schema, viz_info, table_name)
+    response = await _generate_content_async(prompt, "sql_generation")
+    return _clean_sql(response.text)
+
+
+async def generate_and_execute_sql_async(user_query: str, schema: list, viz_info: dict, table_name: str, connection=None) -> list:
+    """Async version of `generate_and_execute_sql`."""
+    generated_sql = await generate_sql_async(user_query, schema, viz_info, table_name)
+    await asyncio.to_thread(_check_sql, user_query, table_name, schema, viz_info, generated_sql, connection)
+    await asyncio.to_thread(rollup_manager.record, table_name, schema, generated_sql)
+    return to_rows(await asyncio.to_thread(_execute_sql, generated_sql, connection))
+
+
+async def _execute_governed_sql_async(generated_sql: str, chart_type: str):
+    """
+    Async version of `_execute_governed_sql`. If the awaiting task is cancelled (stage
+    timeout, latency budget, client gone), the running statement is cancelled in the
+    warehouse too instead of being left to finish on its worker thread.
+    """
+    governed_sql, fetch_limit = govern_sql(generated_sql, chart_type)
+    cursors = []
+    try:
+        table = await asyncio.to_thread(_execute_sql, governed_sql, None, cursors.append)
+    except asyncio.CancelledError:
+        for cursor in cursors:
+            try:
+                cursor.cancel()
+            except Exception as e:
+                print(f"Could not cancel warehouse query: {e}")
+        raise
+    return await asyncio.to_thread(reduce_result, table, chart_type, fetch_limit)
+
+
+async def _select_table_and_get_schema_async(user_query: str, connection=None) -> tuple[list, str]:
+    """Async version of `_select_table_and_get_schema`."""
+    if connection:
+        table_metadata = await asyncio.to_thread(get_all_tables_metadata, connection)
+    else:
+        table_metadata = await asyncio.to_thread(get_cached_tables_metadata)
+    if not table_metadata:
+        raise ValueError(f"No tables found in {DB_CATALOG}.{DB_SCHEMA}.")
+
+    if connection:
+        candidates, schemas, selected_table = table_metadata, None, None
+    else:
+        candidates, schemas, selected_table = await asyncio.to_thread(_shortlist_tables, user_query, table_metadata)
+    if selected_table is not None:
+        print(f"Table index matched '{selected_table}'; skipping the table-selection LLM call.")
+    else:
+        response = await _generate_content_async(
+            _build_table_selection_prompt(user_query, candidates, schemas), "table_selection"
+        )
+        selected_table = response.text.strip()
+
+    if connection:
+        schema_data = await asyncio.to_thread(get_table_schema, selected_table, connection)
+    else:
+        schema_data = await asyncio.to_thread(get_cached_table_schema, selected_table)
+    if not schema_data:
+        raise LookupError(f"Table '{selected_table}' was selected by LLM but not found.")
+
+    return schema_data, selected_table
+
+
+async def plan_single_shot_async(user_query: str) -> dict:
+    """Async version of `plan_single_shot`."""
+    table_metadata, schemas = await asyncio.to_thread(_load_planner_catalog, user_query)
+    prompt = await asyncio.to_thread(_build_planner_prompt, user_query, table_metadata, schemas)
+    response = await _generate_content_async(prompt, "single_shot_plan", config=_planner_config())
+    plan = _parse_plan_response(response, schemas)
+    await asyncio.to_thread(_check_sql, user_query, plan["table_name"], plan["schema"], plan["viz_info"], plan["sql"])
+    return plan
+
+
+async def plan_multi_step_async(user_query: str) -> dict:
+    """Async version of `plan_multi_step`."""
+    schema, table_name = await _select_table_and_get_schema_async(user_query)
+    viz_info = await choose_visualization_async(user_query, schema, table_name)
+    key = await asyncio.to_thread(_sql_guard_key, user_query, table_name, schema, viz_info)
+    generated_sql = sql_guard.validated_sql(key)
+    if generated_sql is None:
+        generated_sql = await generate_sql_async(user_query, schema, viz_info, table_name)
+        await asyncio.to_thread(_check_sql, user_query, table_name, schema, viz_info, generated_sql)
+    return {"table_name": table_name, "schema": schema, "viz_info": viz_info, "sql": generated_sql}
+
+
+async def plan_visualization_async(user_query: str, planner: str = None, fingerprint: str = None) -> dict:
+    """Async version of `plan_visualization`."""
+    planner = _resolve_planner(planner)
+    if fingerprint and (plan := await asyncio.to_thread(_get_cached_plan, user_query, fingerprint)):
+        return plan
+
+    plan = None
+    if planner == "single_shot":
+        try:
+            plan = await plan_single_shot_async(user_query)
+        except (ValueError, LookupError) as e:
+            print(f"Single-shot planner failed, falling back to multi-step chain: {e}")
+    plan = plan or await plan_multi_step_async(user_query)
+
+    if fingerprint:
+        await asyncio.to_thread(_put_cached_plan, user_query, fingerprint, plan)
+    return plan
+
+
+async def _coalesce(flights: SingleFlight, stage: str, key, fn):
+    """Runs `fn()` through a single-flight group and counts calls that joined another's run."""
+    result, shared = await flights.run(key, fn)
+    if shared:
+        record_coalesced(stage)
+    return result
+
+
+def _build_request_pipeline(user_query: str, planner: str = None) -> Pipeline:
+    """
+    Lays out one request as a DAG. The table list and all schemas are loaded concurrently
+    (two warehouse queries on a cold catalog cache); everything after that depends on
+    the plan. Stage results are the events of `stream_visualization_from_query_async`.
+    """
+    async def tables():
+        return await asyncio.to_thread(get_cached_tables_metadata)
+
+    async def schemas():
+        return await asyncio.to_thread(get_cached_all_table_schemas)
+
+    async def fingerprint(tables, schemas):
+        return await asyncio.to_thread(catalog_fingerprint) if response_cache is not None else None
+
+    async def plan(fingerprint):
+        key = (normalize_query(user_query), _resolve_planner(planner), fingerprint)
+        return await _coalesce(
+            _plan_flights, "plan", key, lambda: plan_visualization_async(user_query, planner, fingerprint)
+        )
+
+    async def result_key(plan, fingerprint):
+        return await asyncio.to_thread(_result_key, fingerprint, plan)
+
+    async def cached(plan, result_key):
+        return await asyncio.to_thread(_get_cached_result, result_key, plan["sql"])
+
+    async def data(plan, cached):
+        if cached is not None:
+            return cached[0], cached[1]["data_reduction"]
+        chart_type = plan["viz_info"]["type"]
+        # Every execution counts towards rollups, including SQL reused from the plan or guard caches.
+        await asyncio.to_thread(rollup_manager.record, plan["table_name"], plan["schema"], plan["sql"])
+        return await _coalesce(
+            _sql_flights, "sql", (plan["sql"], chart_type),
+            lambda: _execute_governed_sql_async(plan["sql"], chart_type),
+        )
+
+    async def insights(plan, result_key, cached, data):
+        if cached is not None:
+            return cached[1]["insights"]
+        table, data_reduction = data
+
+        async def compute():
+            insights_text = await generate_data_insights_async(user_query, plan["viz_info"], _data_sample(table))
+            await asyncio.to_thread(_put_cached_result, result_key, plan["sql"], table, insights_text, data_reduction)
+            return insights_text
+
+        key = (normalize_query(user_query), plan["sql"], plan["viz_info"]["type"])
+        return await _coalesce(_insights_flights, "insights", key, compute)
+
+    return (
+        Pipeline(Deadline(REQUEST_LATENCY_BUDGET))
+        .stage("tables", tables, timeout=STAGE_TIMEOUTS["catalog"])
+        .stage("schemas", schemas, timeout=STAGE_TIMEOUTS["catalog"])
+        .stage("fingerprint", fingerprint, after=("tables", "schemas"), timeout=STAGE_TIMEOUTS["catalog"])
+        .stage("plan", plan, after=("fingerprint",), timeout=STAGE_TIMEOUTS["plan"])
+        .stage("result_key", result_key, after=("plan", "fingerprint"), timeout=STAGE_TIMEOUTS["catalog"])
+        .stage("cached", cached, after=("plan", "result_key"), timeout=STAGE_TIMEOUTS["catalog"])
+        .stage("data", data, after=("plan", "cached"), timeout=STAGE_TIMEOUTS["data"])
+        .stage("insights", insights, after=("plan", "result_key", "cached", "data"), timeout=STAGE_TIMEOUTS["insights"])
+    )
+
+
+async def stream_visualization_from_query_async(user_query: str, planner: str = None):
+    """
+    Runs the chain and yields (event, payload) pairs as soon as each part is available:
+    ("visualization", viz_info), ("data_reduction", dict), ("data", pyarrow Table),
+    then ("insights", text).
+    Clients can render the chart before the insights LLM call has finished.
+    Raises a TimeoutError subclass when a stage or the request's latency budget runs out.
+    """
+    async for stage, result in _build_request_pipeline(user_query, planner).run_iter():
+        if stage == "plan":
+            yield "visualization", dict(result["viz_info"])
+        elif stage == "data":
+            table, data_reduction = result
+            yield "data_reduction", data_reduction
+            yield "data", table
+        elif stage == "insights":
+            yield "insights", result
+
+
+async def generate_visualization_from_query_async(user_query: str, planner: str = None) -> dict:
+    """
+    Async version of `generate_visualization_from_query`.
+    Wall-clock latency is bound by the LLM and warehouse, not by threadpool queueing.
+    """
+    parts = {}
+    async for event, payload in stream_visualization_from_query_async(user_query, planner):
+        parts[event] = payload
+
+    viz_info = parts["visualization"]
+    viz_info['insights'] = parts["insights"]
+    return {
+        "visualization": viz_info,
+        "data": parts["data"],
+        "data_reduction": parts["data_reduction"]
+    }
@@ -1,5 +1,21 @@
 import os
-from databricks.sdk import WorkspaceClient
+import io
+import csv
+import sys
+import json
+import zlib
+import tempfile
+import threading
+from typing import BinaryIO
+from metadata_cache import catalog_cache
+from db_pool import get_pool
+from csv_profiling import csv_to_parquet, describe_column, describe_table
+from incremental_upload import scan_csv
+from sql_guard import qualified_name, quote_identifier, quote_string
+from metrics import timed, UPLOAD_BYTES
+from job_tracker import create_job_tracker_from_env
+from rollups import rollup_manager
+from local_store import local_store
 # --- Databricks Configuration ---
 DATABRICKS_HOST = os.getenv("DB_SERVER_HOSTNAME")
 DATABRICKS_TOKEN = os.getenv("DB_ACCESS_TOKEN")
@@ -7,7 +23,178 @@ DATABRICKS_CATALOG = os.getenv("DB_CATALOG", "workspace")
 DATABRICKS_SCHEMA = os.getenv("DB_SCHEMA", "dev")
 DATABRICKS_VOLUME = os.getenv("DB_VOLUME", "files")
 
-w = WorkspaceClient(host=DATABRICKS_HOST, token=DATABRICKS_TOKEN)
+# --- Upload Limits ---
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(5 * 1024 ** 3)))
+# Compress CSVs on the wire; the ingestion job must accept the "compression" parameter.
+UPLOAD_GZIP = os.getenv("UPLOAD_GZIP", "false").lower() == "true"
+# Multipart settings; worst-case upload buffering is about part_size * parallelism per file.
+UPLOAD_PART_SIZE = int(os.getenv("UPLOAD_PART_SIZE", str(16 * 1024 ** 2)))
+UPLOAD_PARALLELISM = int(os.getenv("UPLOAD_PARALLELISM", "2"))
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# "csv" uploads the file as-is; "parquet" profiles it and uploads typed, compressed Parquet.
+UPLOAD_FORMAT = os.getenv("UPLOAD_FORMAT", "csv")
+
+# Job that turns uploaded files into tables; its "file_name" parameter may list several files.
+CSV_TO_TABLE_JOB_ID = int(os.getenv("CSV_TO_TABLE_JOB_ID", "148324980352233"))
+
+_workspace_client = None
+_workspace_client_lock = threading.Lock()
+
+
+def get_workspace_client():
+    """
+    Returns the shared databricks.sdk WorkspaceClient, creating it on first use rather than
+    at import. The SDK itself is imported here too: it accounts for most of the API's import time.
+    """
+    global _workspace_client
+    with _workspace_client_lock:
+        if _workspace_client is None:
+            from databricks.sdk import WorkspaceClient
+            _workspace_client = WorkspaceClient(host=DATABRICKS_HOST, token=DATABRICKS_TOKEN)
+        return _workspace_client
+
+
+def set_workspace_client(client):
+    """Replaces the workspace client, e.g. with the stand-in used by bench/."""
+    global _workspace_client
+    with _workspace_client_lock:
+        _workspace_client = client
+
+
+class UploadTooLargeError(ValueError):
+    """Raised when an upload exceeds UPLOAD_MAX_BYTES."""
+
+
+class _LimitedReader(io.RawIOBase):
+    """Read-through wrapper that fails once more than `max_bytes` have been read."""
+
+    def __init__(self, source: BinaryIO, max_bytes: int):
+        self._source = source
+        self._max_bytes = max_bytes
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self._source.read(len(buffer))
+        self.bytes_read += len(data)
+        if self.bytes_read > self._max_bytes:
+            raise UploadTooLargeError(f"Upload exceeds the {self._max_bytes}-byte limit.")
+        buffer[:len(data)] = data
+        return len(data)
+
+
+class _GzipReader(io.RawIOBase):
+    """Compresses a stream on the fly, holding at most one compressed chunk in memory."""
+
+    def __init__(self, source: BinaryIO, chunk_size: int = UPLOAD_CHUNK_SIZE):
+        self._source = source
+        self._chunk_size = chunk_size
+        self._compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31 -> gzip container
+        self._pending = b""
+        self._eof = False
+        self.bytes_written = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._pending and not self._eof:
+            chunk = self._source.read(self._chunk_size)
+            if chunk:
+                self._pending = self._compressor.compress(chunk)
+            else:
+                self._pending = self._compressor.flush()
+                self._eof = True
+        n = min(len(buffer), len(self._pending))
+        buffer[:n] = self._pending[:n]
+        self._pending = self._pending[n:]
+        self.bytes_written += n
+        return n
+
+
+def _volume_path(databricks_path: str) -> str:
+    return (
+        f"/Volumes/{DATABRICKS_CATALOG}/"
+        f"{DATABRICKS_SCHEMA}/{DATABRICKS_VOLUME}/{databricks_path}"
+    )
+
+
+def upload_csv_stream_to_databricks(
+    source: BinaryIO, databricks_path: str, max_bytes: int = None, compress: bool = None
+) -> str:
+    """
+    Streams a CSV from a file-like object to the Unity Catalog Volume without reading it
+    into memory. Large files go through the SDK's multipart upload, which retries failed
+    parts individually instead of restarting the whole transfer.
+
+    Returns the path written inside the Volume (with a .gz suffix when compressed).
+    """
+    max_bytes = UPLOAD_MAX_BYTES if max_bytes is None else max_bytes
+    compress = UPLOAD_GZIP if compress is None else compress
+
+    limited, gzipped = _LimitedReader(source, max_bytes), None
+    stream = io.BufferedReader(limited, buffer_size=UPLOAD_CHUNK_SIZE)
+    if compress:
+        gzipped = _GzipReader(stream)
+        stream = io.BufferedReader(gzipped, buffer_size=UPLOAD_CHUNK_SIZE)
+        databricks_path = f"{databricks_path}.gz"
+
+    with timed("volume_upload"):
+        get_workspace_client().files.upload(
+            _volume_path(databricks_path),
+            contents=stream,
+            overwrite=True,
+            part_size=UPLOAD_PART_SIZE,
+            use_parallel=UPLOAD_PARALLELISM > 1,
+            parallelism=UPLOAD_PARALLELISM,
+        )
+    UPLOAD_BYTES.labels("csv.gz" if compress else "csv").observe(
+        gzipped.bytes_written if gzipped else limited.bytes_read
+    )
+    return databricks_path
+
+
+def upload_csv_as_parquet_to_databricks(
+    source: BinaryIO, databricks_path: str, max_bytes: int = None
+) -> tuple[str, dict]:
+    """
+    Converts a CSV stream to Parquet in a local temporary file while profiling it, then
+    uploads the Parquet file. Returns (path inside the Volume, column profile).
+    """
+    max_bytes = UPLOAD_MAX_BYTES if max_bytes is None else max_bytes
+    parquet_path = f"{databricks_path.rsplit('.', 1)[0]}.parquet"
+
+    with tempfile.TemporaryFile() as parquet_file:
+        with timed("csv_to_parquet"):
+            profile = csv_to_parquet(_LimitedReader(source, max_bytes), parquet_file)
+        parquet_size = parquet_file.tell()
+        parquet_file.seek(0)
+        with timed("volume_upload"):
+            get_workspace_client().files.upload(
+                _volume_path(parquet_path),
+                contents=parquet_file,
+                overwrite=True,
+                part_size=UPLOAD_PART_SIZE,
+                use_parallel=UPLOAD_PARALLELISM > 1,
+                parallelism=UPLOAD_PARALLELISM,
+            )
+    UPLOAD_BYTES.labels("parquet").observe(parquet_size)
+    return parquet_path, profile
+
+
+def apply_profile_comments(table_name: str, source_name: str, profile: dict):
+    """Stores an upload profile as table and column comments on the created table."""
+    full_name = qualified_name(DATABRICKS_CATALOG, DATABRICKS_SCHEMA, table_name)
+    with timed("profile_comments"), get_pool().connection() as connection, connection.cursor() as cursor:
+        cursor.execute(f"COMMENT ON TABLE {full_name} IS {quote_string(describe_table(source_name, profile))}")
+        for column in profile["columns"]:
+            cursor.execute(
+                f"ALTER TABLE {full_name} ALTER COLUMN {quote_identifier(column['name'])} "
+                f"COMMENT {quote_string(describe_column(column))}"
+            )
+    catalog_cache.invalidate(table_name)
 
 
 def upload_csv_to_databricks(
@@ -17,26 +204,180 @@ def upload_csv_to_databricks(
     Uploads the CSV file content to a Databricks Unity Catalog Volume.
     The databricks_path should be in the format /Volumes/{catalog}/{schema}/{volume}/your_file.csv
     """
-    full_volume_path = (
-        f"/Volumes/{DATABRICKS_CATALOG}/"
-        f"{DATABRICKS_SCHEMA}/{DATABRICKS_VOLUME}/{databricks_path}"
-    )
+    full_volume_path = _volume_path(databricks_path)
 
-    w.files.upload(
+    get_workspace_client().files.upload(
         full_volume_path,
         contents=file_content,
         overwrite=True,
     )
     return True
-    
-def trigger_csv_to_table(filename):
+
+
+# --- Incremental Appends ---
+# Each table loaded from a CSV can have a manifest next to its file in the Volume: the
+# chunk hashes of the last ingested version (see incremental_upload.py). An append upload
+# compares the new version against it, uploads only the new rows and merges them into the
+# table on the SQL warehouse instead of re-running the ingestion job over the whole file.
+
+def _is_not_found(error: Exception) -> bool:
+    if isinstance(error, FileNotFoundError):
+        return True
+    # Checked without importing the SDK: a real client raising NotFound has loaded it already.
+    errors = sys.modules.get("databricks.sdk.errors")
+    return errors is not None and isinstance(error, errors.NotFound)
+
+
+def _manifest_path(table_name: str) -> str:
+    return _volume_path(f"{table_name}.manifest.json")
+
+
+def load_append_manifest(table_name: str):
+    """Returns the table's manifest, or None if there is none (or it cannot be read)."""
+    try:
+        response = get_workspace_client().files.download(_manifest_path(table_name))
+        return json.loads(response.contents.read())
+    except Exception as e:
+        if not _is_not_found(e):
+            print(f"Could not read the append manifest of {table_name}: {e}")
+        return None
+
+
+def save_append_manifest(table_name: str, manifest: dict):
+    get_workspace_client().files.upload(
+        _manifest_path(table_name), contents=io.BytesIO(json.dumps(manifest).encode()), overwrite=True
+    )
+
+
+def delete_append_manifest(table_name: str):
+    """Forgets what was ingested, e.g. before the table is overwritten by a full upload."""
+    try:
+        get_workspace_client().files.delete(_manifest_path(table_name))
+    except Exception as e:
+        if not _is_not_found(e):
+            print(f"Could not delete the append manifest of {table_name}: {e}")
+
+
+def _merge_statement(table_name: str, delta_path: str, columns: list, key_columns: list) -> str:
+    """
+    INSERT (no keys) or MERGE (upsert on the key columns) of an uploaded delta file.
+    Columns are matched by name, so the warehouse casts them to the table's types.
+    """
+    target = qualified_name(DATABRICKS_CATALOG, DATABRICKS_SCHEMA, table_name)
+    names = [quote_identifier(c) for c in columns]
+    source = (
+        f"SELECT {', '.join(names)} FROM read_files({quote_string(_volume_path(delta_path))}, "
+        "format => 'csv', header => true, multiLine => true)"
+    )
+    if not key_columns:
+        return f"INSERT INTO {target} ({', '.join(names)}) {source}"
+    keys = {quote_identifier(k) for k in key_columns}
+    values = [n for n in names if n not in keys]
+    update = f"WHEN MATCHED THEN UPDATE SET {', '.join(f't.{n} = s.{n}' for n in values)} " if values else ""
+    return (
+        f"MERGE INTO {target} AS t USING ({source}) AS s "
+        f"ON {' AND '.join(f't.{k} <=> s.{k}' for k in sorted(keys))} "
+        f"{update}WHEN NOT MATCHED THEN INSERT ({', '.join(names)}) VALUES ({', '.join(f's.{n}' for n in names)})"
+    )
+
+
+def append_csv_to_table(source: BinaryIO, table_name: str, delta_name: str, key_columns: list = ()) -> dict:
+    """
+    Appends only the rows of a re-uploaded CSV that the table does not have yet.
+
+    Without key columns the new rows are inserted, which requires the previously ingested
+    rows to be unchanged. With key columns, rows of changed chunks are upserted by key;
+    rows deleted from the file stay in the table.
+
+    Returns {"mode": "append", "databricks_path", "rows_merged", "rows_total"} when the
+    delta was merged, or {"mode": "overwrite", "reason", "manifest"} when the file has to
+    be loaded in full; the manifest should then be saved once that load has succeeded.
+    """
+    previous = load_append_manifest(table_name)
+    with tempfile.TemporaryFile() as delta:
+        with timed("append_scan"):
+            reader = io.BufferedReader(_LimitedReader(source, UPLOAD_MAX_BYTES), buffer_size=UPLOAD_CHUNK_SIZE)
+            scan = scan_csv(reader, previous, delta, key_columns)
+        manifest = scan["manifest"]
+        if previous is None:
+            return {"mode": "overwrite", "reason": "no earlier upload to append to", "manifest": manifest}
+        if not scan["comparable"]:
+            return {"mode": "overwrite", "reason": "the CSV header changed", "manifest": manifest}
+        if scan["changed"] and not key_columns:
+            return {"mode": "overwrite", "reason": "previously ingested rows changed and no key columns were given",
+                    "manifest": manifest}
+
+        result = {"mode": "append", "databricks_path": None, "rows_merged": scan["new_rows"], "rows_total": scan["rows"]}
+        if scan["new_rows"]:
+            delta.seek(0)
+            delta_path = upload_csv_stream_to_databricks(delta, delta_name)
+            columns = next(csv.reader([manifest["header"]]))
+            try:
+                with timed("append_merge"), get_pool().connection() as connection, connection.cursor() as cursor:
+                    cursor.execute(_merge_statement(table_name, delta_path, columns, key_columns))
+            except Exception as e:
+                print(f"Could not merge {delta_path} into {table_name}: {e}")
+                return {"mode": "overwrite", "reason": f"merging the new rows failed: {e}", "manifest": manifest}
+            finally:
+                try:
+                    get_workspace_client().files.delete(_volume_path(delta_path))
+                except Exception as e:
+                    print(f"Could not delete {delta_path}: {e}")
+            result["databricks_path"] = delta_path
+
+    save_append_manifest(table_name, manifest)
+    if scan["new_rows"]:
+        catalog_cache.invalidate(table_name)
+        catalog_cache.bump_data_version(table_name)
+        # Aggregates of the table are stale now; stop offering them and rebuild against the merged data.
+        rollup_manager.invalidate(table_name)
+        rollup_manager.refresh(table_name)
+    return result
+
+
+def trigger_csv_to_table(filename, extra_parameters: dict = None):
+    return trigger_csv_to_tables([filename], extra_parameters)
+
+
+def trigger_csv_to_tables(filenames: list, extra_parameters: dict = None):
+    """Starts one table-creation run for one or more files; names are passed comma-separated."""
     try:   
         # Trigger the job run
-        print(f"Triggering job ID: {148324980352233} with parameters: file_name = {filename}")
-        new_run = w.jobs.run_now(job_id=148324980352233, job_parameters={"file_name": filename})
+        job_parameters = {"file_name": ",".join(filenames), **(extra_parameters or {})}
+        print(f"Triggering job ID: {CSV_TO_TABLE_JOB_ID} with parameters: {job_parameters}")
+        with timed("job_trigger"):
+            new_run = get_workspace_client().jobs.run_now(job_id=CSV_TO_TABLE_JOB_ID, job_parameters=job_parameters)
 
         print(f"Job triggered successfully. Run ID: {new_run.run_id}")
+        # The job (re)creates tables, so cached table lists, schemas and rollups are stale.
+        for filename in filenames:
+            catalog_cache.invalidate(filename)
+            rollup_manager.invalidate(filename)
         return new_run.run_id
 
     except Exception as e:
         print(f"An error occurred: {e}")
+
+
+def get_job_run(run_id: int):
+    return get_workspace_client().jobs.get_run(run_id)
+
+
+# --- Job Tracking ---
+
+def _on_job_finished(record: dict):
+    # Queries may have re-cached the catalog while the run was in progress.
+    for table_name in record["tables"]:
+        catalog_cache.invalidate(table_name)
+        # The table was reloaded; results cached from its old rows must not be served.
+        catalog_cache.bump_data_version(table_name)
+        # Rollups built while the run was in progress may predate the new data; drop them
+        # and rebuild frequently used aggregates.
+        rollup_manager.invalidate(table_name)
+        rollup_manager.refresh(table_name)
+
+
+# Watches table-creation runs for /jobs/{run_id}; started and stopped by the API's lifespan hook.
+job_tracker = create_job_tracker_from_env(
+    trigger_csv_to_tables, get_job_run, on_finished=_on_job_finished, store=local_store
+)
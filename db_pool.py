@@ -0,0 +1,215 @@
+import os
+import time
+import threading
+from contextlib import contextmanager
+
+
+def _connect_to_warehouse():
+    """Opens a new Databricks SQL session using the DB_* environment variables."""
+    import databricks.sql  # Deferred to the first connection to keep start-up fast.
+    return databricks.sql.connect(
+        server_hostname=os.environ.get('DB_SERVER_HOSTNAME'),
+        http_path=os.environ.get('DB_HTTP_PATH'),
+        access_token=os.environ.get('DB_ACCESS_TOKEN'),
+    )
+
+
+class ConnectionPool:
+    """
+    A bounded pool of long-lived Databricks SQL connections.
+
+    Connections are checked out per unit of work and returned afterwards, so the
+    TLS handshake and session creation are paid once per connection instead of once
+    per request. Idle connections are health-checked before reuse and evicted once
+    they have been idle for longer than `idle_timeout` seconds.
+    """
+
+    def __init__(self, connect=_connect_to_warehouse, max_size: int = 8, min_size: int = 0,
+                 idle_timeout: float = 600.0, health_check_after: float = 60.0,
+                 checkout_timeout: float = 30.0):
+        self._connect = connect
+        self.max_size = max_size
+        self.min_size = min_size
+        self.idle_timeout = idle_timeout
+        self.health_check_after = health_check_after
+        self.checkout_timeout = checkout_timeout
+
+        # Idle connections are kept as (connection, last_used) and reused LIFO,
+        # so the least recently used ones age out first.
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._closed = False
+        self._reaper = None
+        self._stop_reaper = threading.Event()
+
+    # --- Checkout / Return ---
+
+    def acquire(self):
+        """Checks out a healthy connection, opening a new one if none are idle."""
+        if self._closed:
+            raise RuntimeError("Connection pool is closed.")
+        if not self._slots.acquire(timeout=self.checkout_timeout):
+            raise TimeoutError(f"Timed out waiting for a database connection after {self.checkout_timeout}s.")
+
+        try:
+            while True:
+                with self._lock:
+                    entry = self._idle.pop() if self._idle else None
+                if entry is None:
+                    return self._connect()
+
+                connection, last_used = entry
+                idle_for = time.monotonic() - last_used
+                if idle_for > self.idle_timeout:
+                    self._discard(connection)
+                    continue
+                if idle_for > self.health_check_after and not self._is_healthy(connection):
+                    self._discard(connection)
+                    continue
+                return connection
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, connection, discard: bool = False):
+        """Returns a connection to the pool, or closes it if it should not be reused."""
+        try:
+            if discard or self._closed:
+                self._discard(connection)
+            else:
+                with self._lock:
+                    self._idle.append((connection, time.monotonic()))
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        """Context manager that checks out a connection for the duration of the block."""
+        connection = self.acquire()
+        try:
+            yield connection
+        except Exception:
+            # Query errors leave the session usable; only drop it if it is actually broken.
+            self.release(connection, discard=not self._is_healthy(connection))
+            raise
+        else:
+            self.release(connection)
+
+    # --- Maintenance ---
+
+    def prefill(self):
+        """Opens up to `min_size` connections ahead of the first request."""
+        with self._lock:
+            missing = self.min_size - len(self._idle)
+        for _ in range(max(missing, 0)):
+            connection = self._connect()
+            with self._lock:
+                self._idle.append((connection, time.monotonic()))
+
+    def ping(self):
+        """Runs a trivial query on a pooled connection; raises if the warehouse is unreachable."""
+        with self.connection() as connection, connection.cursor() as cursor:
+            cursor.execute("SELECT 1")
+            cursor.fetchall()
+
+    def evict_idle(self):
+        """Closes idle connections that have outlived `idle_timeout`, keeping at least `min_size`."""
+        now = time.monotonic()
+        with self._lock:
+            keep, expired = [], []
+            # Oldest entries are at the front of the list.
+            for i, (connection, last_used) in enumerate(self._idle):
+                survivors = len(keep) + len(self._idle) - i
+                if now - last_used > self.idle_timeout and survivors > self.min_size:
+                    expired.append(connection)
+                else:
+                    keep.append((connection, last_used))
+            self._idle = keep
+        for connection in expired:
+            self._discard(connection)
+
+    def start_reaper(self, interval: float = 60.0):
+        """Starts a daemon thread that periodically evicts idle connections."""
+        if self._reaper is not None:
+            return
+
+        def _run():
+            while not self._stop_reaper.wait(interval):
+                self.evict_idle()
+
+        self._reaper = threading.Thread(target=_run, name="db-pool-reaper", daemon=True)
+        self._reaper.start()
+
+    def close(self):
+        """Closes every idle connection and refuses further checkouts."""
+        self._closed = True
+        self._stop_reaper.set()
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection, _ in idle:
+            self._discard(connection)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"idle": len(self._idle), "max_size": self.max_size}
+
+    # --- Internals ---
+
+    @staticmethod
+    def _is_healthy(connection) -> bool:
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+                cursor.fetchall()
+            return True
+        except Exception:
+            return False
+
+    @staticmethod
+    def _discard(connection):
+        try:
+            connection.close()
+        except Exception as e:
+            print(f"Error closing pooled connection: {e}")
+
+
+# --- Process-wide Pool ---
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def init_pool(**overrides) -> ConnectionPool:
+    """
+    Creates the process-wide pool from DB_POOL_* environment variables.
+    Called from the FastAPI lifespan hook; keyword arguments override the environment.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            return _pool
+        options = {
+            "max_size": int(os.environ.get("DB_POOL_MAX_SIZE", "8")),
+            "min_size": int(os.environ.get("DB_POOL_MIN_SIZE", "1")),
+            "idle_timeout": float(os.environ.get("DB_POOL_IDLE_TIMEOUT", "600")),
+            "health_check_after": float(os.environ.get("DB_POOL_HEALTH_CHECK_AFTER", "60")),
+            "checkout_timeout": float(os.environ.get("DB_POOL_CHECKOUT_TIMEOUT", "30")),
+        }
+        options.update(overrides)
+        _pool = ConnectionPool(**options)
+        _pool.start_reaper()
+        return _pool
+
+
+def get_pool() -> ConnectionPool:
+    """Returns the process-wide pool, creating it on first use outside of FastAPI."""
+    return _pool if _pool is not None else init_pool()
+
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
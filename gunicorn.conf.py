@@ -0,0 +1,71 @@
+# Production serving: `gunicorn -c gunicorn.conf.py main:app` (see launch.sh).
+# Each worker is a full uvicorn event loop with its own warehouse pool and caches; state
+# that must be seen by every worker goes through the local store (local_store.py).
+import os
+import shutil
+from dotenv import load_dotenv
+
+# The settings below, and the state paths handed to the workers, may come from .env.
+load_dotenv()
+
+
+def _available_cores() -> int:
+    """CPUs this process may use, honouring a container CPU quota (cgroup v2) and affinity."""
+    try:
+        cores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cores = os.cpu_count() or 1
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            cores = min(cores, max(1, int(int(quota) / int(period))))
+    except (OSError, ValueError):
+        pass
+    return cores
+
+
+# --- Workers ---
+# The API mostly waits on the warehouse and Gemini, so one worker per core is enough;
+# WEB_CONCURRENCY overrides it.
+workers = int(os.environ.get("WEB_CONCURRENCY", str(_available_cores())))
+worker_class = "uvicorn_worker.UvicornWorker"
+bind = os.environ.get("BIND", "127.0.0.1:4000")
+# Import the app in each worker rather than in the master, so no worker inherits the
+# master's sockets, threads or SQLite connections.
+preload_app = False
+
+# Workers are not recycled after N requests (max_requests): the worker that submitted an
+# upload job polls it and runs its post-run hooks from memory, and a restart would drop them.
+
+# --- Timeouts ---
+# A visualization request can wait on a cold warehouse; nginx gives up at the same point.
+timeout = int(os.environ.get("WORKER_TIMEOUT", "120"))
+# On SIGTERM, workers stop accepting, finish in-flight requests and run the lifespan shutdown.
+graceful_timeout = int(os.environ.get("GRACEFUL_TIMEOUT", "30"))
+# Longer than nginx's upstream keepalive, so nginx always closes idle connections first.
+keepalive = 75
+
+# --- Shared State ---
+# Deferred insights, job records, catalog invalidations, cached responses and Prometheus
+# metrics are shared between workers through files on the local disk.
+_state_dir = os.environ.get("STATE_DIR", ".cache")
+os.environ.setdefault("LOCAL_STORE_PATH", os.path.join(_state_dir, "local_store.sqlite3"))
+os.environ.setdefault("RESPONSE_CACHE_BACKEND", "sqlite")
+os.environ.setdefault("RESPONSE_CACHE_PATH", os.path.join(_state_dir, "response_cache.sqlite3"))
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", os.path.join(_state_dir, "prometheus"))
+
+accesslog = "-"
+errorlog = "-"
+
+
+def on_starting(server):
+    # Metric files of a previous run would otherwise be added to this one's.
+    directory = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory, exist_ok=True)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
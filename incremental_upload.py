@@ -0,0 +1,123 @@
+import os
+import csv
+import zlib
+import hashlib
+from collections import Counter
+from typing import BinaryIO
+
+# Rows per chunk on average. Chunk boundaries are picked from row contents, so rows added
+# or changed in one place leave the chunks elsewhere in the file, and their hashes, intact.
+APPEND_CHUNK_ROWS = int(os.getenv("APPEND_CHUNK_ROWS", "1024"))
+MANIFEST_VERSION = 1
+
+_BOM = b"\xef\xbb\xbf"
+
+
+class IncrementalUploadError(ValueError):
+    """Raised when a CSV cannot be appended, e.g. a key column is missing from its header."""
+
+
+def _records(source: BinaryIO):
+    """
+    Yields CSV records without their line terminator. Physical lines are joined while a
+    quoted field is open, so values with embedded newlines stay one record. Blank lines are skipped.
+    """
+    record, quotes = b"", 0
+    for line in source:
+        record += line
+        quotes += line.count(b'"')
+        if quotes % 2 == 0:
+            if record := record.rstrip(b"\r\n"):
+                yield record
+            record, quotes = b"", 0
+    if record := record.rstrip(b"\r\n"):
+        yield record
+
+
+def _digest(rows: list) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    for row in rows:
+        h.update(row)
+        h.update(b"\n")
+    return h.hexdigest()
+
+
+def scan_csv(source: BinaryIO, previous: dict = None, delta: BinaryIO = None, key_columns: list = (),
+             chunk_rows: int = APPEND_CHUNK_ROWS) -> dict:
+    """
+    Splits a CSV into content-defined chunks of rows and compares them with the manifest
+    of the last ingested version of the file.
+
+    Rows of chunks that are not in `previous` are written to `delta` (with the header),
+    so they can be uploaded on their own. The last chunk of a file ends at the end of the
+    file rather than at a boundary; when rows are appended it grows, so only the rows after
+    its old length are treated as new.
+
+    Returns {"manifest", "rows", "new_rows", "reused_chunks", "comparable", "changed"}:
+    `comparable` is False without a previous manifest or when the header changed, and
+    `changed` is True when content of the previous version is missing (edited or deleted rows).
+    """
+    records = _records(source)
+    header = next(records, b"").removeprefix(_BOM)
+    if not header:
+        raise IncrementalUploadError("The CSV file is empty.")
+    header_text = header.decode("utf-8", errors="replace")
+    columns = next(csv.reader([header_text]))
+    if missing := [k for k in key_columns if k not in columns]:
+        raise IncrementalUploadError(f"Key columns not found in the CSV header: {', '.join(missing)}")
+
+    comparable = (
+        previous is not None and previous.get("version") == MANIFEST_VERSION
+        and previous.get("header") == header_text and previous.get("chunk_rows") == chunk_rows
+    )
+    known = Counter(previous["chunks"]) if comparable else Counter()
+    tail = previous.get("tail") if comparable else None
+    if delta is not None:
+        delta.write(header + b"\n")
+
+    chunks, rows = [], []
+    stats = {"rows": 0, "new_rows": 0, "reused_chunks": 0}
+
+    def close_chunk():
+        nonlocal tail
+        digest = _digest(rows)
+        chunks.append(digest)
+        if known[digest] > 0:
+            known[digest] -= 1
+            stats["reused_chunks"] += 1
+            return
+        new = rows
+        # The previous tail, now followed by more rows of the same chunk.
+        if tail is not None and len(rows) >= tail["rows"] and _digest(rows[:tail["rows"]]) == tail["digest"]:
+            new, tail = rows[tail["rows"]:], None
+        stats["new_rows"] += len(new)
+        if delta is not None:
+            for row in new:
+                delta.write(row + b"\n")
+
+    max_rows = chunk_rows * 8
+    for row in records:
+        rows.append(row)
+        stats["rows"] += 1
+        if zlib.crc32(row) % chunk_rows == 0 or len(rows) >= max_rows:
+            close_chunk()
+            rows = []
+
+    new_tail = None
+    if rows:
+        close_chunk()
+        new_tail = {"digest": chunks.pop(), "rows": len(rows)}
+
+    return {
+        "manifest": {
+            "version": MANIFEST_VERSION,
+            "header": header_text,
+            "chunk_rows": chunk_rows,
+            "chunks": chunks,
+            "tail": new_tail,
+            "rows": stats["rows"],
+        },
+        **stats,
+        "comparable": comparable,
+        "changed": comparable and (sum(known.values()) > 0 or tail is not None),
+    }
@@ -0,0 +1,294 @@
+import os
+import json
+import time
+import socket
+import ipaddress
+import threading
+import urllib.parse
+import urllib.request
+from concurrent.futures import Future
+
+# Life-cycle states after which a run will not change any more.
+TERMINAL_STATES = {"TERMINATED", "SKIPPED", "INTERNAL_ERROR"}
+RUNNING_STATES = {"RUNNING", "TERMINATING"}
+
+
+def _status(life_cycle_state: str, result_state: str) -> str:
+    """Collapses Databricks run states into pending / running / succeeded / failed."""
+    if life_cycle_state in TERMINAL_STATES:
+        return "succeeded" if result_state == "SUCCESS" else "failed"
+    if life_cycle_state in RUNNING_STATES:
+        return "running"
+    return "pending"
+
+
+class CallbackURLError(ValueError):
+    """Raised when a job callback URL is not allowed."""
+
+
+class _NoRedirects(urllib.request.HTTPRedirectHandler):
+    # A redirect could point the callback at an address the URL check never saw.
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+_callback_opener = urllib.request.build_opener(_NoRedirects)
+
+
+def check_callback_url(url: str, allowed_hosts: frozenset):
+    """
+    Rejects callback URLs unless they are http(s), their host is in `allowed_hosts` (an
+    entry starting with "." also allows its subdomains) and every address the host resolves
+    to is public. Raises CallbackURLError; resolving the host blocks.
+    """
+    parsed = urllib.parse.urlsplit(url)
+    host = (parsed.hostname or "").lower()
+    if parsed.scheme not in ("http", "https") or not host:
+        raise CallbackURLError("callback_url must be an http(s) URL.")
+    if not allowed_hosts:
+        raise CallbackURLError("Job callbacks are disabled; set JOB_CALLBACK_ALLOWED_HOSTS to enable them.")
+    if not any(host == entry or (entry.startswith(".") and host.endswith(entry)) for entry in allowed_hosts):
+        raise CallbackURLError(f"callback_url host '{host}' is not in JOB_CALLBACK_ALLOWED_HOSTS.")
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(host, parsed.port or None)}
+    except socket.gaierror as e:
+        raise CallbackURLError(f"callback_url host '{host}' does not resolve: {e}")
+    for address in addresses:
+        ip = ipaddress.ip_address(address.split("%", 1)[0])
+        if not ip.is_global or ip.is_multicast:
+            raise CallbackURLError(f"callback_url host '{host}' resolves to a non-public address.")
+
+
+def _post_json(url: str, payload: dict, timeout: float = 10.0):
+    request = urllib.request.Request(
+        url, data=json.dumps(payload).encode(), headers={"Content-Type": "application/json"}, method="POST"
+    )
+    with _callback_opener.open(request, timeout=timeout) as response:
+        response.read()
+
+
+class JobTracker:
+    """
+    Follows upload-to-table job runs in the background.
+
+    `submit` triggers the job for one uploaded file and resolves to its run id. With a
+    `batch_window`, files submitted within that many seconds (and with the same extra
+    parameters) share one run whose `file_name` parameter lists them all, so a burst of
+    uploads pays cluster start-up once. A single poller thread then checks active runs
+    every `poll_interval` seconds. When a run finishes it calls `on_finished(record)`,
+    each file's `on_success` hook if the run succeeded, and any webhook callback URLs.
+
+    `trigger(file_names, extra_parameters)` must return a run id or None on failure;
+    `get_run(run_id)` returns a databricks.sdk Run. With a `store` (see local_store.py)
+    every record is also published there, so any worker process can report on a run;
+    the process that submitted it keeps polling it and runs its hooks.
+    """
+
+    NAMESPACE = "job_runs"
+
+    def __init__(self, trigger, get_run, poll_interval: float = 10.0, batch_window: float = 0.0,
+                 retention: float = 86400.0, on_finished=None, store=None, callback_allowed_hosts=()):
+        self._trigger = trigger
+        self._get_run = get_run
+        self.poll_interval = poll_interval
+        self.batch_window = batch_window
+        self.retention = retention
+        self._on_finished = on_finished
+        self.store = store
+        self.callback_allowed_hosts = frozenset(h.strip().lower() for h in callback_allowed_hosts if h.strip())
+        self._runs = {}  # run_id -> record
+        self._hooks = {}  # run_id -> ([on_success], [callback_url])
+        self._batches = {}  # extra-parameters key -> pending batch
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._poller = None
+
+    # --- Submission ---
+
+    def submit(self, file_name: str, extra_parameters: dict = None, on_success=None,
+               callback_url: str = None) -> Future:
+        """Queues a file for table creation; the returned Future resolves to the run id (or None)."""
+        future = Future()
+        entry = (file_name, on_success, callback_url, future)
+        if not self.batch_window:
+            self._launch(extra_parameters, [entry])
+            return future
+
+        key = json.dumps(extra_parameters or {}, sort_keys=True)
+        with self._lock:
+            batch = self._batches.get(key)
+            if batch is None:
+                batch = self._batches[key] = {"extra_parameters": extra_parameters, "entries": []}
+                timer = threading.Timer(self.batch_window, self._flush, args=(key,))
+                timer.daemon = True
+                timer.start()
+            batch["entries"].append(entry)
+        return future
+
+    def _flush(self, key: str):
+        with self._lock:
+            batch = self._batches.pop(key, None)
+        if batch:
+            self._launch(batch["extra_parameters"], batch["entries"])
+
+    def _launch(self, extra_parameters: dict, entries: list):
+        file_names = list(dict.fromkeys(entry[0] for entry in entries))
+        try:
+            run_id = self._trigger(file_names, extra_parameters)
+        except Exception as e:
+            print(f"Could not trigger table creation for {file_names}: {e}")
+            run_id = None
+
+        if run_id is not None:
+            self.watch(
+                run_id, file_names,
+                on_success=[entry[1] for entry in entries if entry[1]],
+                callback_urls=[entry[2] for entry in entries if entry[2]],
+            )
+        for entry in entries:
+            entry[3].set_result(run_id)
+
+    # --- Tracking ---
+
+    def watch(self, run_id: int, file_names: list, on_success: list = (), callback_urls: list = ()):
+        """Starts following a run that was triggered elsewhere."""
+        now = time.time()
+        with self._lock:
+            self._sweep(now)
+            self._runs[run_id] = {
+                "run_id": run_id,
+                "status": "pending",
+                "life_cycle_state": None,
+                "result_state": None,
+                "state_message": None,
+                "tables": list(file_names),
+                "submitted_at": now,
+                "finished_at": None,
+            }
+            self._hooks[run_id] = (list(on_success), list(callback_urls))
+        self._publish(run_id)
+        self._wake.set()
+
+    def status(self, run_id: int):
+        """Returns a copy of the run's record, or None if neither this process nor the store knows it."""
+        with self._lock:
+            record = self._runs.get(run_id)
+            if record is not None:
+                return dict(record, tables=list(record["tables"]))
+        return self.store.get(self.NAMESPACE, str(run_id)) if self.store is not None else None
+
+    def _publish(self, run_id: int):
+        if self.store is None:
+            return
+        if (record := self.status(run_id)) is not None:
+            try:
+                self.store.put(self.NAMESPACE, str(run_id), record, self.retention)
+            except Exception as e:
+                print(f"Could not publish the state of run {run_id}: {e}")
+
+    def poll(self):
+        """Refreshes every unfinished run once; the poller thread calls this periodically."""
+        with self._lock:
+            active = [run_id for run_id, record in self._runs.items() if record["finished_at"] is None]
+        for run_id in active:
+            try:
+                run = self._get_run(run_id)
+            except Exception as e:
+                print(f"Could not fetch the state of run {run_id}: {e}")
+                continue
+            state = run.state
+            life_cycle = state.life_cycle_state.value if state and state.life_cycle_state else None
+            result = state.result_state.value if state and state.result_state else None
+            with self._lock:
+                record = self._runs.get(run_id)
+                if record is None:
+                    continue
+                record.update(
+                    life_cycle_state=life_cycle,
+                    result_state=result,
+                    state_message=state.state_message if state else None,
+                    status=_status(life_cycle, result),
+                )
+                finished = life_cycle in TERMINAL_STATES
+                if finished:
+                    record["finished_at"] = time.time()
+                    hooks = self._hooks.pop(run_id, ([], []))
+            self._publish(run_id)
+            if finished:
+                self._finish(self.status(run_id), *hooks)
+
+    def _finish(self, record: dict, on_success: list, callback_urls: list):
+        if self._on_finished is not None:
+            try:
+                self._on_finished(record)
+            except Exception as e:
+                print(f"Job completion handler failed for run {record['run_id']}: {e}")
+        if record["status"] == "succeeded":
+            for hook in on_success:
+                try:
+                    hook()
+                except Exception as e:
+                    print(f"Post-run hook failed for run {record['run_id']}: {e}")
+        else:
+            print(f"Run {record['run_id']} finished as {record['result_state'] or record['life_cycle_state']}.")
+        for url in callback_urls:
+            # Callbacks get their own thread so a slow receiver never delays polling.
+            threading.Thread(target=self._notify, args=(url, record), daemon=True).start()
+
+    def check_callback_url(self, url: str):
+        """Raises CallbackURLError unless `url` may receive job callbacks (see check_callback_url)."""
+        check_callback_url(url, self.callback_allowed_hosts)
+
+    def _notify(self, url: str, record: dict):
+        try:
+            # Checked again at send time: the host may resolve differently than at submission.
+            self.check_callback_url(url)
+            _post_json(url, record)
+        except Exception as e:
+            print(f"Job callback to {url} failed: {e}")
+
+    def _sweep(self, now: float):
+        cutoff = now - self.retention
+        for run_id in [k for k, v in self._runs.items() if v["finished_at"] and v["finished_at"] < cutoff]:
+            del self._runs[run_id]
+
+    # --- Background Poller ---
+
+    def start(self):
+        if self._poller is not None and self._poller.is_alive():
+            return
+        self._stop = threading.Event()
+        self._poller = threading.Thread(target=self._run, name="job-tracker", daemon=True)
+        self._poller.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._poller is not None:
+            self._poller.join(timeout=5)
+            self._poller = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.poll()
+            # Sleep until the next poll, or until a new run is watched.
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+
+
+def create_job_tracker_from_env(trigger, get_run, on_finished=None, store=None) -> JobTracker:
+    """
+    Builds a tracker from JOB_POLL_INTERVAL, JOB_BATCH_WINDOW (0 disables batching), JOB_RETENTION
+    and JOB_CALLBACK_ALLOWED_HOSTS (comma-separated; callbacks are disabled while it is empty).
+    """
+    return JobTracker(
+        trigger,
+        get_run,
+        poll_interval=float(os.environ.get("JOB_POLL_INTERVAL", "10")),
+        batch_window=float(os.environ.get("JOB_BATCH_WINDOW", "0")),
+        retention=float(os.environ.get("JOB_RETENTION", "86400")),
+        on_finished=on_finished,
+        store=store,
+        callback_allowed_hosts=os.environ.get("JOB_CALLBACK_ALLOWED_HOSTS", "").split(","),
+    )
@@ -1,2 +1,7 @@
 nginx -c /app/nginx.conf
-uvicorn main:app --reload --port 4000
\ No newline at end of file
+
+# APP_MODE=dev runs a single auto-reloading worker; the default serves with one worker per core.
+if [ "${APP_MODE:-production}" = "dev" ]; then
+    exec uvicorn main:app --reload --port 4000
+fi
+exec gunicorn -c gunicorn.conf.py main:app
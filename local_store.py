@@ -0,0 +1,140 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+
+
+class LocalStore:
+    """
+    Small JSON record store in a SQLite file, shared by every worker process on a host.
+
+    With several API workers, a request may be served by a different process than the one
+    that started the work it asks about (deferred insights, upload jobs), so that state is
+    written here. Records expire after their `ttl`. Each process opens its own connection
+    on first use, so the store can be created before the server forks its workers.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=10)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS records (
+                    namespace TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    expires_at REAL NOT NULL,
+                    PRIMARY KEY (namespace, key)
+                )
+                """
+            )
+            self._pid = os.getpid()
+        return self._conn
+
+    def get(self, namespace: str, key: str):
+        """Returns the stored value, or None if it is missing or expired."""
+        with self._lock:
+            row = self._connection().execute(
+                "SELECT value FROM records WHERE namespace = ? AND key = ? AND expires_at >= ?",
+                (namespace, key, time.time()),
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, namespace: str, key: str, value, ttl: float):
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            conn.execute(
+                "INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?)",
+                (namespace, key, json.dumps(value, default=str), now + ttl),
+            )
+            conn.execute("DELETE FROM records WHERE expires_at < ?", (now,))
+
+    def modify(self, namespace: str, key: str, fn, ttl: float):
+        """
+        Atomically replaces a value: `fn(value)` gets the current value (None if missing or
+        expired) and returns (new value, result). A new value of None leaves the record
+        alone; otherwise it is stored for `ttl` seconds. Returns `result`.
+        """
+        with self._lock:
+            conn = self._connection()
+            # BEGIN IMMEDIATE takes the write lock up front, so concurrent changes from
+            # other workers cannot interleave between the read and the write.
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                row = conn.execute(
+                    "SELECT value, expires_at FROM records WHERE namespace = ? AND key = ?", (namespace, key)
+                ).fetchone()
+                value, result = fn(json.loads(row[0]) if row and row[1] >= now else None)
+                if value is not None:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?)",
+                        (namespace, key, json.dumps(value, default=str), now + ttl),
+                    )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return result
+
+    def update(self, namespace: str, key: str, **fields):
+        """Merges fields into a stored dict, keeping its expiry; a missing record is left alone."""
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(
+                    "SELECT value FROM records WHERE namespace = ? AND key = ?", (namespace, key)
+                ).fetchone()
+                if row is not None:
+                    value = {**json.loads(row[0]), **fields}
+                    conn.execute(
+                        "UPDATE records SET value = ? WHERE namespace = ? AND key = ?",
+                        (json.dumps(value, default=str), namespace, key),
+                    )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+    def increment(self, namespace: str, key: str) -> int:
+        """Atomically bumps a counter that never expires and returns its new value."""
+        with self._lock:
+            conn = self._connection()
+            conn.execute(
+                "INSERT INTO records VALUES (?, ?, '1', 1e300) "
+                "ON CONFLICT (namespace, key) DO UPDATE SET value = CAST(value AS INTEGER) + 1",
+                (namespace, key),
+            )
+            return int(conn.execute(
+                "SELECT value FROM records WHERE namespace = ? AND key = ?", (namespace, key)
+            ).fetchone()[0])
+
+    def counter(self, namespace: str, key: str) -> int:
+        value = self.get(namespace, key)
+        return int(value) if value is not None else 0
+
+
+def create_local_store_from_env():
+    """
+    Returns a store at LOCAL_STORE_PATH, or None when it is unset (single-process mode,
+    where all of this state simply stays in memory).
+    """
+    path = os.environ.get("LOCAL_STORE_PATH")
+    return LocalStore(path) if path else None
+
+
+# Shared by pending insights, job tracking, catalog invalidation and rollups across workers.
+local_store = create_local_store_from_env()
@@ -1,72 +1,464 @@
+import time
+
+# Start-up is measured from here; the imports below are most of a cold start.
+_STARTED = time.perf_counter()
+
+# Settings are read from the environment when modules are imported, so .env goes first.
+from dotenv import load_dotenv
+load_dotenv()
+
+import os
+import uuid
+import asyncio
+import functools
+from contextlib import asynccontextmanager
 from datetime import datetime
-from fastapi import FastAPI, UploadFile, File, HTTPException
-from fastapi.responses import JSONResponse
-from databricks_integration import upload_csv_to_databricks, trigger_csv_to_table
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException
+from fastapi.responses import JSONResponse, StreamingResponse, Response
+from databricks_integration import (
+    upload_csv_stream_to_databricks,
+    upload_csv_as_parquet_to_databricks,
+    apply_profile_comments,
+    append_csv_to_table,
+    save_append_manifest,
+    delete_append_manifest,
+    job_tracker,
+    UploadTooLargeError,
+    UPLOAD_MAX_BYTES,
+    UPLOAD_FORMAT,
+)
+from csv_profiling import CsvConversionError
+from incremental_upload import IncrementalUploadError
+from job_tracker import CallbackURLError
+from sql_guard import is_valid_table_name
+from typing import Optional
 from pydantic import BaseModel
-from databricks_flow import generate_visualization_from_query
+from databricks_flow import (
+    generate_visualization_from_query_async,
+    stream_visualization_from_query_async,
+    start_catalog_refresh,
+    stop_catalog_refresh,
+    warm_up_catalog,
+    warm_up_llm,
+)
+from db_pool import init_pool, close_pool, get_pool
+from pending_results import PendingResults
+from local_store import local_store
+from serialization import RESULT_FORMATS, ARROW_STREAM_MEDIA_TYPE, format_table, to_arrow_ipc, dumps
+from metrics import start_trace, timed, render_metrics, record_startup, RESPONSE_BYTES
+
+_IMPORTED = time.perf_counter()
+
+
+# --- Readiness ---
+# Start-up milestones in ms since _STARTED, and the latest result of each warm-up check.
+_startup = {"import_ms": round((_IMPORTED - _STARTED) * 1000, 1)}
+_readiness = {"checks": {}, "task": None}
+READINESS_CHECKS = ("warehouse", "catalog", "llm")
+# How long shutdown waits for background insight tasks; keep below the server's graceful timeout.
+SHUTDOWN_GRACE_SECONDS = float(os.environ.get("SHUTDOWN_GRACE_SECONDS", "20"))
+
+
+def _warm_warehouse():
+    pool = get_pool()
+    pool.prefill()
+    pool.ping()
+
+
+async def _run_check(name: str, fn):
+    start = time.perf_counter()
+    try:
+        await asyncio.to_thread(fn)
+        result = {"ok": True}
+    except Exception as e:
+        # A sleeping or unreachable warehouse should not stop the API from starting.
+        print(f"Warm-up check '{name}' failed: {e}")
+        result = {"ok": False, "error": str(e)}
+    result["ms"] = round((time.perf_counter() - start) * 1000, 1)
+    _readiness["checks"][name] = result
+
+
+def _is_ready() -> bool:
+    checks = _readiness["checks"]
+    return all(name in checks and checks[name]["ok"] for name in READINESS_CHECKS)
+
+
+async def _warm_up():
+    """Opens warehouse connections and loads the catalog while the Gemini client is created."""
+    async def warehouse_then_catalog():
+        await _run_check("warehouse", _warm_warehouse)
+        if _readiness["checks"]["warehouse"]["ok"]:
+            await _run_check("catalog", warm_up_catalog)
+
+    await asyncio.gather(warehouse_then_catalog(), _run_check("llm", warm_up_llm))
+    if _is_ready() and "ready_ms" not in _startup:
+        _startup["ready_ms"] = round((time.perf_counter() - _STARTED) * 1000, 1)
+        record_startup("ready", _startup["ready_ms"] / 1000)
+        print(f"API ready {_startup['ready_ms']} ms after start.")
+
+
+def _start_warm_up():
+    """Starts a warm-up in the background unless one is already running."""
+    task = _readiness["task"]
+    if task is None or task.done():
+        _readiness["task"] = asyncio.create_task(_warm_up())
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Open the shared Databricks SQL pool once per process instead of once per request.
+    # Connections, the catalog and the Gemini client are warmed in the background, so the
+    # process serves (and answers /ready with 503) right away instead of blocking here.
+    init_pool()
+    start_catalog_refresh()
+    job_tracker.start()
+    _start_warm_up()
+    _startup["serving_ms"] = round((time.perf_counter() - _STARTED) * 1000, 1)
+    record_startup("imported", _startup["import_ms"] / 1000)
+    record_startup("serving", _startup["serving_ms"] / 1000)
+    print(f"API imported in {_startup['import_ms']} ms, serving after {_startup['serving_ms']} ms.")
+    yield
+    if _readiness["task"] is not None:
+        _readiness["task"].cancel()
+    # Let deferred insights that are already being computed finish before the worker exits.
+    if _background_tasks:
+        await asyncio.wait(set(_background_tasks), timeout=SHUTDOWN_GRACE_SECONDS)
+    job_tracker.stop()
+    stop_catalog_refresh()
+    await asyncio.to_thread(close_pool)
 
-app = FastAPI()
+
+app = FastAPI(lifespan=lifespan)
+
+# Insights computed after the data has been returned, polled via /insights/{request_id}.
+pending_insights = PendingResults(store=local_store)
+# Strong references so background insight tasks are not garbage-collected mid-flight.
+_background_tasks = set()
 
 # This defines the expected JSON body structure for the POST request.
 class QueryInput(BaseModel):
     query: str
+    # Optional override of the PLANNER_MODE setting: "multi_step" or "single_shot".
+    planner: Optional[str] = None
+    # Return the data without waiting for insights; fetch them from /insights/{request_id}.
+    defer_insights: bool = False
+    # "rows" (list of objects), "columnar" (column arrays) or "arrow" (Arrow IPC stream).
+    format: str = "rows"
+    # Include per-stage timings, token and row counts as a "timings" field (or a final event).
+    timings: bool = False
+
+
+def _check_format(result_format: str, allowed=RESULT_FORMATS):
+    if result_format not in allowed:
+        raise HTTPException(
+            status_code=400, detail=f"Unsupported format '{result_format}'. Expected one of: {', '.join(allowed)}."
+        )
+
+
+def _render(viz_info: dict, table, result_format: str, **extra) -> Response:
+    """
+    Serializes a visualization result. Runs on a worker thread because converting and
+    encoding large result sets is CPU-bound.
+    """
+    with timed("serialize"):
+        if result_format == "arrow":
+            # Non-tabular fields travel as JSON in the Arrow schema metadata.
+            body = to_arrow_ipc(table, metadata={"visualization": viz_info, **extra})
+            media_type = ARROW_STREAM_MEDIA_TYPE
+        else:
+            body = dumps({"visualization": viz_info, "data": format_table(table, result_format), **extra})
+            media_type = "application/json"
+    RESPONSE_BYTES.labels(result_format).observe(len(body))
+    return Response(content=body, media_type=media_type)
+
+
+def _with_timings(trace, include: bool) -> dict:
+    return {"timings": trace.to_dict()} if include else {}
+
+
+def _to_http_exception(e: Exception) -> HTTPException:
+    if isinstance(e, HTTPException):
+        return e
+    if isinstance(e, TimeoutError):
+        # A stage timeout or the request's latency budget ran out (slow Gemini or warehouse).
+        return HTTPException(status_code=504, detail=str(e) or "The request timed out.")
+    if isinstance(e, (ValueError, LookupError)):
+        # Handle known errors from our flow (e.g., no tables found, LLM returns invalid format)
+        return HTTPException(status_code=400, detail=str(e))
+    # Catch any other unexpected errors (e.g., DB connection, LLM API failure)
+    return HTTPException(status_code=500, detail=f"An internal error occurred: {e}")
+
+
+async def _resolve_insights(request_id: str, events):
+    """Drains the remaining 'insights' event of a visualization stream into pending_insights."""
+    try:
+        async for event, payload in events:
+            if event == "insights":
+                await asyncio.to_thread(pending_insights.resolve, request_id, payload)
+    except Exception as e:
+        await asyncio.to_thread(pending_insights.fail, request_id, str(e))
 
 
 @app.post("/generate_visualization")
-def generate_viz(input_data: QueryInput):
+async def generate_viz(input_data: QueryInput):
     """
     Accepts a user query and returns a full JSON payload with
     a recommended visualization and the corresponding data.
     """
+    _check_format(input_data.format)
+    trace = start_trace()
     try:
+        if input_data.defer_insights:
+            events = stream_visualization_from_query_async(input_data.query, planner=input_data.planner)
+            _, viz_info = await anext(events)
+            _, data_reduction = await anext(events)
+            _, data = await anext(events)
+
+            # With a local store these are SQLite writes, so they stay off the event loop.
+            request_id = await asyncio.to_thread(pending_insights.create)
+            task = asyncio.create_task(_resolve_insights(request_id, events))
+            _background_tasks.add(task)
+            task.add_done_callback(_background_tasks.discard)
+            response = await asyncio.to_thread(
+                _render, viz_info, data, input_data.format,
+                data_reduction=data_reduction, request_id=request_id,
+                **_with_timings(trace, input_data.timings),
+            )
+            response.headers["Server-Timing"] = trace.server_timing()
+            return response
+
         # The entire complex workflow is handled by this single function call.
-        visualization_data = generate_visualization_from_query(input_data.query)
+        # It is awaited end-to-end, so no threadpool worker is held while the LLM responds.
+        visualization_data = await generate_visualization_from_query_async(
+            input_data.query, planner=input_data.planner
+        )
         
-        # FastAPI automatically converts the final Python dictionary into a JSON response.
-        return visualization_data
-    except (ValueError, LookupError) as e:
-        # Handle known errors from our flow (e.g., no tables found, LLM returns invalid format)
-        raise HTTPException(status_code=400, detail=str(e))
+        # Results are encoded with orjson straight from Arrow, off the event loop.
+        response = await asyncio.to_thread(
+            _render, visualization_data["visualization"], visualization_data["data"], input_data.format,
+            data_reduction=visualization_data["data_reduction"],
+            **_with_timings(trace, input_data.timings),
+        )
+        response.headers["Server-Timing"] = trace.server_timing()
+        return response
+    except Exception as e:
+        raise _to_http_exception(e)
+
+
+@app.post("/generate_visualization/stream")
+async def generate_viz_stream(input_data: QueryInput):
+    """
+    Streams the result as newline-delimited JSON, one {"event", "payload"} object per line:
+    the visualization choice, the data (preceded by its data_reduction summary), then the
+    insights, each as soon as it is ready. With "timings" set, a final "timings" event follows.
+    """
+    _check_format(input_data.format, allowed=("rows", "columnar"))
+    trace = start_trace()
+    events = stream_visualization_from_query_async(input_data.query, planner=input_data.planner)
+    try:
+        # Wait for the first event so planning errors still map to a proper status code.
+        first = await anext(events)
     except Exception as e:
-        # Catch any other unexpected errors (e.g., DB connection, LLM API failure)
-        raise HTTPException(status_code=500, detail=f"An internal error occurred: {e}")
+        raise _to_http_exception(e)
+
+    def encode(event: str, payload) -> bytes:
+        if event == "data":
+            payload = format_table(payload, input_data.format)
+        return dumps({"event": event, "payload": payload}) + b"\n"
+
+    async def ndjson():
+        yield encode(*first)
+        try:
+            async for event, payload in events:
+                yield await asyncio.to_thread(encode, event, payload)
+            if input_data.timings:
+                yield encode("timings", trace.to_dict())
+        except Exception as e:
+            # Headers are already sent, so errors are reported in-band.
+            yield encode("error", _to_http_exception(e).detail)
+
+    # Tell nginx not to buffer the stream, so each event reaches the browser as it is produced.
+    return StreamingResponse(ndjson(), media_type="application/x-ndjson", headers={"X-Accel-Buffering": "no"})
+
+
+@app.get("/insights/{request_id}")
+async def get_insights(request_id: str):
+    """Returns deferred insights: {"status": "pending" | "ready" | "failed", ...}."""
+    entry = await asyncio.to_thread(pending_insights.get, request_id)
+    if entry is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired request id.")
+    return {"request_id": request_id, "status": entry["status"], "insights": entry["result"], "error": entry["error"]}
+
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus scrape endpoint: stage latencies, LLM tokens, result sizes and cache hits."""
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
+
 
+@app.get("/ready")
+async def ready():
+    """
+    Readiness probe: 200 once the warehouse answers, the catalog is cached and the Gemini
+    client exists, 503 until then. Probes after a failed warm-up start another one.
+    """
+    is_ready = _is_ready()
+    if not is_ready:
+        _start_warm_up()
+    return JSONResponse(
+        {"ready": is_ready, "checks": _readiness["checks"], "startup_ms": _startup},
+        status_code=200 if is_ready else 503,
+    )
+
+
+@app.get("/jobs/{run_id}")
+async def get_job(run_id: int):
+    """
+    Status of a table-creation run started by /upload/:
+    {"status": "pending" | "running" | "succeeded" | "failed", "tables", ...}.
+    The tables are queryable once the status is "succeeded".
+    """
+    record = await asyncio.to_thread(job_tracker.status, run_id)
+    if record is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired run id.")
+    return record
+
+
+def _chain(*hooks):
+    """One post-run hook that calls each of `hooks` (None entries skipped) in order."""
+    hooks = [hook for hook in hooks if hook is not None]
+    if not hooks:
+        return None
+
+    def run():
+        for hook in hooks:
+            hook()
+    return run
 
 
 @app.post("/upload/")
-async def upload(file: UploadFile = File(...)):
+async def upload(
+    file: UploadFile = File(...),
+    callback_url: Optional[str] = Form(None),
+    mode: str = Form("overwrite"),
+    key_columns: Optional[str] = Form(None),
+):
     """
     Receives a CSV file, uploads it to Databricks, and triggers table creation.
+    The file is streamed from its spooled temporary file, never read fully into memory.
+    Poll /jobs/{run_id} for completion, or pass `callback_url` to receive the final
+    job status as a JSON POST.
+
+    With `mode=append`, a new version of an earlier upload only sends the rows the table
+    does not have yet and merges them in directly (`key_columns`, comma-separated, upserts
+    changed rows by key). The response then has "mode": "append" and no run. If the file
+    cannot be appended (first upload, changed header, edited rows without keys) it is
+    loaded in full as usual, with the reason in "append_skipped".
     """
     if not file.filename.endswith(".csv"):
         raise HTTPException(
             status_code=400, detail="Only CSV files are allowed."
         )
+    if callback_url is not None:
+        try:
+            # Allow-listed, public hosts only; resolving the host blocks.
+            await asyncio.to_thread(job_tracker.check_callback_url, callback_url)
+        except CallbackURLError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    if not is_valid_table_name(file.filename[:-len(".csv")]):
+        # The name becomes the table name and the file name in the Volume.
+        raise HTTPException(
+            status_code=400, detail="File names may only contain letters, digits, '_' and '-' before '.csv'."
+        )
+    if mode not in ("overwrite", "append"):
+        raise HTTPException(status_code=400, detail="mode must be 'overwrite' or 'append'.")
+    if file.size is not None and file.size > UPLOAD_MAX_BYTES:
+        raise HTTPException(
+            status_code=413, detail=f"File exceeds the {UPLOAD_MAX_BYTES}-byte upload limit."
+        )
 
+    trace = start_trace()
     try:
-        file_content = await file.read()
-
         timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
         databricks_file_name = f"{file.filename.replace('.csv', '')}.csv"
 
-        upload_success = upload_csv_to_databricks(
-            file_content, databricks_file_name
-        )
+        table_name = databricks_file_name.split(".")[0]
+        uploaded_path, profile, manifest, append_skipped = None, None, None, None
+
+        if mode == "append":
+            keys = [k.strip() for k in (key_columns or "").split(",") if k.strip()]
+            delta_name = f"{table_name}__append_{timestamp}_{uuid.uuid4().hex[:8]}.csv"
+            append = await asyncio.to_thread(append_csv_to_table, file.file, table_name, delta_name, keys)
+            if append["mode"] == "append":
+                return JSONResponse(
+                    status_code=200,
+                    content={
+                        "message": "New CSV rows merged into the table.",
+                        "mode": "append",
+                        "databricks_path": append["databricks_path"],
+                        "rows_merged": append["rows_merged"],
+                        "rows_total": append["rows_total"],
+                        "run_id": None,
+                        "status_url": None,
+                        "profile": None,
+                    },
+                    headers={"Server-Timing": trace.server_timing()},
+                )
+            print(f"Loading all of {file.filename}: {append['reason']}.")
+            manifest, append_skipped = append["manifest"], append["reason"]
+            file.file.seek(0)
+        else:
+            # A full load replaces whatever earlier appends were compared against.
+            await asyncio.to_thread(delete_append_manifest, table_name)
+
+        if UPLOAD_FORMAT == "parquet":
+            # Profile and convert locally so the job ingests typed Parquet instead of raw text.
+            try:
+                uploaded_path, profile = await asyncio.to_thread(
+                    upload_csv_as_parquet_to_databricks, file.file, databricks_file_name
+                )
+            except CsvConversionError as e:
+                print(f"Falling back to raw CSV upload for {file.filename}: {e}")
+                file.file.seek(0)
 
-        if not upload_success:
-            raise HTTPException(
-                status_code=500, detail="Failed to upload CSV to Databricks."
+        if uploaded_path is None:
+            # The SDK upload blocks, so it runs on a worker thread while chunks are piped through.
+            uploaded_path = await asyncio.to_thread(
+                upload_csv_stream_to_databricks, file.file, databricks_file_name
             )
 
-        run_id = trigger_csv_to_table(databricks_file_name.split(".")[0])
+        if profile is not None:
+            extra_parameters = {"file_format": "parquet"}
+        elif uploaded_path.endswith(".gz"):
+            extra_parameters = {"compression": "gzip"}
+        else:
+            extra_parameters = None
+        # Profile comments (and the manifest for later appends) are written once the run has created the table.
+        on_success = _chain(
+            functools.partial(save_append_manifest, table_name, manifest) if manifest is not None else None,
+            functools.partial(apply_profile_comments, table_name, file.filename, profile) if profile is not None else None,
+        )
+        # With JOB_BATCH_WINDOW set, this waits up to the window for other uploads to share the run.
+        run = await asyncio.to_thread(job_tracker.submit, table_name, extra_parameters, on_success, callback_url)
+        run_id = await asyncio.wrap_future(run)
 
         return JSONResponse(
             status_code=200,
             content={
                 "message": "CSV uploaded and table creation initiated successfully.",
-                "databricks_path": databricks_file_name,
-                "run_id": run_id
+                "mode": "overwrite",
+                "append_skipped": append_skipped,
+                "databricks_path": uploaded_path,
+                "run_id": run_id,
+                "status_url": f"/jobs/{run_id}" if run_id is not None else None,
+                "profile": profile
             },
+            headers={"Server-Timing": trace.server_timing()},
         )
+    except UploadTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except IncrementalUploadError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Internal server error: {e}")
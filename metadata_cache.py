@@ -0,0 +1,203 @@
+import os
+import time
+import threading
+from local_store import local_store
+
+
+class CatalogCache:
+    """
+    In-process cache for information_schema lookups: the table list and per-table schemas.
+
+    Entries expire after `ttl` seconds. A background thread can refresh them ahead of
+    expiry so the request path normally never waits on the warehouse, and `invalidate`
+    drops everything when the catalog is known to have changed (e.g. after an upload).
+    `version` is bumped on every invalidation so callers can key derived data on it.
+    `data_version` counts changes to a table's rows (reloads, appends), which leave its
+    schema and so the rest of the cache as it is.
+
+    With a `store` (see local_store.py), invalidations are counted there as a shared
+    generation; each worker process checks it at most every `sync_interval` seconds and
+    drops its own entries when another worker has invalidated.
+    """
+
+    def __init__(self, ttl: float = 300.0, store=None, sync_interval: float = 1.0):
+        self.ttl = ttl
+        self.store = store
+        self.sync_interval = sync_interval
+        self.version = 0
+        self._generation = 0
+        self._synced_at = float("-inf")
+        self._tables = None  # (tables, fetched_at)
+        self._schemas = {}   # table_name -> (schema, fetched_at)
+        self._all_schemas = None  # ({table_name: schema}, fetched_at)
+        self._data_versions = {}  # table_name -> count, without a store
+        self._lock = threading.Lock()
+        self._refresher = None
+        self._stop_refresher = threading.Event()
+
+    def _is_fresh(self, fetched_at: float) -> bool:
+        return time.monotonic() - fetched_at < self.ttl
+
+    def _sync(self):
+        """Applies invalidations made by other worker processes."""
+        now = time.monotonic()
+        if self.store is None or now - self._synced_at < self.sync_interval:
+            return
+        self._synced_at = now
+        try:
+            generation = self.store.counter("catalog_cache", "generation")
+        except Exception as e:
+            print(f"Could not read the shared catalog generation: {e}")
+            return
+        with self._lock:
+            if generation != self._generation:
+                self._generation = generation
+                self._drop(None)
+
+    def get_tables(self, loader) -> list:
+        """Returns the cached table list, calling `loader()` on a miss or after expiry."""
+        self._sync()
+        with self._lock:
+            entry, version = self._tables, self.version
+        if entry is not None and self._is_fresh(entry[1]):
+            return entry[0]
+
+        tables = loader()
+        with self._lock:
+            # Do not resurrect data loaded before a concurrent invalidation.
+            if version == self.version and tables:
+                self._tables = (tables, time.monotonic())
+        return tables
+
+    def get_schema(self, table_name: str, loader) -> list:
+        """Returns the cached schema for a table, calling `loader(table_name)` on a miss."""
+        self._sync()
+        with self._lock:
+            entry, version = self._schemas.get(table_name), self.version
+        if entry is not None and self._is_fresh(entry[1]):
+            return entry[0]
+
+        schema = loader(table_name)
+        with self._lock:
+            # Empty results are not cached: the table may be about to be created.
+            if version == self.version and schema:
+                self._schemas[table_name] = (schema, time.monotonic())
+        return schema
+
+    def get_all_schemas(self, loader) -> dict:
+        """Returns {table_name: schema} for the whole catalog, calling `loader()` on a miss."""
+        self._sync()
+        with self._lock:
+            entry, version = self._all_schemas, self.version
+        if entry is not None and self._is_fresh(entry[1]):
+            return entry[0]
+
+        schemas = loader()
+        now = time.monotonic()
+        with self._lock:
+            if version == self.version and schemas:
+                self._all_schemas = (schemas, now)
+                for name, schema in schemas.items():
+                    self._schemas[name] = (schema, now)
+        return schemas
+
+    def invalidate(self, table_name: str = None):
+        """Drops the table list and either one table's schema or all of them."""
+        with self._lock:
+            self._drop(table_name)
+        if self.store is not None:
+            try:
+                generation = self.store.increment("catalog_cache", "generation")
+            except Exception as e:
+                print(f"Could not share a catalog invalidation: {e}")
+                return
+            with self._lock:
+                # Other workers drop everything on a new generation; this one already dropped its part.
+                if generation == self._generation + 1:
+                    self._generation = generation
+
+    def data_version(self, table_name: str) -> int:
+        """Returns how often the table's data has changed; keys cached query results."""
+        table_name = table_name.lower()
+        if self.store is not None:
+            try:
+                return self.store.counter("data_version", table_name)
+            except Exception as e:
+                print(f"Could not read the data version of {table_name}: {e}")
+        with self._lock:
+            return self._data_versions.get(table_name, 0)
+
+    def bump_data_version(self, table_name: str):
+        """Marks the table's rows as changed, so results cached from them are no longer served."""
+        table_name = table_name.lower()
+        if self.store is not None:
+            try:
+                self.store.increment("data_version", table_name)
+                return
+            except Exception as e:
+                print(f"Could not share a data change of {table_name}: {e}")
+        with self._lock:
+            self._data_versions[table_name] = self._data_versions.get(table_name, 0) + 1
+
+    def _drop(self, table_name: str = None):
+        # Callers hold the lock.
+        self.version += 1
+        self._tables = None
+        self._all_schemas = None
+        if table_name is None:
+            self._schemas.clear()
+        else:
+            self._schemas.pop(table_name, None)
+
+    def refresh(self, tables_loader, schema_loader, all_schemas_loader=None):
+        """Reloads the table list and every cached schema, replacing entries in place."""
+        self._sync()
+        with self._lock:
+            version = self.version
+            cached_tables = list(self._schemas)
+            bulk = self._all_schemas is not None and all_schemas_loader is not None
+        tables = tables_loader()
+        if bulk:
+            all_schemas = all_schemas_loader()
+            schemas = {name: all_schemas.get(name, []) for name in cached_tables}
+        else:
+            schemas = {name: schema_loader(name) for name in cached_tables}
+
+        now = time.monotonic()
+        with self._lock:
+            if version != self.version:
+                return
+            if tables:
+                self._tables = (tables, now)
+            if bulk and all_schemas:
+                self._all_schemas = (all_schemas, now)
+            for name, schema in schemas.items():
+                if schema:
+                    self._schemas[name] = (schema, now)
+                else:
+                    self._schemas.pop(name, None)
+
+    def start_background_refresh(self, tables_loader, schema_loader, all_schemas_loader=None, interval: float = None):
+        """Starts a daemon thread that refreshes the cache before entries expire."""
+        if self._refresher is not None:
+            return
+        interval = interval or self.ttl / 2
+        stop = self._stop_refresher = threading.Event()
+
+        def _run():
+            while not stop.wait(interval):
+                try:
+                    self.refresh(tables_loader, schema_loader, all_schemas_loader)
+                except Exception as e:
+                    print(f"Background catalog refresh failed: {e}")
+
+        self._refresher = threading.Thread(target=_run, name="catalog-cache-refresh", daemon=True)
+        self._refresher.start()
+
+    def stop_background_refresh(self):
+        self._stop_refresher.set()
+        self._refresher = None
+
+
+# Shared by the visualization flow (reads) and the upload integration (invalidation).
+catalog_cache = CatalogCache(ttl=float(os.environ.get("CATALOG_CACHE_TTL", "300")), store=local_store)
@@ -0,0 +1,180 @@
+import os
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+from prometheus_client import Counter, Gauge, Histogram, CollectorRegistry, CONTENT_TYPE_LATEST, generate_latest
+
+# --- Prometheus Metrics ---
+# Process-wide, exposed on /metrics. Stage names are a small fixed set (see `timed` callers),
+# so label cardinality stays bounded. Under several workers PROMETHEUS_MULTIPROC_DIR is set
+# (see gunicorn.conf.py) and every worker's values are merged at scrape time.
+STAGE_SECONDS = Histogram(
+    "viz_stage_duration_seconds", "Time spent per pipeline stage.", ["stage"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80),
+)
+LLM_TOKENS = Histogram(
+    "viz_llm_tokens", "Tokens per LLM call.", ["step", "kind"],
+    buckets=(50, 100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000, 64000),
+)
+RESULT_ROWS = Histogram(
+    "viz_result_rows", "Rows returned by the warehouse per query.",
+    buckets=(0, 1, 10, 50, 100, 500, 1000, 5000, 10000, 50000, 100000),
+)
+RESULT_BYTES = Histogram(
+    "viz_result_bytes", "Arrow bytes returned by the warehouse per query.",
+    buckets=(1e3, 1e4, 1e5, 5e5, 1e6, 5e6, 1e7, 5e7, 1e8),
+)
+RESPONSE_BYTES = Histogram(
+    "viz_response_bytes", "Encoded response body size.", ["format"],
+    buckets=(1e3, 1e4, 1e5, 5e5, 1e6, 5e6, 1e7, 5e7),
+)
+UPLOAD_BYTES = Histogram(
+    "viz_upload_bytes", "Bytes written to the Volume per upload.", ["format"],
+    buckets=(1e4, 1e5, 1e6, 1e7, 1e8, 1e9, 5e9),
+)
+CACHE_LOOKUPS = Counter(
+    "viz_cache_lookups_total", "Cache lookups by cache and outcome.", ["cache", "outcome"]
+)
+COALESCED = Counter(
+    "viz_coalesced_total", "Calls that joined an identical in-flight computation.", ["stage"]
+)
+STARTUP_SECONDS = Gauge(
+    "viz_startup_seconds", "Seconds from the start of the API import to each start-up phase.", ["phase"],
+    multiprocess_mode="max",
+)
+
+
+# --- Per-Request Traces ---
+
+class RequestTrace:
+    """
+    Timings and counters for one request, filled in by the same calls that feed the
+    Prometheus metrics. Pipeline stages run on several tasks and threads, so updates
+    are locked. Repeated stages (e.g. two chart-choice calls) accumulate.
+    """
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self._stages = {}  # stage -> milliseconds
+        self._llm = {"calls": 0, "prompt_tokens": 0, "response_tokens": 0}
+        self._result = {"rows": 0, "bytes": 0}
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def add_stage(self, stage: str, seconds: float):
+        with self._lock:
+            self._stages[stage] = self._stages.get(stage, 0.0) + seconds * 1000
+
+    def add_llm_call(self, prompt_tokens: int, response_tokens: int):
+        with self._lock:
+            self._llm["calls"] += 1
+            self._llm["prompt_tokens"] += prompt_tokens
+            self._llm["response_tokens"] += response_tokens
+
+    def add_result(self, rows: int, nbytes: int):
+        with self._lock:
+            self._result["rows"] += rows
+            self._result["bytes"] += nbytes
+
+    def set_cache(self, cache: str, outcome: str):
+        with self._lock:
+            self._cache[cache] = outcome
+
+    def to_dict(self) -> dict:
+        """{"total_ms", "stages_ms", "llm", "result", "cache"} for the response `timings` field."""
+        with self._lock:
+            return {
+                "total_ms": round((time.perf_counter() - self.started_at) * 1000, 1),
+                "stages_ms": {k: round(v, 1) for k, v in self._stages.items()},
+                "llm": dict(self._llm),
+                "result": dict(self._result),
+                "cache": dict(self._cache),
+            }
+
+    def server_timing(self) -> str:
+        """Value for a Server-Timing header, readable in the browser's network panel."""
+        timings = self.to_dict()
+        entries = [f"{stage};dur={ms}" for stage, ms in timings["stages_ms"].items()]
+        entries.append(f"total;dur={timings['total_ms']}")
+        return ", ".join(entries)
+
+
+_current_trace = contextvars.ContextVar("request_trace", default=None)
+
+
+def start_trace() -> RequestTrace:
+    """
+    Starts a trace for the current request. Tasks and worker threads started afterwards
+    inherit it through the context, so flow code never has to pass it around.
+    """
+    trace = RequestTrace()
+    _current_trace.set(trace)
+    return trace
+
+
+def current_trace() -> RequestTrace:
+    return _current_trace.get()
+
+
+# --- Recording Helpers ---
+
+@contextmanager
+def timed(stage: str):
+    """Times the block into the stage histogram and the current request's trace."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.labels(stage).observe(elapsed)
+        if (trace := _current_trace.get()) is not None:
+            trace.add_stage(stage, elapsed)
+
+
+def record_llm_usage(step: str, response):
+    """Records prompt and response token counts from a Gemini response's usage metadata."""
+    usage = getattr(response, "usage_metadata", None)
+    prompt_tokens = (getattr(usage, "prompt_token_count", None) or 0) if usage else 0
+    response_tokens = (getattr(usage, "candidates_token_count", None) or 0) if usage else 0
+    LLM_TOKENS.labels(step, "prompt").observe(prompt_tokens)
+    LLM_TOKENS.labels(step, "response").observe(response_tokens)
+    if (trace := _current_trace.get()) is not None:
+        trace.add_llm_call(prompt_tokens, response_tokens)
+
+
+def record_result(table):
+    """Records the size of a warehouse result table."""
+    RESULT_ROWS.observe(table.num_rows)
+    RESULT_BYTES.observe(table.nbytes)
+    if (trace := _current_trace.get()) is not None:
+        trace.add_result(table.num_rows, table.nbytes)
+
+
+def record_cache(cache: str, outcome: str):
+    """Counts a cache lookup, e.g. record_cache("plan", "similar")."""
+    CACHE_LOOKUPS.labels(cache, outcome).inc()
+    if (trace := _current_trace.get()) is not None:
+        trace.set_cache(cache, outcome)
+
+
+def record_coalesced(stage: str):
+    """Counts a call that shared another request's in-flight result for `stage`."""
+    COALESCED.labels(stage).inc()
+    if (trace := _current_trace.get()) is not None:
+        trace.set_cache(f"{stage}_in_flight", "shared")
+
+
+def record_startup(phase: str, seconds: float):
+    """Records when a start-up phase ("imported", "serving", "ready") was reached."""
+    STARTUP_SECONDS.labels(phase).set(seconds)
+
+
+def render_metrics() -> tuple[bytes, str]:
+    """Returns (body, content type) for the /metrics endpoint."""
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -0,0 +1,61 @@
+import time
+import uuid
+import threading
+
+
+class PendingResults:
+    """
+    Registry of results that are computed after the response has been sent, such as
+    deferred insights. Each entry is addressed by a random request id and expires `ttl`
+    seconds after it was created. With a `store` (see local_store.py) entries are kept
+    there instead of in memory, so any worker process can answer the poll.
+    """
+
+    NAMESPACE = "pending_results"
+
+    def __init__(self, ttl: float = 900.0, store=None):
+        self.ttl = ttl
+        self.store = store
+        self._entries = {}  # request_id -> {"status", "result", "error", "created_at"}
+        self._lock = threading.Lock()
+
+    def create(self) -> str:
+        request_id = uuid.uuid4().hex
+        if self.store is not None:
+            self.store.put(self.NAMESPACE, request_id, {"status": "pending", "result": None, "error": None}, self.ttl)
+            return request_id
+        with self._lock:
+            self._sweep()
+            self._entries[request_id] = {
+                "status": "pending", "result": None, "error": None, "created_at": time.time()
+            }
+        return request_id
+
+    def resolve(self, request_id: str, result):
+        self._update(request_id, status="ready", result=result)
+
+    def fail(self, request_id: str, error: str):
+        self._update(request_id, status="failed", error=error)
+
+    def get(self, request_id: str):
+        """Returns {"status", "result", "error"} or None for unknown or expired ids."""
+        if self.store is not None:
+            return self.store.get(self.NAMESPACE, request_id)
+        with self._lock:
+            entry = self._entries.get(request_id)
+            if entry is None or time.time() - entry["created_at"] > self.ttl:
+                return None
+            return {k: entry[k] for k in ("status", "result", "error")}
+
+    def _update(self, request_id: str, **fields):
+        if self.store is not None:
+            self.store.update(self.NAMESPACE, request_id, **fields)
+            return
+        with self._lock:
+            if request_id in self._entries:
+                self._entries[request_id].update(fields)
+
+    def _sweep(self):
+        cutoff = time.time() - self.ttl
+        for request_id in [k for k, v in self._entries.items() if v["created_at"] < cutoff]:
+            del self._entries[request_id]
@@ -0,0 +1,102 @@
+import os
+import time
+import asyncio
+
+
+class StageTimeoutError(TimeoutError):
+    """Raised when a single pipeline stage runs past its own timeout."""
+
+
+class LatencyBudgetExceeded(TimeoutError):
+    """Raised when a request runs past its overall latency budget."""
+
+
+def stage_timeout(stage_name: str, default: float) -> float:
+    """Per-stage timeout in seconds; override with STAGE_TIMEOUT_<NAME>, 0 disables it."""
+    value = float(os.environ.get(f"STAGE_TIMEOUT_{stage_name.upper()}", default))
+    return value or None
+
+
+class Deadline:
+    """Wall-clock budget shared by every stage of one request; `budget=None` never expires."""
+
+    def __init__(self, budget: float = None):
+        self.budget = budget
+        self.expires_at = time.monotonic() + budget if budget else None
+
+    def remaining(self) -> float:
+        if self.expires_at is None:
+            return None
+        return max(self.expires_at - time.monotonic(), 0.0)
+
+
+class Pipeline:
+    """
+    Small DAG executor for the request flow. Each stage is an async callable that receives
+    the results of the stages it runs `after` as keyword arguments; stages whose
+    dependencies are done run concurrently as asyncio tasks.
+
+    A stage is bounded by its own timeout and by the request's Deadline. The first failure
+    or timeout cancels every stage still running, so nothing keeps working for a request
+    that has already failed. Work already handed to a thread cannot be interrupted; stages
+    that need that (e.g. a warehouse query) handle CancelledError themselves.
+    """
+
+    def __init__(self, deadline: Deadline = None):
+        self.deadline = deadline or Deadline()
+        self._stages = {}  # name -> (fn, after, timeout)
+
+    def stage(self, name: str, fn, after=(), timeout: float = None) -> "Pipeline":
+        """Adds a stage; its dependencies must already be registered. Returns self for chaining."""
+        if name in self._stages:
+            raise ValueError(f"Stage '{name}' is already defined.")
+        missing = [dep for dep in after if dep not in self._stages]
+        if missing:
+            raise ValueError(f"Stage '{name}' depends on unknown stage(s): {', '.join(missing)}.")
+        self._stages[name] = (fn, tuple(after), timeout)
+        return self
+
+    async def _run_stage(self, name: str, tasks: dict):
+        fn, after, timeout = self._stages[name]
+        results = await asyncio.gather(*(tasks[dep] for dep in after))
+
+        remaining = self.deadline.remaining()
+        if remaining == 0:
+            raise LatencyBudgetExceeded(f"Latency budget of {self.deadline.budget}s exhausted before stage '{name}'.")
+        bound = min((t for t in (timeout, remaining) if t is not None), default=None)
+        try:
+            async with asyncio.timeout(bound) as scope:
+                return await fn(**dict(zip(after, results)))
+        except TimeoutError:
+            # Only this bound running out is a stage or budget timeout; a TimeoutError raised
+            # by the stage itself (e.g. waiting for a pooled connection) keeps its own message.
+            if not scope.expired():
+                raise
+            if bound == timeout:
+                raise StageTimeoutError(f"Stage '{name}' timed out after {timeout}s.") from None
+            raise LatencyBudgetExceeded(
+                f"Latency budget of {self.deadline.budget}s exhausted during stage '{name}'."
+            ) from None
+
+    async def run_iter(self):
+        """Runs the DAG and yields (stage_name, result) pairs in completion order."""
+        tasks = {}
+        for name in self._stages:
+            tasks[name] = asyncio.ensure_future(self._run_stage(name, tasks))
+        order = {task: (i, name) for i, (name, task) in enumerate(tasks.items())}
+        pending = set(tasks.values())
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                # Stages finishing in the same wakeup are reported in registration order.
+                for task in sorted(done, key=order.get):
+                    yield order[task][1], task.result()
+        finally:
+            # Runs on failure, timeout, and when the consumer stops early (e.g. a client disconnect).
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+
+    async def run(self) -> dict:
+        """Runs the DAG to completion and returns {stage_name: result}."""
+        return {name: result async for name, result in self.run_iter()}
@@ -1,204 +1,263 @@
 import os
-from dotenv import load_dotenv
-import databricks.sql
-from google import genai
-import json
-
-# Load all environment variables
-load_dotenv()
-
-# --- Connection and API Setup ---
-DB_HOST = os.environ.get('DB_SERVER_HOSTNAME')
-DB_PATH = os.environ.get('DB_HTTP_PATH')
-DB_TOKEN = os.environ.get('DB_ACCESS_TOKEN')
-DB_CATALOG = os.environ.get('DB_CATALOG')
-DB_SCHEMA = os.environ.get('DB_SCHEMA')
-
-client = genai.Client()
-
-# --- Constants ---
-CHART_TYPES = [
-    "bar-funnel", "boxplot", "error-bars",
-    "financial", "funnel", "geo",
-    "graph", "matrix", "pcp",
-    "sankey", "smith", "stacked100",
-    "treemap", "venn", "word-cloud"
-]
-
-# --- Helper Functions (Mostly Unchanged) ---
-def get_table_schema(table_name: str, connection):
-    """Retrieves schema for a specific table using an existing connection."""
-    with connection.cursor() as cursor:
-        cursor.execute(
-            f"""
-            SELECT column_name, data_type
-            FROM {DB_CATALOG}.information_schema.columns
-            WHERE table_schema = '{DB_SCHEMA}' AND table_name = '{table_name}'
-            ORDER BY ordinal_position
-            """
-        )
-        return [{"column_name": r[0], "data_type": r[1]} for r in cursor.fetchall()]
-
-def get_all_tables_metadata(connection):
-    """Retrieves metadata for all tables using an existing connection."""
-    with connection.cursor() as cursor:
-        cursor.execute(
-            f"""
-            SELECT table_name, comment
-            FROM {DB_CATALOG}.information_schema.tables
-            WHERE table_schema = '{DB_SCHEMA}'
-            ORDER BY table_name
-            """
-        )
-        return [
-            {"table_name": r[0], "description": r[1] if r[1] else "No description available."}
-            for r in cursor.fetchall()
-        ]
-
-# --- NEW: LLM-Powered Functions ---
-
-def choose_visualization(user_query: str, schema: list) -> dict:
+import time
+import hashlib
+import asyncio
+import threading
+from functools import lru_cache
+from collections import OrderedDict
+from typing import NamedTuple
+from charts import enabled_chart_types
+
+
+# --- Templates ---
+
+class PromptTemplate:
     """
-    Uses an LLM to choose the best visualization type based on the user query and table schema.
-    
-    Returns:
-        A dictionary like {"type": "scatter", "justification": "..."}
+    A prompt split into a static prefix, rendered once when the template is built, and a
+    `str.format` body filled in per request. The prefix always comes first, so identical
+    prefixes are shared across requests by Gemini's prompt caching (see ContextCache).
     """
-    schema_str = "\n".join([f"- {col['column_name']} ({col['data_type']})" for col in schema])
-    
-    llm_instruction = (
+
+    def __init__(self, name: str, instructions: str, body: str):
+        self.name = name
+        self.prefix = f"{instructions}\n\n"
+        self.body = body
+        self.digest = hashlib.sha256(self.prefix.encode()).hexdigest()[:16]
+
+    def render(self, **fields) -> "Prompt":
+        return Prompt(self, self.body.format(**fields))
+
+
+class Prompt(NamedTuple):
+    template: PromptTemplate
+    suffix: str
+
+    @property
+    def text(self) -> str:
+        return self.template.prefix + self.suffix
+
+
+TABLE_SELECTION = PromptTemplate(
+    "table_selection",
+    "The user will inquire and ask to visualize some type of data. "
+    "You will be given a list of table names along with their description and, when available, their columns. "
+    "You are supposed to pick the most relevant table, and strictly return only the name. "
+    "DO NOT return anything but the name of the most relevant table.",
+    "user query: {user_query}\n\ntable(s):\n{table_info}",
+)
+
+SQL_GENERATION = PromptTemplate(
+    "sql_generation",
+    "You are a Databricks SQL expert. Your goal is to write a SINGLE SQL query to fetch data that can be used to create a specified visualization. "
+    "The query should be tailored to the user's request.\n"
+    "IMPORTANT RULES:\n"
+    "1. If a necessary column doesn't exist but can be derived from existing columns (e.g., extracting a year from a date, creating a price category), "
+    "you MUST generate it on-the-fly using a Common Table Expression (CTE) with a `WITH` clause.\n"
+    "2. DO NOT use `CREATE TABLE` or any other DDL statements. The query must only read data.\n"
+    "3. Your response must be ONLY the raw SQL query. Do not include any explanations, comments, or markdown formatting like ```sql.",
+    "--- CONTEXT ---\n"
+    "User Query: \"{user_query}\"\n"
+    "Table to Query: {table}\n"
+    "Chosen Visualization: {chart_type} (Justification: {justification})\n"
+    "Required Data Shape: {data_shape}\n"
+    "Available Columns:\n{columns}\n"
+    "{rollups}"
+    "--- END CONTEXT ---\n\n"
+    "SQL Query:",
+)
+
+INSIGHTS = PromptTemplate(
+    "insights",
+    "You are a helpful data analyst. Your task is to provide a brief, human-readable insight based on a user's query, the chosen visualization, and a sample of the resulting data. "
+    "The insight should be a short observation about patterns, trends, or notable points in the data. "
+    "Focus on what the data reveals in the context of the user's question. "
+    "Your response should be a single, concise string of one or two sentences. Do not add any other text or explanation.",
+    "--- CONTEXT ---\n"
+    "Original User Query: \"{user_query}\"\n"
+    "Chosen Visualization: {chart_type}\n"
+    "Justification for Chart: {justification}\n"
+    "--- DATA SAMPLE (first {sample_rows} rows) ---\n"
+    "{data}\n"
+    "--- END CONTEXT ---\n\n"
+    "Insight:",
+)
+
+
+def _chart_catalog(charts: tuple) -> str:
+    return "\n".join(f"- {chart.name}: {chart.data_shape}" for chart in charts)
+
+
+@lru_cache(maxsize=8)
+def _visualization_template(charts: tuple) -> PromptTemplate:
+    return PromptTemplate(
+        "chart_choice",
         "You are an expert data analyst. Your task is to recommend the best chart type to answer a user's question "
         "based on the available data columns. You must choose exactly one type from the provided list.\n"
-        f"Available chart types: {', '.join(CHART_TYPES)}\n"
+        f"Available chart types and the data each one needs:\n{_chart_catalog(charts)}\n"
         "Your response MUST be a single, valid JSON object with two keys: 'type' and 'justification'. "
-        "Do not add any other text, explanation, or markdown formatting outside of the JSON object."
-        "Do not refer to the user or their specific query. Frame it as a general best practice."
-
-    )
-    
-    final_prompt = (
-        f"{llm_instruction}\n\n"
-        f"User Query: \"{user_query}\"\n\n"
-        f"Available Columns:\n{schema_str}"
-    )
-    
-    response = client.models.generate_content(
-        model="gemini-2.5-flash",
-        contents=final_prompt
-    )
-    
-    try:
-        # Clean up potential markdown formatting from the LLM response
-        cleaned_response = response.text.strip().replace("```json", "").replace("```", "").strip()
-        return json.loads(cleaned_response)
-    except (json.JSONDecodeError, AttributeError) as e:
-        print(f"Error decoding JSON from LLM for visualization choice: {e}")
-        raise ValueError("LLM failed to return a valid JSON for visualization type.")
-
-def generate_and_execute_sql(user_query: str, schema: list, viz_info: dict, table_name: str, connection) -> list:
-    """
-    Uses an LLM to generate a Databricks SQL query and then executes it.
-    The LLM is instructed to create new columns on-the-fly using CTEs if needed.
-    
-    Returns:
-        A list of dictionaries representing the query results.
-    """
-    schema_str = "\n".join([f"- {col['column_name']} ({col['data_type']})" for col in schema])
-    
-    llm_instruction = (
-        "You are a Databricks SQL expert. Your goal is to write a SINGLE SQL query to fetch data that can be used to create a specified visualization. "
-        "The query should be tailored to the user's request.\n"
-        "IMPORTANT RULES:\n"
-        "1. If a necessary column doesn't exist but can be derived from existing columns (e.g., extracting a year from a date, creating a price category), "
-        "you MUST generate it on-the-fly using a Common Table Expression (CTE) with a `WITH` clause.\n"
-        "2. DO NOT use `CREATE TABLE` or any other DDL statements. The query must only read data.\n"
-        "3. Your response must be ONLY the raw SQL query. Do not include any explanations, comments, or markdown formatting like ```sql."
-    )
-    
-    final_prompt = (
-        f"{llm_instruction}\n\n"
-        f"--- CONTEXT ---\n"
-        f"User Query: \"{user_query}\"\n"
-        f"Table to Query: `{DB_CATALOG}`.`{DB_SCHEMA}`.`{table_name}`\n"
-        f"Chosen Visualization: {viz_info['type']} (Justification: {viz_info['justification']})\n"
-        f"Available Columns:\n{schema_str}\n"
-        f"--- END CONTEXT ---\n\n"
-        f"SQL Query:"
+        "Do not add any other text, explanation, or markdown formatting outside of the JSON object. "
+        "Do not refer to the user or their specific query. Frame it as a general best practice.",
+        "User Query: \"{user_query}\"\n\nAvailable Columns:\n{columns}",
     )
 
-    response = client.models.generate_content(
-        model="gemini-2.5-flash",
-        contents=final_prompt
+
+@lru_cache(maxsize=8)
+def _planner_template(charts: tuple, catalog: str, schema: str) -> PromptTemplate:
+    return PromptTemplate(
+        "single_shot_plan",
+        "You are an expert data analyst and Databricks SQL expert. Given a user's request and a catalog of tables, "
+        "produce a complete visualization plan in one step:\n"
+        "1. 'table_name': the single most relevant table, copied exactly from the catalog.\n"
+        "2. 'type': the best chart type, exactly one of the following, each listed with the data it needs:\n"
+        f"{_chart_catalog(charts)}\n"
+        "3. 'justification': why this chart type fits the data, framed as a general best practice "
+        "without referring to the user or their specific query.\n"
+        "4. 'sql': a SINGLE read-only SQL query against "
+        f"`{catalog}`.`{schema}`.`<table_name>` that fetches the data for the chart in the shape it needs. "
+        "Derive missing columns with a Common Table Expression (`WITH` clause) if needed. "
+        "Never use DDL statements such as `CREATE TABLE`.\n"
+        "Your response MUST be a single JSON object with exactly these four keys.",
+        "User Query: \"{user_query}\"\n\nCatalog:\n{table_info}",
     )
-    
-    generated_sql = response.text.strip()
-    
-    print(f"Executing Generated SQL:\n{generated_sql}") # For debugging
-    
-    with connection.cursor() as cursor:
-        cursor.execute(generated_sql)
-        # fetchall_arrow().to_pylist() is an efficient way to get a list of dicts
-        rows = cursor.fetchall()
-        columns = [desc[0] for desc in cursor.description]
-        results = [dict(zip(columns, row)) for row in rows]
-    
-    return results
-
-# --- Core Orchestration Logic ---
-
-def _select_table_and_get_schema(user_query: str, connection) -> tuple[list, str]:
+
+
+def visualization_template() -> PromptTemplate:
+    """Chart-choice template for the enabled chart types; rebuilt only if the registry changes."""
+    return _visualization_template(tuple(enabled_chart_types()))
+
+
+def planner_template(catalog: str, schema: str) -> PromptTemplate:
+    """Single-shot planner template for the enabled chart types and the target schema."""
+    return _planner_template(tuple(enabled_chart_types()), catalog, schema)
+
+
+# --- Schema Blocks ---
+
+class SchemaBlocks:
     """
-    First step: Gathers metadata, calls LLM to select a table, and gets its schema.
-    Returns a tuple of (schema, selected_table_name).
+    Rendered column listings per table, reused until the table's schema changes.
+    The catalog cache hands out the same schema lists between refreshes, so the
+    identity check almost always short-circuits the comparison.
     """
-    table_metadata = get_all_tables_metadata(connection)
-    if not table_metadata:
-        raise ValueError(f"No tables found in {DB_CATALOG}.{DB_SCHEMA}.")
-
-    table_context_list = [
-        f"Table Name: {meta['table_name']}\nDescription: {meta['description']}"
-        for meta in table_metadata
-    ]
-    table_info = "\n---\n".join(table_context_list)
-    
-    llm_instruction = (
-        "The user will inquire and ask to visualize some type of data. "
-        "You will be given a list of table names along with their description. "
-        "You are supposed to pick the most relevant table, and strictly return only the name. "
-        "DO NOT return anything but the name of the most relevant table."
-    )
-    final_prompt = f"{llm_instruction}\n\nuser query: {user_query}\n\ntable(s):\n{table_info}"
-    
-    response = client.models.generate_content(model="gemini-2.5-flash", contents=final_prompt)
-    selected_table = response.text.strip()
-    
-    schema_data = get_table_schema(selected_table, connection)
-    if not schema_data:
-        raise LookupError(f"Table '{selected_table}' was selected by LLM but not found.")
 
-    return schema_data, selected_table
+    def __init__(self, max_entries: int = 512):
+        self.max_entries = max_entries
+        self._blocks = OrderedDict()  # table -> (schema, {"columns": str, "names": str})
+        self._lock = threading.Lock()
+
+    def _get(self, table_name: str, schema: list) -> dict:
+        with self._lock:
+            entry = self._blocks.get(table_name)
+            if entry is not None and (entry[0] is schema or entry[0] == schema):
+                self._blocks.move_to_end(table_name)
+                return entry[1]
+
+        blocks = {
+            "columns": "\n".join(f"- {col['column_name']} ({col['data_type']})" for col in schema),
+            "names": ", ".join(col['column_name'] for col in schema),
+        }
+        with self._lock:
+            self._blocks[table_name] = (schema, blocks)
+            self._blocks.move_to_end(table_name)
+            while len(self._blocks) > self.max_entries:
+                self._blocks.popitem(last=False)
+        return blocks
+
+    def columns(self, table_name: str, schema: list) -> str:
+        """One "- name (type)" line per column."""
+        return self._get(table_name, schema)["columns"]
+
+    def names(self, table_name: str, schema: list) -> str:
+        """Comma-separated column names."""
+        return self._get(table_name, schema)["names"]
+
+
+schema_blocks = SchemaBlocks()
 
 
-def generate_visualization_from_query(user_query: str) -> dict:
+# --- Gemini Context Caching ---
+
+class ContextCache:
     """
-    Executes the full Text-to-Visualization chain.
+    Explicit Gemini context caches for template prefixes, so repeated requests send and
+    pay full price only for the per-request suffix.
+
+    Gemini only caches content above a minimum size (about 1024 tokens for Flash), so
+    prefixes shorter than `min_chars` are always sent inline; they still benefit from
+    Gemini's implicit prefix caching. A cache that cannot be created is retried after
+    `ttl`, and the prompt is sent in full meanwhile.
     """
-    # Use a single connection for the entire process for efficiency
-    with databricks.sql.connect(server_hostname=DB_HOST, http_path=DB_PATH, access_token=DB_TOKEN) as connection:
-        
-        # 1. Select the relevant table and get its schema
-        schema, table_name = _select_table_and_get_schema(user_query, connection)
-        
-        # 2. Choose the best visualization type
-        viz_info = choose_visualization(user_query, schema)
-        
-        # 3. Generate and execute the SQL to get the data
-        data = generate_and_execute_sql(user_query, schema, viz_info, table_name, connection)
-
-    # 4. Assemble the final response object
-    final_output = {
-        "visualization": viz_info,
-        "data": data
-    }
-    
-    return final_output
\ No newline at end of file
+
+    def __init__(self, enabled: bool = False, ttl: float = 3600.0, min_chars: int = 4096):
+        self.enabled = enabled
+        self.ttl = ttl
+        self.min_chars = min_chars
+        self._entries = {}  # (model, digest) -> (cache name or None, valid until)
+        self._lock = threading.Lock()
+
+    def _lookup(self, key: tuple):
+        """(found, cache name); found is False when the cache should be (re)created."""
+        entry = self._entries.get(key)
+        if entry is None or time.monotonic() >= entry[1]:
+            return False, None
+        return True, entry[0]
+
+    def _create(self, client, model: str, template: PromptTemplate):
+        key = (model, template.digest)
+        with self._lock:
+            found, name = self._lookup(key)
+            if found:
+                return name
+            from google.genai import types
+            try:
+                cache = client.caches.create(
+                    model=model,
+                    config=types.CreateCachedContentConfig(
+                        contents=[template.prefix], display_name=template.name, ttl=f"{int(self.ttl)}s"
+                    ),
+                )
+                name = cache.name
+            except Exception as e:
+                print(f"Could not create a context cache for the {template.name} prompt: {e}")
+                name = None
+            # Stop using a cache a minute before Gemini expires it.
+            self._entries[key] = (name, time.monotonic() + max(self.ttl - 60, 1))
+            return name
+
+    def _apply(self, prompt: Prompt, config, name: str):
+        if name is None:
+            return prompt.text, config
+        from google.genai import types
+        if config is None:
+            return prompt.suffix, types.GenerateContentConfig(cached_content=name)
+        return prompt.suffix, config.model_copy(update={"cached_content": name})
+
+    def _eligible(self, prompt: Prompt) -> bool:
+        return self.enabled and len(prompt.template.prefix) >= self.min_chars
+
+    def prepare(self, client, model: str, prompt: Prompt, config=None):
+        """Returns (contents, config) for `generate_content`, using a cached prefix when possible."""
+        if not self._eligible(prompt):
+            return prompt.text, config
+        found, name = self._lookup((model, prompt.template.digest))
+        if not found:
+            name = self._create(client, model, prompt.template)
+        return self._apply(prompt, config, name)
+
+    async def prepare_async(self, client, model: str, prompt: Prompt, config=None):
+        """Async version of `prepare`; cache creation runs on a worker thread."""
+        if not self._eligible(prompt):
+            return prompt.text, config
+        found, name = self._lookup((model, prompt.template.digest))
+        if not found:
+            name = await asyncio.to_thread(self._create, client, model, prompt.template)
+        return self._apply(prompt, config, name)
+
+
+def create_context_cache_from_env() -> ContextCache:
+    """Builds the cache from PROMPT_CONTEXT_CACHE, PROMPT_CONTEXT_CACHE_TTL and PROMPT_CONTEXT_CACHE_MIN_CHARS."""
+    return ContextCache(
+        enabled=os.environ.get("PROMPT_CONTEXT_CACHE", "false").lower() == "true",
+        ttl=float(os.environ.get("PROMPT_CONTEXT_CACHE_TTL", "3600")),
+        min_chars=int(os.environ.get("PROMPT_CONTEXT_CACHE_MIN_CHARS", "4096")),
+    )
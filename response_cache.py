@@ -0,0 +1,322 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import datetime
+import decimal
+import threading
+from collections import OrderedDict
+import numpy as np
+from serialization import to_arrow_ipc, from_arrow_ipc
+
+# --- Query Normalization and Embedding ---
+
+EMBEDDING_DIMS = 1024
+
+# Filler words that change phrasing but not which data is being asked for. Words that
+# compare or give a direction ("over", "per", "vs", "from") are never filler.
+STOPWORDS = frozenset("""
+a an the of for in on by across and with as at is are was were be
+me my our show display give get plot chart graph visualize visualise what which how please can
+you i we all each every do does
+""".split())
+
+# Comparison, direction and ordering words. Two queries that differ in any of these (or in
+# a number) ask for different data however similar they look, so a fuzzy hit must match them.
+GUARD_WORDS = frozenset("""
+over under above below more less fewer greater than least most top bottom highest lowest
+max min maximum minimum before after since until from to between per vs versus not no
+without except excluding exclude only first last ascending descending asc desc increase
+decrease increasing decreasing growth decline
+""".split())
+
+
+def normalize_query(query: str) -> str:
+    """Lowercases, strips punctuation and collapses whitespace so trivial variants share a key."""
+    query = re.sub(r"[^\w\s]", " ", query.lower())
+    return " ".join(query.split())
+
+
+def _stable_hash(token: str) -> int:
+    # Python's hash() is salted per process; cached vectors must stay comparable across restarts.
+    return int.from_bytes(hashlib.blake2b(token.encode(), digest_size=8).digest(), "little")
+
+
+def embed_query(query: str, dims: int = EMBEDDING_DIMS) -> np.ndarray:
+    """
+    Embeds a query as an L2-normalized hashed bag of words, word bigrams and character
+    trigrams, ignoring filler words. Cheap and local, yet close enough for paraphrases
+    such as "sales by region" vs. "plot the sales by region".
+    """
+    words = [w for w in normalize_query(query).split() if w not in STOPWORDS]
+    features = list(words)
+    features += [f"{a} {b}" for a, b in zip(words, words[1:])]
+    for word in words:
+        padded = f" {word} "
+        features += [padded[i:i + 3] for i in range(len(padded) - 2)]
+
+    vector = np.zeros(dims, dtype=np.float32)
+    for feature in features:
+        h = _stable_hash(feature)
+        vector[h % dims] += 1.0 if (h >> 32) & 1 else -1.0
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def _guard_tokens(query: str) -> list:
+    """
+    Normalized numbers and comparison words of a query. "top 5" and "top 10", or "orders
+    over 100" and "orders under 100", embed almost identically but must never share a plan.
+    """
+    numbers = [repr(float(n)) for n in re.findall(r"\d+(?:\.\d+)?", query)]
+    words = [w for w in normalize_query(query).split() if w in GUARD_WORDS]
+    return sorted(numbers + words)
+
+
+def _json_default(value):
+    # Mirror FastAPI's encoding so cached payloads look the same as fresh ones.
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if isinstance(value, (datetime.date, datetime.datetime, datetime.time)):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _dumps(value) -> bytes:
+    return json.dumps(value, default=_json_default).encode()
+
+
+# --- Backends ---
+# Both backends store opaque bytes under a key, with an expiry, an optional namespace and
+# an optional embedding vector used by `nearest`. Eviction is least-recently-used once
+# either the entry count or the total stored bytes exceed their limits.
+
+class MemoryBackend:
+    """Process-local LRU store."""
+
+    def __init__(self, max_entries: int = 1024, max_bytes: int = 64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (value, expires_at, namespace, vector)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] < time.time():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key: str, value: bytes, ttl: float, namespace: str = None, vector: np.ndarray = None):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, time.time() + ttl, namespace, vector)
+            self._bytes += len(value)
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+
+    def nearest(self, namespace: str, vector: np.ndarray):
+        """Returns (key, similarity) of the closest live vector in a namespace, or None."""
+        now = time.time()
+        with self._lock:
+            candidates = [
+                (key, entry[3]) for key, entry in self._entries.items()
+                if entry[2] == namespace and entry[3] is not None and entry[1] >= now
+            ]
+        if not candidates:
+            return None
+        scores = np.stack([v for _, v in candidates]) @ vector
+        best = int(np.argmax(scores))
+        return candidates[best][0], float(scores[best])
+
+    def _remove(self, key: str):
+        value = self._entries.pop(key)[0]
+        self._bytes -= len(value)
+
+
+class SQLiteBackend:
+    """On-disk LRU store; survives restarts and can be shared by workers on one host."""
+
+    def __init__(self, path: str, max_entries: int = 10000, max_bytes: int = 512 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                namespace TEXT,
+                value BLOB NOT NULL,
+                vector BLOB,
+                size INTEGER NOT NULL,
+                expires_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS entries_namespace ON entries (namespace)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access)")
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, expires_at FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if row[1] < now:
+                self._conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                return None
+            self._conn.execute("UPDATE entries SET last_access = ? WHERE key = ?", (now, key))
+            return row[0]
+
+    def set(self, key: str, value: bytes, ttl: float, namespace: str = None, vector: np.ndarray = None):
+        now = time.time()
+        blob = vector.astype(np.float32).tobytes() if vector is not None else None
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, namespace, value, blob, len(value), now + ttl, now),
+            )
+            self._evict(now)
+
+    def nearest(self, namespace: str, vector: np.ndarray):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT key, vector FROM entries WHERE namespace = ? AND vector IS NOT NULL AND expires_at >= ?",
+                (namespace, time.time()),
+            ).fetchall()
+        if not rows:
+            return None
+        matrix = np.frombuffer(b"".join(r[1] for r in rows), dtype=np.float32).reshape(len(rows), -1)
+        scores = matrix @ vector
+        best = int(np.argmax(scores))
+        return rows[best][0], float(scores[best])
+
+    def _evict(self, now: float):
+        self._conn.execute("DELETE FROM entries WHERE expires_at < ?", (now,))
+        count, total = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        if count <= self.max_entries and total <= self.max_bytes:
+            return
+        # Walk from the least recently used entry until both limits are met again.
+        doomed = []
+        for key, size in self._conn.execute("SELECT key, size FROM entries ORDER BY last_access"):
+            if count <= self.max_entries and total <= self.max_bytes:
+                break
+            doomed.append((key,))
+            count -= 1
+            total -= size
+        self._conn.executemany("DELETE FROM entries WHERE key = ?", doomed)
+
+
+# --- Response Cache ---
+
+class ResponseCache:
+    """
+    Caches visualization plans (table, viz_info, SQL) and, with a shorter TTL, query results.
+
+    Plans are keyed by the normalized query plus a catalog fingerprint, so any schema
+    change misses naturally. On an exact miss, the closest cached query under the same
+    fingerprint is reused if its embedding similarity clears `similarity_threshold`.
+    Results (an Arrow table plus metadata such as insights) are keyed by fingerprint and SQL, so
+    paraphrases that map to the same SQL share rows too.
+    """
+
+    def __init__(self, backend, plan_ttl: float = 86400.0, result_ttl: float = 300.0,
+                 similarity_threshold: float = 0.9, embedder=embed_query):
+        self.backend = backend
+        self.plan_ttl = plan_ttl
+        self.result_ttl = result_ttl
+        self.similarity_threshold = similarity_threshold
+        self.embedder = embedder
+
+    @staticmethod
+    def _key(*parts: str) -> str:
+        return hashlib.sha256("\x1f".join(parts).encode()).hexdigest()
+
+    def get_plan(self, query: str, fingerprint: str) -> tuple[dict, str]:
+        """Returns (plan, "exact" | "similar") on a hit, or (None, "miss")."""
+        value = self.backend.get(self._key("plan", fingerprint, normalize_query(query)))
+        if value is not None:
+            return json.loads(value)["plan"], "exact"
+
+        if self.similarity_threshold and self.similarity_threshold < 1:
+            match = self.backend.nearest(f"plan:{fingerprint}", self.embedder(query))
+            if match is not None and match[1] >= self.similarity_threshold:
+                value = self.backend.get(match[0])
+                if value is not None:
+                    entry = json.loads(value)
+                    # Entries written before guard tokens existed have none and never match.
+                    if entry.get("guards") == _guard_tokens(query):
+                        return entry["plan"], "similar"
+        return None, "miss"
+
+    def put_plan(self, query: str, fingerprint: str, plan: dict):
+        self.backend.set(
+            self._key("plan", fingerprint, normalize_query(query)),
+            _dumps({"plan": plan, "guards": _guard_tokens(query)}),
+            self.plan_ttl,
+            namespace=f"plan:{fingerprint}",
+            vector=self.embedder(query),
+        )
+
+    def get_result(self, fingerprint: str, sql: str):
+        """
+        Returns (table, metadata) for cached rows of this SQL, or None. `fingerprint` must
+        change whenever the data the SQL reads does (see databricks_flow._result_key).
+        """
+        if not self.result_ttl:
+            return None
+        value = self.backend.get(self._key("result", fingerprint, sql))
+        if value is None:
+            return None
+        # Stored as a one-line JSON header followed by the Arrow IPC stream.
+        header, _, body = value.partition(b"\n")
+        return from_arrow_ipc(body), json.loads(header)
+
+    def put_result(self, fingerprint: str, sql: str, table, metadata: dict):
+        """Stores result rows with JSON metadata such as the insights text."""
+        if self.result_ttl:
+            value = _dumps(metadata) + b"\n" + to_arrow_ipc(table)
+            self.backend.set(self._key("result", fingerprint, sql), value, self.result_ttl)
+
+
+def create_response_cache_from_env():
+    """
+    Builds the cache from RESPONSE_CACHE_* environment variables.
+    Returns None when RESPONSE_CACHE_BACKEND is "off".
+    """
+    backend_name = os.environ.get("RESPONSE_CACHE_BACKEND", "memory")
+    max_entries = int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", "1024"))
+    max_bytes = int(os.environ.get("RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+    if backend_name == "off":
+        return None
+    if backend_name == "sqlite":
+        path = os.environ.get("RESPONSE_CACHE_PATH", ".cache/response_cache.sqlite3")
+        backend = SQLiteBackend(path, max_entries=max_entries, max_bytes=max_bytes)
+    elif backend_name == "memory":
+        backend = MemoryBackend(max_entries=max_entries, max_bytes=max_bytes)
+    else:
+        raise ValueError(f"Unknown RESPONSE_CACHE_BACKEND '{backend_name}'.")
+
+    return ResponseCache(
+        backend,
+        plan_ttl=float(os.environ.get("RESPONSE_CACHE_PLAN_TTL", "86400")),
+        result_ttl=float(os.environ.get("RESPONSE_CACHE_RESULT_TTL", "300")),
+        similarity_threshold=float(os.environ.get("RESPONSE_CACHE_SIMILARITY", "0.9")),
+    )
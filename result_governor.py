@@ -0,0 +1,163 @@
+import os
+import numpy as np
+import pyarrow as pa
+from charts import row_budget, downsample_method
+
+# --- Row Budgets ---
+# Per-chart budgets and downsampling methods live in the chart registry (charts.py).
+# Charts that can be downsampled without losing their shape (line, scatter) fetch up to
+# OVERSAMPLE x budget rows from the warehouse and are reduced locally.
+OVERSAMPLE = int(os.environ.get("ROW_BUDGET_OVERSAMPLE", "10"))
+
+
+def govern_sql(sql: str, chart_type: str) -> tuple[str, int]:
+    """
+    Wraps generated SQL in an outer LIMIT so oversized results are cut in the warehouse.
+    Returns (governed_sql, fetch_limit); one extra row is requested to detect truncation.
+    """
+    budget = row_budget(chart_type)
+    fetch_limit = budget * OVERSAMPLE if downsample_method(chart_type) else budget
+    inner = sql.strip().rstrip(";").strip()
+    return f"SELECT * FROM (\n{inner}\n) AS governed_result LIMIT {fetch_limit + 1}", fetch_limit
+
+
+# --- Downsampling ---
+
+def _as_float(column) -> np.ndarray:
+    """Numeric or temporal Arrow column as float64; None for anything else."""
+    if not (pa.types.is_integer(column.type) or pa.types.is_floating(column.type)
+            or pa.types.is_decimal(column.type) or pa.types.is_temporal(column.type)):
+        return None
+    values = np.asarray(column.to_numpy(zero_copy_only=False))
+    if values.dtype.kind in "mM":
+        values = values.view("int64")
+    return np.nan_to_num(values.astype(np.float64))
+
+
+def lttb_indices(x: np.ndarray, y: np.ndarray, n_out: int) -> np.ndarray:
+    """
+    Largest-Triangle-Three-Buckets: picks n_out points that preserve a line's visual shape.
+    The buckets must follow the x axis, so points are sorted by x first; the returned
+    indices are in x order.
+    """
+    n = len(x)
+    order = np.argsort(x, kind="stable")
+    if n_out >= n or n_out < 3:
+        return order
+    x, y = x[order], y[order]
+
+    every = (n - 2) / (n_out - 2)
+    selected = np.empty(n_out, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        start = int(np.floor(i * every)) + 1
+        end = int(np.floor((i + 1) * every)) + 1
+        next_end = min(int(np.floor((i + 2) * every)) + 1, n)
+        avg_x, avg_y = x[end:next_end].mean(), y[end:next_end].mean()
+
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(np.argmax(area))
+        selected[i + 1] = a
+    return order[selected]
+
+
+def minmax_indices(x: np.ndarray, y: np.ndarray, n_out: int) -> np.ndarray:
+    """
+    Sorts by x, splits into n_out / 2 equal buckets and keeps each bucket's min and max y.
+    The returned indices are in x order.
+    """
+    n = len(x)
+    order = np.argsort(x, kind="stable")
+    if n_out >= n or n_out < 2:
+        return order
+
+    selected = []
+    for bucket in np.array_split(np.arange(n), n_out // 2):
+        if len(bucket):
+            values = y[order[bucket]]
+            selected.extend(sorted({bucket[np.argmin(values)], bucket[np.argmax(values)]}))
+    return order[np.asarray(selected, dtype=np.int64)]
+
+
+_DOWNSAMPLERS = {"lttb": lttb_indices, "minmax": minmax_indices}
+
+
+def _pick_columns(table: pa.Table):
+    """Chooses the x column, the y column and an optional series column for downsampling."""
+    x_name = table.column_names[0]
+    y_name = next(
+        (n for n in table.column_names[1:] if _as_float(table.column(n)) is not None
+         and not pa.types.is_temporal(table.column(n).type)),
+        None,
+    )
+    series_name = next(
+        (n for n in table.column_names[1:]
+         if n != y_name and (pa.types.is_string(table.column(n).type) or pa.types.is_large_string(table.column(n).type))),
+        None,
+    )
+    return x_name, y_name, series_name
+
+
+def downsample(table: pa.Table, method: str, n_out: int) -> tuple[pa.Table, int]:
+    """
+    Reduces a table to at most n_out rows with the given method, returned in x order.
+    Multi-series results (a text column next to x and y) are reduced per series so lines
+    are not interleaved; each series keeps at least 3 points, so when there are more
+    series than that allows, only the series with the most rows are kept.
+    Returns (table, number of series dropped). Tables without a numeric y column are
+    returned unchanged.
+    """
+    x_name, y_name, series_name = _pick_columns(table)
+    if y_name is None:
+        return table, 0
+
+    x = _as_float(table.column(x_name))
+    if x is None:
+        # Categorical x: use row order as the axis.
+        x = np.arange(table.num_rows, dtype=np.float64)
+    y = _as_float(table.column(y_name))
+    pick = _DOWNSAMPLERS[method]
+
+    if series_name is None:
+        return table.take(pick(x, y, n_out)), 0
+
+    series = np.asarray(table.column(series_name).to_numpy(zero_copy_only=False), dtype=object)
+    groups = [np.flatnonzero(series == value) for value in dict.fromkeys(series)]
+    kept = sorted(groups, key=len, reverse=True)[:max(n_out // 3, 1)]
+    per_series = n_out // len(kept)
+    indices = np.concatenate([group[pick(x[group], y[group], per_series)] for group in kept])
+    return table.take(indices[np.argsort(x[indices], kind="stable")]), len(groups) - len(kept)
+
+
+def reduce_result(table: pa.Table, chart_type: str, fetch_limit: int) -> tuple[pa.Table, dict]:
+    """
+    Applies the row budget to a governed result and describes what was done to it:
+    {"row_budget", "rows_fetched", "rows_returned", "truncated", "downsampled", "series_dropped"}.
+    Downsampled results always fit the budget; only other results are cut to it.
+    """
+    budget = row_budget(chart_type)
+    rows_fetched = table.num_rows
+    truncated = rows_fetched > fetch_limit
+    if truncated:
+        table = table.slice(0, fetch_limit)
+
+    method = downsample_method(chart_type)
+    downsampled, series_dropped = None, 0
+    if table.num_rows > budget:
+        if method:
+            reduced, series_dropped = downsample(table, method, budget)
+            if reduced.num_rows < table.num_rows:
+                table, downsampled = reduced, method
+        # Downsampled rows are in x order, so a slice would cut the end off every series.
+        if table.num_rows > budget and downsampled is None:
+            table, truncated = table.slice(0, budget), True
+
+    return table, {
+        "row_budget": budget,
+        "rows_fetched": min(rows_fetched, fetch_limit),
+        "rows_returned": table.num_rows,
+        "truncated": truncated,
+        "downsampled": downsampled,
+        "series_dropped": series_dropped,
+    }
@@ -0,0 +1,352 @@
+import os
+import time
+import copy
+import hashlib
+import threading
+from db_pool import get_pool
+from metrics import timed
+from local_store import local_store
+from sql_guard import qualified_name, quote_identifier
+
+# Rollup tables live next to the tables they summarize; this prefix keeps them out of table selection.
+ROLLUP_PREFIX = "rollup__"
+
+# Aggregates that can be stored per group and re-aggregated later. AVG is kept as SUM and COUNT.
+_MEASURES = {"Sum": ("sum",), "Min": ("min",), "Max": ("max",), "Count": ("count",), "Avg": ("sum", "count")}
+_REAGGREGATE = {"sum": "SUM", "count": "SUM", "min": "MIN", "max": "MAX"}
+
+
+def is_rollup_table(table_name: str) -> bool:
+    return table_name.startswith(ROLLUP_PREFIX)
+
+
+def _qualified(table_name: str) -> str:
+    return qualified_name(os.environ.get("DB_CATALOG"), os.environ.get("DB_SCHEMA"), table_name)
+
+
+def _execute_statement(statement: str):
+    with get_pool().connection() as connection, connection.cursor() as cursor:
+        cursor.execute(statement)
+
+
+def extract_shape(sql: str, table_name: str, dialect: str = "databricks"):
+    """
+    Finds the aggregation a query runs over `table_name`, as (dimensions, measures).
+
+    Dimensions are the columns used in GROUP BY and WHERE, so a rollup grouped on them
+    can answer the same filters and any expression of those columns (e.g. YEAR(order_date)).
+    Measures are strings like "sum:amount" or "count:*". Returns None unless some SELECT
+    reads the table alone (no joins) and uses only SUM, COUNT, MIN, MAX and AVG of plain columns.
+    """
+    # Imported on first use to keep start-up fast (see sql_guard.py).
+    import sqlglot
+    from sqlglot import exp
+    from sqlglot.errors import SqlglotError
+
+    try:
+        tree = sqlglot.parse_one(sql, read=dialect)
+    except SqlglotError:
+        return None
+
+    for select in tree.find_all(exp.Select):
+        source = select.args.get("from_")
+        if (source is None or select.args.get("joins") or not isinstance(source.this, exp.Table)
+                or source.this.name.lower() != table_name.lower()):
+            continue
+        aggregates = [
+            agg for node in [*select.expressions, select.args.get("having")] if node is not None
+            for agg in node.find_all(exp.AggFunc)
+        ]
+        if not aggregates:
+            continue
+
+        measures = set()
+        for agg in aggregates:
+            kinds, arg = _MEASURES.get(type(agg).__name__), agg.this
+            if kinds is None:
+                return None
+            if isinstance(arg, exp.Star) and isinstance(agg, exp.Count):
+                measures.add("count:*")
+            elif isinstance(arg, exp.Column):
+                measures.update(f"{kind}:{arg.name.lower()}" for kind in kinds)
+            else:
+                return None  # COUNT(DISTINCT ...) or an aggregate over an expression
+
+        dimensions = {
+            column.name.lower()
+            for clause in (select.args.get("group"), select.args.get("where")) if clause is not None
+            for column in clause.find_all(exp.Column)
+        }
+        return frozenset(dimensions), frozenset(measures)
+    return None
+
+
+def _measure_column(measure: str) -> str:
+    kind, column = measure.split(":", 1)
+    return "row_count" if column == "*" else f"{kind}_{column}"
+
+
+def _new_state() -> dict:
+    # JSON-friendly so it can live in the local store; dimension sets are keyed as "a,b".
+    return {
+        "shapes": {},   # dimensions -> {"measures": [...], "hits": int}
+        "rollups": {},  # rollup name -> {"dimensions": [...], "measures": [...], "built_at": float}
+        "revision": 0,  # bumped whenever the table's rollups change
+        "lease": None,  # {"owner": str, "until": float} while a build is running
+        "rebuild": False,  # a build was requested while another was running
+    }
+
+
+def _dimension_key(dimensions) -> str:
+    return ",".join(sorted(dimensions))
+
+
+def _dimensions(key: str) -> frozenset:
+    return frozenset(key.split(",")) if key else frozenset()
+
+
+class RollupManager:
+    """
+    Materializes frequent aggregations over uploaded tables as summary tables.
+
+    `record` notes the (dimensions, measures) shape of each executed query. Once a table's
+    dimension set has been seen `min_hits` times, a summary table grouped by those
+    dimensions is built in the background, with every measure asked for so far. Table
+    uploads call `invalidate` when a run starts; once new data is in (a finished run or an
+    append), `invalidate` stops offering the old rollups and `refresh` rebuilds them.
+    `describe` tells the SQL prompt which rollups exist; it is up to the model to use one
+    when it covers the question.
+
+    With a `store` (see local_store.py) usage counts, the rollups of each table and their
+    revision are shared by all worker processes, and a build lease of `build_timeout`
+    seconds makes sure only one of them builds a table's rollups at a time.
+
+    `execute(statement)` runs DDL on the warehouse; `qualify(name)` returns the full name.
+    """
+
+    NAMESPACE = "rollups"
+    # Rollup state outlives any build; it is dropped only with the table's shapes.
+    STATE_TTL = 30 * 86400
+
+    def __init__(self, min_hits: int = 3, max_per_table: int = 4, max_dimensions: int = 4,
+                 max_age: float = 21600.0, execute=_execute_statement, qualify=_qualified,
+                 dialect: str = "databricks", store=None, build_timeout: float = 1800.0):
+        self.min_hits = min_hits
+        self.max_per_table = max_per_table
+        self.max_dimensions = max_dimensions
+        self.max_age = max_age
+        self.dialect = dialect
+        self.store = store
+        self.build_timeout = build_timeout
+        self._execute = execute
+        self._qualify = qualify
+        self._tables = {}  # table -> state, when there is no store
+        self._revision = 0  # sum of all table revisions, when there is no store
+        self._lock = threading.Lock()
+
+    # --- State ---
+
+    @property
+    def _owner(self) -> str:
+        # Includes the pid at call time, so forked workers never share a build lease.
+        return f"{os.getpid()}:{id(self)}"
+
+    def _read(self, table_name: str) -> dict:
+        if self.store is not None:
+            return self.store.get(self.NAMESPACE, table_name) or _new_state()
+        with self._lock:
+            return copy.deepcopy(self._tables.get(table_name) or _new_state())
+
+    def _modify(self, table_name: str, fn):
+        """Applies `fn(state)`, which changes the table's state in place, atomically; returns its result."""
+        if self.store is not None:
+            def apply(state):
+                state = state or _new_state()
+                return state, fn(state)
+            return self.store.modify(self.NAMESPACE, table_name, apply, self.STATE_TTL)
+        with self._lock:
+            return fn(self._tables.setdefault(table_name, _new_state()))
+
+    def _bump_revision(self, table_name: str, rollups: dict = None):
+        """Replaces the table's rollups (if given) and bumps its revision and the global one."""
+        def bump(state):
+            if rollups is not None:
+                state["rollups"] = rollups
+            state["revision"] += 1
+        self._modify(table_name, bump)
+        if self.store is not None:
+            self.store.increment(self.NAMESPACE, "__revision__")
+        else:
+            with self._lock:
+                self._revision += 1
+
+    # --- Usage Tracking ---
+
+    def record(self, table_name: str, schema: list, sql: str):
+        """Counts the query's aggregation shape and schedules a build once it is frequent."""
+        if not self.min_hits or is_rollup_table(table_name):
+            return
+        shape = extract_shape(sql, table_name, self.dialect)
+        if shape is None:
+            return
+        dimensions, measures = shape
+        known = {col["column_name"].lower() for col in schema}
+        columns = dimensions | ({m.split(":", 1)[1] for m in measures} - {"*"})
+        if len(dimensions) > self.max_dimensions or not columns <= known:
+            return
+
+        def count(state):
+            usage = state["shapes"].setdefault(_dimension_key(dimensions), {"measures": [], "hits": 0})
+            usage["hits"] += 1
+            new_measures = not measures <= set(usage["measures"])
+            usage["measures"] = sorted(set(usage["measures"]) | measures)
+            # Build on reaching the threshold, and again when a hot rollup lacks a measure.
+            return usage["hits"] == self.min_hits or (usage["hits"] > self.min_hits and new_measures)
+
+        if self._modify(table_name, count):
+            self._schedule(table_name)
+
+    def _hot_shapes(self, table_name: str) -> list:
+        shapes = [
+            (_dimensions(key), set(usage["measures"]), usage["hits"])
+            for key, usage in self._read(table_name)["shapes"].items()
+            if usage["hits"] >= self.min_hits
+        ]
+        shapes.sort(key=lambda shape: -shape[2])
+        return shapes[:self.max_per_table]
+
+    # --- Materialization ---
+
+    def rollup_name(self, table_name: str, dimensions) -> str:
+        digest = hashlib.sha256(",".join(sorted(dimensions)).encode()).hexdigest()[:8]
+        return f"{ROLLUP_PREFIX}{table_name}__{digest}"
+
+    def _build_statement(self, table_name: str, dimensions, measures) -> str:
+        columns = [quote_identifier(d) for d in sorted(dimensions)]
+        for measure in sorted(measures):
+            kind, column = measure.split(":", 1)
+            expression = "COUNT(*)" if column == "*" else f"{kind.upper()}({quote_identifier(column)})"
+            columns.append(f"{expression} AS {quote_identifier(_measure_column(measure))}")
+        group_by = f" GROUP BY {', '.join(quote_identifier(d) for d in sorted(dimensions))}" if dimensions else ""
+        return (
+            f"CREATE OR REPLACE TABLE {self._qualify(self.rollup_name(table_name, dimensions))} AS "
+            f"SELECT {', '.join(columns)} FROM {self._qualify(table_name)}{group_by}"
+        )
+
+    def materialize(self, table_name: str):
+        """(Re)builds every hot rollup for a table; blocking, so normally run via `refresh`."""
+        built = {}
+        for dimensions, measures, _ in self._hot_shapes(table_name):
+            measures.add("count:*")
+            name = self.rollup_name(table_name, dimensions)
+            try:
+                with timed("rollup_build"):
+                    self._execute(self._build_statement(table_name, dimensions, measures))
+            except Exception as e:
+                # Usually a re-uploaded table lost a column; forget the shape.
+                print(f"Could not build rollup {name}: {e}")
+                self._modify(table_name, lambda state: state["shapes"].pop(_dimension_key(dimensions), None))
+                continue
+            built[name] = {"dimensions": sorted(dimensions), "measures": sorted(measures), "built_at": time.time()}
+            print(f"Built rollup {name} over {', '.join(sorted(dimensions)) or 'the whole table'}.")
+
+        self._bump_revision(table_name, built)
+
+    def _schedule(self, table_name: str):
+        def acquire(state):
+            lease, now = state["lease"], time.time()
+            if lease is not None and lease["until"] > now:
+                # The running build may predate the request (e.g. new data); build again after it.
+                state["rebuild"] = True
+                return False
+            state["lease"] = {"owner": self._owner, "until": now + self.build_timeout}
+            state["rebuild"] = False
+            return True
+
+        if self._modify(table_name, acquire):
+            threading.Thread(target=self._build_in_background, args=(table_name,), name="rollup-build", daemon=True).start()
+
+    def _build_in_background(self, table_name: str):
+        def release(state):
+            if state["lease"] and state["lease"]["owner"] == self._owner:
+                state["lease"] = None
+            return state.get("rebuild", False)
+
+        try:
+            self.materialize(table_name)
+        except Exception as e:
+            print(f"Rollup build for {table_name} failed: {e}")
+        finally:
+            rebuild = self._modify(table_name, release)
+        if rebuild:
+            self._schedule(table_name)
+
+    def refresh(self, table_name: str):
+        """Rebuilds a table's rollups in the background, e.g. after an upload job finished."""
+        if self._hot_shapes(table_name):
+            self._schedule(table_name)
+
+    def invalidate(self, table_name: str):
+        """Stops offering a table's rollups, e.g. while an upload job replaces the table."""
+        if self._read(table_name)["rollups"]:
+            self._bump_revision(table_name, {})
+
+    # --- Prompt Hints ---
+
+    def revision(self, table_name: str = None) -> int:
+        """Changes whenever the rollups of `table_name` (or of any table) change; used in cache keys."""
+        if table_name is not None:
+            return self._read(table_name)["revision"]
+        if self.store is not None:
+            return self.store.counter(self.NAMESPACE, "__revision__")
+        with self._lock:
+            return self._revision
+
+    def available(self, table_name: str) -> dict:
+        """Fresh rollups of a table; stale ones are rebuilt in the background and left out."""
+        rollups = self._read(table_name)["rollups"]
+        now = time.time()
+        fresh = {name: r for name, r in rollups.items() if not self.max_age or now - r["built_at"] < self.max_age}
+        if len(fresh) < len(rollups):
+            self.refresh(table_name)
+        return fresh
+
+    def describe(self, table_name: str) -> str:
+        """Prompt text listing a table's rollups and how to re-aggregate them; empty if none."""
+        rollups = self.available(table_name)
+        if not rollups:
+            return ""
+        lines = []
+        for name, rollup in sorted(rollups.items()):
+            measures = ", ".join(_measure_column(m) for m in sorted(rollup["measures"]))
+            lines.append(
+                f"- {self._qualify(name)}: grouped by {', '.join(sorted(rollup['dimensions'])) or 'nothing (one row)'}; "
+                f"columns {measures}"
+            )
+        rules = ", ".join(
+            f"{kind.upper()}(x) -> {_REAGGREGATE[kind]}({kind}_x)" for kind in ("sum", "count", "min", "max")
+        )
+        return (
+            "Pre-aggregated rollups of this table. Query a rollup instead of the table when its grouping "
+            "columns include every column you filter or group on and it has every aggregate you need. "
+            f"Re-aggregate its columns: {rules}, COUNT(*) -> SUM(row_count), AVG(x) -> SUM(sum_x) / SUM(count_x).\n"
+            + "\n".join(lines)
+        )
+
+
+def create_rollup_manager_from_env() -> RollupManager:
+    """
+    Builds the manager from ROLLUP_MIN_HITS (0 disables rollups), ROLLUP_MAX_PER_TABLE,
+    ROLLUP_MAX_DIMENSIONS and ROLLUP_MAX_AGE (seconds before a rollup is rebuilt).
+    """
+    return RollupManager(
+        min_hits=int(os.environ.get("ROLLUP_MIN_HITS", "3")),
+        max_per_table=int(os.environ.get("ROLLUP_MAX_PER_TABLE", "4")),
+        max_dimensions=int(os.environ.get("ROLLUP_MAX_DIMENSIONS", "4")),
+        max_age=float(os.environ.get("ROLLUP_MAX_AGE", "21600")),
+        store=local_store,
+    )
+
+
+# Shared by the query flow (usage and prompt hints) and the upload jobs (rebuilds).
+rollup_manager = create_rollup_manager_from_env()
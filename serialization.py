@@ -0,0 +1,74 @@
+import datetime
+import decimal
+import orjson
+import pyarrow as pa
+import pyarrow.compute as pc
+
+# --- Result Formats ---
+# Query results travel through the flow as pyarrow Tables and are only turned into
+# Python objects at the edge, in whichever shape the client asked for:
+#   "rows"     - [{column: value, ...}, ...] (the original format)
+#   "columnar" - {"columns": [{"name", "type"}], "data": {column: [values]}}
+#   "arrow"    - Arrow IPC stream bytes
+RESULT_FORMATS = ("rows", "columnar", "arrow")
+ARROW_STREAM_MEDIA_TYPE = "application/vnd.apache.arrow.stream"
+
+
+def _json_friendly(table: pa.Table) -> pa.Table:
+    """Casts decimal columns to float64 in Arrow so they never round-trip through Decimal objects."""
+    for i, field in enumerate(table.schema):
+        if pa.types.is_decimal(field.type):
+            table = table.set_column(i, field.name, pc.cast(table.column(i), pa.float64()))
+    return table
+
+
+def to_rows(table: pa.Table) -> list:
+    return _json_friendly(table).to_pylist()
+
+
+def to_columnar(table: pa.Table) -> dict:
+    table = _json_friendly(table)
+    return {
+        "columns": [{"name": f.name, "type": str(f.type)} for f in table.schema],
+        "data": table.to_pydict(),
+    }
+
+
+def format_table(table: pa.Table, result_format: str):
+    """Converts a result table into the JSON-ready `rows` or `columnar` shape."""
+    if result_format == "columnar":
+        return to_columnar(table)
+    if result_format == "rows":
+        return to_rows(table)
+    raise ValueError(f"Unknown result format '{result_format}'. Expected one of: {', '.join(RESULT_FORMATS)}.")
+
+
+def to_arrow_ipc(table: pa.Table, metadata: dict = None) -> bytes:
+    """Serializes a table as an Arrow IPC stream, with optional JSON metadata on the schema."""
+    if metadata:
+        table = table.replace_schema_metadata({k: dumps(v) for k, v in metadata.items()})
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def from_arrow_ipc(data: bytes) -> pa.Table:
+    return pa.ipc.open_stream(pa.py_buffer(data)).read_all()
+
+
+# --- Fast JSON ---
+
+def _default(value):
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if isinstance(value, (bytes, bytearray)):
+        return value.decode("utf-8", errors="replace")
+    if isinstance(value, datetime.timedelta):
+        return value.total_seconds()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(value) -> bytes:
+    """orjson-based encoder; several times faster than json for large result sets."""
+    return orjson.dumps(value, default=_default, option=orjson.OPT_NON_STR_KEYS)
@@ -0,0 +1,75 @@
+import asyncio
+import threading
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent async calls with the same key into one execution.
+
+    The first caller starts `fn()` as a task; callers arriving while it runs await the same
+    task and get the same result (or exception). The task is shielded from any single
+    caller's cancellation, e.g. one client's stage timeout, and is only cancelled once
+    every caller waiting on it has gone. Nothing is kept after completion, so this
+    deduplicates in-flight work only; caching is the response cache's job.
+    """
+
+    def __init__(self):
+        self._inflight = {}  # key -> [task, waiter count]
+
+    def __len__(self):
+        return len(self._inflight)
+
+    async def run(self, key, fn) -> tuple:
+        """Returns (result, shared) where `shared` is True if another caller started the work."""
+        entry = self._inflight.get(key)
+        shared = entry is not None
+        if entry is None:
+            task = asyncio.ensure_future(fn())
+            entry = self._inflight[key] = [task, 0]
+            task.add_done_callback(lambda t: self._forget(key, t))
+        entry[1] += 1
+        try:
+            return await asyncio.shield(entry[0]), shared
+        except asyncio.CancelledError:
+            if entry[1] == 1 and not entry[0].done():
+                entry[0].cancel()
+            raise
+        finally:
+            entry[1] -= 1
+
+    def _forget(self, key, task):
+        entry = self._inflight.get(key)
+        if entry is not None and entry[0] is task:
+            del self._inflight[key]
+
+
+class ThreadSingleFlight:
+    """Thread-based counterpart of SingleFlight for the synchronous flow."""
+
+    def __init__(self):
+        self._inflight = {}  # key -> {"done": Event, "result", "error"}
+        self._lock = threading.Lock()
+
+    def run(self, key, fn) -> tuple:
+        """Returns (result, shared); callers with the same key block until the first one finishes."""
+        with self._lock:
+            call = self._inflight.get(key)
+            shared = call is not None
+            if call is None:
+                call = self._inflight[key] = {"done": threading.Event(), "result": None, "error": None}
+
+        if shared:
+            call["done"].wait()
+        else:
+            try:
+                call["result"] = fn()
+            except BaseException as e:
+                call["error"] = e
+            finally:
+                with self._lock:
+                    del self._inflight[key]
+                call["done"].set()
+
+        if call["error"] is not None:
+            raise call["error"]
+        return call["result"], shared
@@ -0,0 +1,173 @@
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+from functools import lru_cache
+from collections import OrderedDict
+
+# Statements that write, change the catalog or session, or otherwise are not a plain read.
+_FORBIDDEN = (
+    "Insert", "Update", "Delete", "Merge", "Create", "Drop", "Alter", "TruncateTable",
+    "Command", "Use", "Set", "Copy", "Grant", "Refresh", "Cache", "Uncache", "LoadData", "Analyze",
+)
+
+# Spark prints plan sizes with binary units, e.g. "Statistics(sizeInBytes=1.5 GiB, rowCount=...)".
+_STATISTICS_RE = re.compile(r"sizeInBytes=([\d.]+(?:E[+-]?\d+)?)\s*(B|KiB|MiB|GiB|TiB|PiB|EiB)", re.IGNORECASE)
+_UNITS = {"b": 1, "kib": 2 ** 10, "mib": 2 ** 20, "gib": 2 ** 30, "tib": 2 ** 40, "pib": 2 ** 50, "eib": 2 ** 60}
+
+
+# Table names the API creates or queries: letters, digits, "_" and "-", which also keeps
+# them safe as file names in the Volume.
+TABLE_NAME_RE = re.compile(r"^[A-Za-z0-9_-]{1,255}$")
+
+
+# --- Quoting ---
+# Names and values that come from uploads or model output are quoted with these helpers
+# wherever SQL is assembled from strings.
+
+def is_valid_table_name(name: str) -> bool:
+    return bool(TABLE_NAME_RE.match(name))
+
+
+def quote_identifier(name: str) -> str:
+    """Backtick-quotes a catalog, schema, table or column name."""
+    return "`" + name.replace("`", "``") + "`"
+
+
+def qualified_name(catalog: str, schema: str, table_name: str) -> str:
+    return ".".join(quote_identifier(part) for part in (catalog, schema, table_name))
+
+
+def quote_string(value: str) -> str:
+    """Single-quoted Databricks SQL string literal."""
+    return "'" + value.replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+
+class UnsafeSQLError(ValueError):
+    """Raised when generated SQL is not a single read-only query."""
+
+
+class ScanBudgetExceeded(ValueError):
+    """Raised when the warehouse estimates a query would process more than the scan budget."""
+
+
+@lru_cache(maxsize=1)
+def _forbidden_nodes() -> tuple:
+    from sqlglot import exp
+    return tuple(getattr(exp, name) for name in _FORBIDDEN if hasattr(exp, name))
+
+
+def ensure_read_only(sql: str, dialect: str = "databricks"):
+    """Parses SQL locally and rejects anything but exactly one SELECT-style query."""
+    # sqlglot is imported on first use; it is one of the slower imports at start-up.
+    import sqlglot
+    from sqlglot import exp
+    from sqlglot.errors import ParseError
+
+    try:
+        statements = [s for s in sqlglot.parse(sql, read=dialect) if s is not None]
+    except ParseError as e:
+        raise UnsafeSQLError(f"Generated SQL could not be parsed: {str(e).splitlines()[0]}")
+    if len(statements) != 1:
+        raise UnsafeSQLError(f"Expected exactly one SQL statement, got {len(statements)}.")
+
+    statement = statements[0]
+    if not isinstance(statement, exp.Query):
+        raise UnsafeSQLError(f"Only read-only queries are allowed, got {statement.key.upper()}.")
+    forbidden = next(statement.find_all(*_forbidden_nodes()), None)
+    if forbidden is not None:
+        raise UnsafeSQLError(f"Only read-only queries are allowed, found {forbidden.key.upper()}.")
+
+
+def estimate_scan_bytes(plan: str) -> float:
+    """
+    Largest sizeInBytes in an `EXPLAIN COST` plan: the biggest relation read or
+    intermediate result (a cross join shows up as a huge join node). None if absent.
+    """
+    sizes = [float(value) * _UNITS[unit.lower()] for value, unit in _STATISTICS_RE.findall(plan)]
+    return max(sizes) if sizes else None
+
+
+class SQLGuard:
+    """
+    Pre-execution checks for generated SQL: a local read-only parse, then an `EXPLAIN COST`
+    estimate compared against `scan_budget` bytes (0 disables the cost check).
+
+    SQL that passed is remembered per (table, schema hash, normalized question), so a
+    repeat question can reuse the SQL without generating it again, and skips both checks.
+    """
+
+    def __init__(self, scan_budget: float = 0, max_entries: int = 1024, ttl: float = 3600.0,
+                 dialect: str = "databricks"):
+        self.scan_budget = scan_budget
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.dialect = dialect
+        self._validated = OrderedDict()  # key -> (sql, estimated_bytes, validated_at)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def cache_key(table_name: str, schema: list, normalized_query: str) -> str:
+        schema_hash = hashlib.sha256(json.dumps(schema, sort_keys=True).encode()).hexdigest()[:16]
+        return f"{table_name}:{schema_hash}:{normalized_query}"
+
+    def validated_sql(self, key: str):
+        """SQL validated earlier for this key, or None."""
+        with self._lock:
+            entry = self._validated.get(key)
+            if entry is None or time.monotonic() - entry[2] > self.ttl:
+                return None
+            self._validated.move_to_end(key)
+            return entry[0]
+
+    def check(self, sql: str, key: str, explain) -> float:
+        """
+        Validates `sql`, calling `explain(sql)` for the `EXPLAIN COST` plan text when a scan
+        budget is set. Returns the estimated bytes (None if unknown or not checked).
+        Raises UnsafeSQLError (also when the warehouse fails to plan the SQL) or ScanBudgetExceeded.
+        """
+        with self._lock:
+            entry = self._validated.get(key)
+        if entry is not None and entry[0] == sql and time.monotonic() - entry[2] <= self.ttl:
+            return entry[1]
+
+        ensure_read_only(sql, self.dialect)
+        estimated = None
+        if self.scan_budget:
+            try:
+                plan = explain(sql)
+            except (TimeoutError, ConnectionError, RuntimeError):
+                # The warehouse or the connection pool is unavailable, which says nothing about the SQL.
+                raise
+            except Exception as e:
+                # The planner rejected the query (e.g. an unknown table or column).
+                message = str(e).strip().splitlines()[0] if str(e).strip() else type(e).__name__
+                raise UnsafeSQLError(f"The warehouse could not plan the generated SQL: {message}") from e
+            estimated = estimate_scan_bytes(plan)
+            if estimated is not None and estimated > self.scan_budget:
+                raise ScanBudgetExceeded(
+                    f"Query would process about {estimated / 2 ** 30:.1f} GiB, over the "
+                    f"{self.scan_budget / 2 ** 30:.1f} GiB scan budget. Try narrowing the question "
+                    f"(a time range, a filter or an aggregation)."
+                )
+
+        with self._lock:
+            self._validated[key] = (sql, estimated, time.monotonic())
+            self._validated.move_to_end(key)
+            while len(self._validated) > self.max_entries:
+                self._validated.popitem(last=False)
+        return estimated
+
+
+def create_sql_guard_from_env() -> SQLGuard:
+    """
+    Builds the guard from SQL_SCAN_BUDGET_BYTES (default 50 GiB, 0 disables EXPLAIN),
+    SQL_GUARD_CACHE_ENTRIES and SQL_GUARD_CACHE_TTL.
+    """
+    return SQLGuard(
+        scan_budget=float(os.environ.get("SQL_SCAN_BUDGET_BYTES", str(50 * 2 ** 30))),
+        max_entries=int(os.environ.get("SQL_GUARD_CACHE_ENTRIES", "1024")),
+        ttl=float(os.environ.get("SQL_GUARD_CACHE_TTL", "3600")),
+    )
@@ -0,0 +1,120 @@
+import re
+import math
+import threading
+from collections import Counter
+import numpy as np
+from response_cache import STOPWORDS
+
+_TOKEN_RE = re.compile(r"[A-Za-z]+|\d+")
+
+
+def tokenize(text: str) -> list:
+    """
+    Splits snake_case, camelCase and free text into lowercase terms, with naive plural
+    stripping so "orders" matches an `order_id` column. Stopwords are dropped.
+    """
+    text = re.sub(r"([a-z])([A-Z])", r"\1 \2", text)
+    tokens = []
+    for token in _TOKEN_RE.findall(text):
+        token = token.lower()
+        if token in STOPWORDS:
+            continue
+        if len(token) > 3 and token.endswith("s") and not token.endswith("ss"):
+            token = token[:-1]
+        tokens.append(token)
+    return tokens
+
+
+class TableIndex:
+    """
+    Okapi BM25 index over table names, descriptions and column names.
+
+    `sync` only re-tokenizes tables whose metadata changed, so keeping the index in step
+    with the catalog cache is cheap. Postings are held as NumPy arrays and a query is
+    scored against every table in a few vector operations.
+    """
+
+    # Table and column names are the strongest signal; repeat them to weight them up.
+    NAME_WEIGHT = 3
+    COLUMN_WEIGHT = 2
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self._docs = {}  # table_name -> (signature, Counter of terms)
+        self._names = []
+        self._postings = {}  # term -> (doc indices, term frequencies)
+        self._idf = {}
+        self._norms = np.zeros(0)
+        self._dirty = False
+        # The (table_metadata, schemas) objects last synced with; kept rather than their ids,
+        # which a later catalog load can reuse once the old objects are freed.
+        self._synced_with = (None, None)
+        self._lock = threading.Lock()
+
+    def _document(self, meta: dict, schema: list) -> Counter:
+        terms = tokenize(meta["table_name"]) * self.NAME_WEIGHT
+        terms += tokenize(meta.get("description") or "")
+        for column in schema:
+            terms += tokenize(column["column_name"]) * self.COLUMN_WEIGHT
+        return Counter(terms)
+
+    def sync(self, table_metadata: list, schemas: dict):
+        """Adds, updates and removes tables so the index mirrors the given catalog."""
+        with self._lock:
+            if self._synced_with[0] is table_metadata and self._synced_with[1] is schemas:
+                return
+
+            current = set()
+            for meta in table_metadata:
+                name = meta["table_name"]
+                schema = schemas.get(name, [])
+                signature = (meta.get("description"), tuple(c["column_name"] for c in schema))
+                current.add(name)
+                if name not in self._docs or self._docs[name][0] != signature:
+                    self._docs[name] = (signature, self._document(meta, schema))
+                    self._dirty = True
+            for name in set(self._docs) - current:
+                del self._docs[name]
+                self._dirty = True
+
+            if self._dirty:
+                self._rebuild()
+            self._synced_with = (table_metadata, schemas)
+
+    def _rebuild(self):
+        self._names = list(self._docs)
+        lengths = np.array([sum(doc.values()) for _, doc in self._docs.values()], dtype=np.float64)
+        average = lengths.mean() if len(lengths) else 0.0
+
+        postings = {}
+        for i, (_, doc) in enumerate(self._docs.values()):
+            for term, tf in doc.items():
+                postings.setdefault(term, ([], []))
+                postings[term][0].append(i)
+                postings[term][1].append(tf)
+
+        n = len(self._names)
+        self._postings = {t: (np.array(d), np.array(f, dtype=np.float64)) for t, (d, f) in postings.items()}
+        self._idf = {t: math.log(1 + (n - len(d) + 0.5) / (len(d) + 0.5)) for t, (d, _) in postings.items()}
+        self._norms = self.k1 * (1 - self.b + self.b * lengths / average) if average else lengths
+        self._dirty = False
+
+    def search(self, query: str, k: int = 10) -> list:
+        """Returns up to k (table_name, score) pairs with a positive score, best first."""
+        with self._lock:
+            scores = np.zeros(len(self._names))
+            for term in set(tokenize(query)):
+                if term not in self._postings:
+                    continue
+                docs, tfs = self._postings[term]
+                scores[docs] += self._idf[term] * tfs * (self.k1 + 1) / (tfs + self._norms[docs])
+
+            top = np.argsort(-scores, kind="stable")[:k]
+            return [(self._names[i], float(scores[i])) for i in top if scores[i] > 0]
+
+    def matched_terms(self, query: str, table_name: str) -> int:
+        """Number of distinct query terms found in the table's name, description or columns."""
+        with self._lock:
+            doc = self._docs.get(table_name, (None, {}))[1]
+            return sum(1 for term in set(tokenize(query)) if term in doc)